@@ -0,0 +1,197 @@
+# Miguel Delapaz - CS594 - Test harness for running servers in process
+#
+# The net fixture starts Servers on free ports in the test's own process and
+# connects test clients (Peers) to them.  Nothing runs in the background:
+# net.wait() turns every server's event loop and reads every peer's socket
+# until the condition it is given holds, so a test is one thread doing one
+# thing at a time and a failure is the same every run.
+#
+# Where a test needs a server in a process of its own (a handoff, or TLS,
+# whose handshakes block), start_server runs the real command line and the
+# processes fixture cleans up after it.
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import irc_server
+from irc_protocol import Command, ResponseCodes, BinaryFrameDecoder, encode_binary_frame, RECV_SIZE
+
+class Peer:
+    # A client speaking the binary framing on a non-blocking socket.  Every
+    # frame received is kept in frames as (command, status, payload text)
+    def __init__(self, port, receiveBuffer=None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if receiveBuffer is not None:
+            # Before connecting, so the window is small from the start
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receiveBuffer)
+        self.sock.connect(('127.0.0.1', port))
+        self.sock.setblocking(False)
+        self.decoder = BinaryFrameDecoder()
+        self.frames = []
+        self.pending = bytearray()
+        # Cleared to stop reading, like a client that has stalled
+        self.reading = True
+        self.closed = False
+
+    def send(self, command, payload='', flags=0):
+        self.pending += encode_binary_frame(command, 0, payload, flags)
+        self.flush()
+
+    def flush(self):
+        while self.pending and not self.closed:
+            try:
+                sent = self.sock.send(self.pending)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self.closed = True
+                return
+            del self.pending[:sent]
+
+    def poll(self):
+        self.flush()
+        while self.reading and not self.closed:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                data = b''
+            if not data:
+                self.closed = True
+                return
+            for command, status, flags, payload in self.decoder.feed(data):
+                self.frames.append((command, status, payload.decode('utf-8')))
+
+    def responses(self, command, status=None):
+        # Payloads of the frames received for command, oldest first
+        command = command.value
+        status = status.value if status is not None else None
+        return [payload for c, s, payload in self.frames if c == command and (status is None or s == status)]
+
+    def close(self):
+        self.sock.close()
+        self.closed = True
+
+class Net:
+    def __init__(self):
+        self.servers = []
+        self.peers = []
+
+    def server(self, backend='default', **options):
+        # Keepalives off unless a test asks - a slow run shouldn't time anyone out
+        options.setdefault('pingInterval', 0)
+        options.setdefault('idleTimeout', 0)
+        options.setdefault('loginTimeout', 0)
+        server = irc_server.Server(0, irc_server.make_selector(backend), **options)
+        self.servers.append(server)
+        return server
+
+    def peer(self, server, name=None, receiveBuffer=None):
+        # Connected, and logged in as name if given
+        return self.connect(server.port, name, receiveBuffer)
+
+    def connect(self, port, name=None, receiveBuffer=None):
+        # peer() for a server on port that isn't ours, e.g. another process
+        peer = Peer(port, receiveBuffer)
+        self.peers.append(peer)
+        if name is not None:
+            peer.send(Command.LOGIN, name)
+            self.wait(lambda: peer.responses(Command.LOGIN))
+            assert peer.responses(Command.LOGIN, ResponseCodes.OK) == ['']
+        return peer
+
+    def request(self, peer, command, payload=''):
+        # Send a request and wait for its response; returns its payload and
+        # whether it was OK
+        seen = len(peer.responses(command))
+        peer.send(command, payload)
+        self.wait(lambda: len(peer.responses(command)) > seen)
+        for c, status, text in reversed(peer.frames):
+            if c == command.value:
+                return text, status == ResponseCodes.OK.value
+
+    def turn(self):
+        if not self.servers:
+            # Only servers in other processes to wait on
+            time.sleep(0.002)
+        for server in self.servers:
+            if server.running:
+                server.run_once(0.002)
+        for peer in self.peers:
+            peer.poll()
+
+    def wait(self, condition, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise AssertionError("Timed out waiting")
+            self.turn()
+
+    def settle(self, seconds=0.2):
+        # Let everything run for a while, when the point is that nothing happens
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self.turn()
+
+    def close(self):
+        for peer in self.peers:
+            peer.close()
+        for server in self.servers:
+            for sock in list(server.clientList):
+                sock.close()
+            if server.bus is not None:
+                for link in server.bus.links.values():
+                    link.sock.close()
+                # Federation links still being set up, and the link port
+                for pending in getattr(server.bus, 'dialing', {}).values():
+                    pending.sock.close()
+                listenSocket = getattr(server.bus, 'listenSocket', None)
+                if listenSocket is not None:
+                    listenSocket.close()
+            if server.journal is not None:
+                server.journal.file.close()
+            server.listenSocket.close()
+            server.selector.close()
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def start_server(port, script, *arguments):
+    # Run script (irc_server.py, or irc_async.py with 'server' in arguments)
+    # on port and wait until it takes connections
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    process = subprocess.Popen([sys.executable, path, '--port', str(port), '--log-level', 'ERROR'] + list(arguments))
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return process
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise
+            time.sleep(0.05)
+
+@pytest.fixture
+def processes():
+    processes = []
+    yield processes
+    for process in processes:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+@pytest.fixture
+def net():
+    net = Net()
+    yield net
+    net.close()
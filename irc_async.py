@@ -0,0 +1,281 @@
+# Miguel Delapaz - CS594 - IRC Server and Client on asyncio
+#
+# Same protocol and the same state handling as irc_server.Server and
+# irc_session.Session - only the I/O differs.  Each connection is an
+# asyncio.Protocol, so this runs on the stock event loop or on uvloop, and
+# AsyncServer.start() can be awaited from inside an existing async service.
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import sys
+import time
+
+import irc_client
+import irc_limits
+import irc_server
+import irc_session
+
+log = logging.getLogger('irc_async')
+
+def install_uvloop():
+    try:
+        import uvloop
+    except ImportError:
+        log.warning("uvloop is not installed - using the default asyncio event loop")
+        return False
+    uvloop.install()
+    return True
+
+class ServerConnection(asyncio.Protocol):
+    def __init__(self, server):
+        self.server = server
+        self.client = None
+
+    def connection_made(self, transport):
+        addr = transport.get_extra_info('peername')
+        log.debug("Received connection from client at %s", addr)
+        # The transport stands in for the socket everywhere Server uses client.sock
+        self.client = irc_server.Client(transport, addr)
+        self.server.clientList[transport] = self.client
+        self.server.start_client_timer(self.client)
+        transport.set_write_buffer_limits(high=self.server.highWater, low=self.server.lowWater)
+
+    def data_received(self, data):
+        self.server.process_received_data(self.client, data)
+
+    def pause_writing(self):
+        # The transport's own buffer is over the high watermark.  Further frames
+        # wait in client.outbound, where AsyncServer.queue_frame holds them to
+        # the same limits as Server does and drop-oldest can get at them.
+        # Under the pause policy the client stops being read straight away
+        self.server.writeBlocked.add(self.client)
+        if self.server.overflowPolicy == 'pause':
+            self.server.process_slow_consumer(self.client)
+
+    def resume_writing(self):
+        self.server.writeBlocked.discard(self.client)
+        self.server.flush_client(self.client)
+        if self.client.paused:
+            self.client.paused = False
+            self.server.resume_reading(self.client)
+
+    def connection_lost(self, exc):
+        self.server.writeBlocked.discard(self.client)
+        if self.client.sock in self.server.clientList:
+            if exc is None:
+                log.debug("Client at %s disconnected", self.client.addr)
+            else:
+                log.info("Client at %s encounterd an error", self.client.addr)
+            self.server.process_leave_server(self.client)
+
+class AsyncServer(irc_server.Server):
+    def __init__(self, port=6000, host='0.0.0.0', backlog=socket.SOMAXCONN, reusePort=False, tlsContext=None, **options):
+        irc_server.Server.__init__(self, port, backlog=backlog, reusePort=reusePort, **options)
+        # asyncio owns the sockets, we never poll this ourselves
+        self.selector.close()
+        self.selector = None
+        self.host = host
+        self.asyncServer = None
+        # Clients whose transport has paused writing - see ServerConnection
+        self.writeBlocked = set()
+        # asyncio does the TLS handshakes itself when given a context
+        self.tlsContext = tlsContext
+
+    def initialize_listen_socket(self):
+        # The listening socket is created by start()
+        self.listenSocket = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.asyncServer = await loop.create_server(lambda: ServerConnection(self), self.host, self.port,
+                                                    backlog=self.backlog, reuse_address=True, ssl=self.tlsContext,
+                                                    reuse_port=self.reusePort or None)
+        self.port = self.asyncServer.sockets[0].getsockname()[1]
+        log.info("Server listening socket created on port %d", self.port)
+        loop.call_later(self.timers.resolution, self.process_timers)
+        return self.asyncServer
+
+    def process_timers(self):
+        # The wheel is driven by a fixed tick here rather than by select
+        # timeouts.  self.now (and so client.lastActive) is only as fresh as
+        # the last tick, which is plenty for timeouts in seconds
+        self.now = time.monotonic()
+        self.timers.advance(self.now)
+        asyncio.get_running_loop().call_later(self.timers.resolution, self.process_timers)
+
+    async def serve_forever(self):
+        if self.asyncServer is None:
+            await self.start()
+        async with self.asyncServer:
+            await self.asyncServer.serve_forever()
+
+    def queue_frame(self, client, data):
+        # Frames queued while handling one read are handed to the transport
+        # together once the handler is done, so they go out in one write
+        outbound = client.outbound
+        if outbound is None:
+            outbound = client.outbound = irc_server.OutputBuffer()
+        if outbound.append(data):
+            asyncio.get_running_loop().call_soon(self.flush_client, client)
+        elif outbound.backlog() > self.highWater and client in self.writeBlocked:
+            # Nothing leaves outbound until the transport drains, so this is
+            # all backlog.  process_slow_consumer applies the overflow policy
+            # and the hard limit
+            self.process_slow_consumer(client)
+
+    def flush_client(self, client):
+        if client.outbound and client not in self.writeBlocked:
+            client.sock.writelines(client.outbound.take())
+            client.outbound = None
+
+    def pause_reading(self, client):
+        client.sock.pause_reading()
+
+    def resume_reading(self, client):
+        # Reads may be stopped for backpressure and a rate limit at once
+        if not client.paused and client.held is None:
+            client.sock.resume_reading()
+
+    def schedule_close(self, client):
+        if not self.closeList:
+            asyncio.get_running_loop().call_soon(self.process_close_list)
+        irc_server.Server.schedule_close(self, client)
+
+    def close_client(self, client):
+        del self.clientList[client.sock]
+        self.flush_client(client)
+        client.sock.close()
+
+    def run(self):
+        asyncio.run(self.serve_forever())
+
+class ClientConnection(asyncio.Protocol):
+    def __init__(self, session):
+        self.session = session
+
+    def data_received(self, data):
+        self.session.process_received_data(data)
+
+    def connection_lost(self, exc):
+        self.session.process_disconnect("Server disconnected")
+
+class AsyncSession(irc_session.Session):
+    # The transport stands in for the socket everywhere Session uses sock
+    def connect(self, addr, port, timeout=None):
+        # Frames sent before the connection is up (the LOGIN) wait in
+        # outbound and are written as soon as it is
+        self.reset(addr, port)
+        asyncio.ensure_future(self.open_connection(timeout))
+
+    async def open_connection(self, timeout):
+        loop = asyncio.get_running_loop()
+        try:
+            transport, protocol = await asyncio.wait_for(
+                loop.create_connection(lambda: ClientConnection(self), self.addr, self.port,
+                                       ssl=self.tlsContext, server_hostname=self.addr if self.tlsContext else None),
+                timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.outbound.take()
+            self.deliver(irc_session.Event(None, None, "Could not connect to " + self.addr + ": " + str(e),
+                                           None, None, None))
+            return
+        self.sock = transport
+        self.flush_outgoing_data()
+
+    def close(self):
+        # asyncio can't offer an earlier TLS session for resumption, so
+        # there is nothing to keep
+        transport = self.sock
+        self.sock = None
+        self.LoggedIn = False
+        if transport is not None:
+            transport.close()
+
+    def request_flush(self):
+        # Written on the next pass of the loop, so a burst of requests goes
+        # out together
+        if self.sock is not None:
+            asyncio.get_running_loop().call_soon(self.flush_outgoing_data)
+
+    def flush_outgoing_data(self):
+        # The transport buffers whatever the socket won't take
+        if self.sock is not None and self.outbound:
+            self.sock.writelines(self.outbound.take())
+        return 0
+
+class AsyncClient(irc_client.Client):
+    sessionClass = AsyncSession
+
+    def process_quit(self):
+        print("Quitting...")
+        self.quit.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.quit = asyncio.Event()
+        try:
+            # Wake up when input is ready rather than polling the keyboard
+            loop.add_reader(sys.stdin, self.process_keyboard_input)
+            readerAdded = True
+        except (NotImplementedError, ValueError, OSError):
+            # Windows proactor loop - read lines on a helper thread instead
+            readerAdded = False
+            asyncio.ensure_future(self.read_keyboard_thread())
+        if readerAdded:
+            blocking = os.get_blocking(sys.stdin.fileno())
+            os.set_blocking(sys.stdin.fileno(), False)
+        try:
+            await self.quit.wait()
+        finally:
+            if readerAdded:
+                loop.remove_reader(sys.stdin)
+                os.set_blocking(sys.stdin.fileno(), blocking)
+            self.session.close()
+
+    async def read_keyboard_thread(self):
+        loop = asyncio.get_running_loop()
+        while not self.quit.is_set():
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if not line:
+                self.process_quit()
+                return
+            if line.strip() != '':
+                self.process_user_input(line.strip())
+
+# Start of main program - 'server' or 'client'
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CS594 IRC Server and Client on asyncio")
+    parser.add_argument('mode', choices=['server', 'client'])
+    parser.add_argument('--port', type=int, default=6000, help="port to listen on (server)")
+    parser.add_argument('--uvloop', action='store_true', help="run on uvloop if it is installed")
+    parser.add_argument('--binary', action='store_true', help="use the binary framing (client)")
+    parser.add_argument('--compress', action='store_true',
+                        help="ask for compressed frames, implies --binary (client)")
+    parser.add_argument('--tls-cert', metavar='PATH', help="speak TLS with this certificate chain (server)")
+    parser.add_argument('--tls-key', metavar='PATH', help="private key for --tls-cert (server)")
+    irc_client.add_tls_arguments(parser)
+    irc_limits.add_rate_limit_arguments(parser)
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="DEBUG logs every connect and disconnect")
+    args = parser.parse_args()
+    try:
+        rateLimits = irc_limits.make_rate_limits(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    import irc_metrics
+    irc_metrics.setup_logging(args.log_level)
+
+    if args.uvloop:
+        install_uvloop()
+
+    if args.mode == 'server':
+        tlsContext = None
+        if args.tls_cert:
+            import irc_tls
+            tlsContext = irc_tls.make_server_context(args.tls_cert, args.tls_key)
+        AsyncServer(args.port, tlsContext=tlsContext, rateLimits=rateLimits, floodPolicy=args.flood_policy).run()
+    else:
+        asyncio.run(AsyncClient(args.binary, args.compress, irc_client.make_tls_context(args)).run())
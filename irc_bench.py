@@ -0,0 +1,699 @@
+# Miguel Delapaz - CS594 - IRC Server Benchmarks
+import argparse
+import os
+import random
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import irc_limits
+import irc_server
+import irc_session
+from irc_protocol import Command, ResponseCodes, OutputBuffer, encode_frame, encode_binary_frame, make_decoder, compress_payload, decompress_payload, RECV_SIZE, FRAMING_BINARY, FRAMING_COMPRESSED, FRAMING_LEGACY
+
+# connect() opens this many connections at a time, and never has more than
+# twice this many without a login response - under the usual listen backlog
+# of 128
+CONNECT_WINDOW = 64
+
+def raise_fd_limit():
+    # Benchmarks with tens of thousands of sockets need more than the usual
+    # soft limit of 1024 descriptors.  Returns the limit we ended up with
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        target = hard if hard != resource.RLIM_INFINITY else 1 << 20
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft
+
+def make_idle_fds(count):
+    # An eventfd is the cheapest thing that looks like an idle connection to
+    # the poller: one descriptor that never becomes readable
+    if hasattr(os, 'eventfd'):
+        return [os.eventfd(0) for i in range(count)]
+    fds = []
+    for i in range(count):
+        r, w = os.pipe()
+        fds.append(r)
+        fds.append(w)
+    return fds[::2]
+
+def bench_wakeup(args):
+    # Wakeup cost with one active connection and N idle ones.  With select()
+    # this grows with N; with epoll it should stay flat
+    limit = raise_fd_limit()
+    print("%-8s %8s %14s" % ("backend", "idle", "usec/wakeup"))
+    for backend in args.backends:
+        for count in args.sizes:
+            # One descriptor per idle connection plus some headroom
+            if count + 64 > limit:
+                print("%-8s %8d %14s" % (backend, count, "skipped (fd limit " + str(limit) + ")"))
+                continue
+            if backend == 'select' and count + 16 > 1024:
+                print("%-8s %8d %14s" % (backend, count, "skipped (FD_SETSIZE)"))
+                continue
+
+            selector = irc_server.make_selector(backend)
+            idle = make_idle_fds(count)
+            for fd in idle:
+                selector.register(fd, selectors.EVENT_READ)
+            active, peer = socket.socketpair()
+            selector.register(active, selectors.EVENT_READ)
+
+            start = time.perf_counter()
+            for i in range(args.iterations):
+                peer.send(b'x')
+                selector.select()
+                active.recv(1)
+            elapsed = time.perf_counter() - start
+            print("%-8s %8d %14.2f" % (backend, count, elapsed / args.iterations * 1e6))
+
+            selector.close()
+            active.close()
+            peer.close()
+            for fd in idle:
+                os.close(fd)
+
+def bench_fanout(args):
+    # Cost of delivering one MESSAGE to every member of a channel, comparing
+    # per-member encoding (send_response in a loop) against broadcast()
+    raise_fd_limit()
+    server = irc_server.Server(0)
+    print("%8s %18s %18s %8s" % ("members", "per-member usec", "broadcast usec", "speedup"))
+    for count in args.sizes:
+        channel = irc_server.Channel('bench')
+        for i in range(count):
+            # Only our end of the pair is needed - nothing is ever flushed
+            ours, theirs = socket.socketpair()
+            theirs.close()
+            ours.setblocking(False)
+            client = irc_server.Client(ours, ('bench', i))
+            client.name = 'user' + str(i)
+            client.LoggedIn = True
+            if args.compress:
+                client.framing = FRAMING_COMPRESSED
+            server.clientList[ours] = client
+            server.selector.register(ours, selectors.EVENT_READ, client)
+            channel.users.add(client)
+        sender = client
+        response = 'bench\n' + sender.name + '\n' + args.message
+
+        def per_member():
+            for c in channel.users:
+                server.send_response(c, irc_server.Command.MESSAGE, irc_server.ResponseCodes.OK, response)
+
+        def shared():
+            server.broadcast(channel.users, irc_server.Command.MESSAGE, irc_server.ResponseCodes.OK, response)
+
+        results = []
+        for fn in (per_member, shared):
+            best = None
+            for r in range(args.rounds):
+                start = time.perf_counter()
+                fn()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None or elapsed < best else best
+                # Start the next round from empty output buffers
+                for c in channel.users:
+                    c.outbound = None
+                server.dirtyClients.clear()
+            results.append(best)
+        print("%8d %18.1f %18.1f %7.1fx" % (count, results[0] * 1e6, results[1] * 1e6, results[0] / results[1]))
+
+        for c in channel.users:
+            server.selector.unregister(c.sock)
+            del server.clientList[c.sock]
+            c.sock.close()
+
+# Words for made up chat messages
+CHAT_WORDS = ("I think the build is broken again does anyone know why it fails on my machine "
+              "but works for you it was fine yesterday maybe someone changed something in the "
+              "config lol thanks that fixed it sorry about the noise what time is the meeting "
+              "tomorrow morning I can't make it today").split()
+
+def chat_text(size, rng):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(CHAT_WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:size].encode('utf-8')
+
+def best_time(fn, rounds):
+    best = None
+    for r in range(rounds):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None or elapsed < best else best
+    return best
+
+def bench_compression(args):
+    # What compression buys on chat text of various sizes, with and without
+    # the preset dictionary, and what it costs per message
+    rng = random.Random(1)
+    print("%8s %10s %10s %10s %14s %14s" % ("bytes", "no dict", "with dict", "ratio", "compress usec", "expand usec"))
+    for size in args.sizes:
+        payload = ('general\nuser1\n').encode('utf-8') + chat_text(size, rng)
+        plain = zlib.compressobj(6, zlib.DEFLATED, -15)
+        plain = len(plain.compress(payload) + plain.flush())
+        compressed = compress_payload(payload)
+        compressTime = best_time(lambda: compress_payload(payload), args.rounds)
+        expandTime = best_time(lambda: decompress_payload(compressed), args.rounds)
+        print("%8d %10d %10d %9.2fx %14.1f %14.1f" % (len(payload), plain, len(compressed),
+                                                   len(payload) / float(len(compressed)),
+                                                   compressTime * 1e6, expandTime * 1e6))
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return float('nan')
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def start_local_server(extraArgs):
+    # Run the server in its own process so it doesn't share a GIL with the
+    # load generator.  Returns the process and the port it listens on
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'irc_server.py')
+    proc = subprocess.Popen([sys.executable, script, '--port', str(port)] + extraArgs,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc, port
+        except OSError:
+            if time.time() > deadline or proc.poll() is not None:
+                proc.kill()
+                raise SystemExit("Local server did not start")
+            time.sleep(0.05)
+
+class LoadClient:
+    def __init__(self, index, sock, framing):
+        self.index = index
+        self.name = 'b' + str(index)
+        self.sock = sock
+        self.framing = framing
+        self.decoder = make_decoder(framing)
+        self.outbound = OutputBuffer()
+        self.channels = []
+
+class LoadGenerator:
+    # Many simulated users driven from one selector loop.  Senders put the
+    # send time in every MESSAGE; when a copy comes back to any member the
+    # difference is the fan-out latency.  Everything is in this one process
+    # so perf_counter_ns on both ends is the same clock
+    def __init__(self, addr, args):
+        self.addr = addr
+        self.args = args
+        self.framing = FRAMING_BINARY if args.binary else FRAMING_LEGACY
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.responses = {}
+        self.errors = 0
+        self.latencies = []
+        self.delivered = 0
+        self.padding = 'x' * max(0, args.message_size - 20)
+
+    def send(self, client, command, data):
+        if self.framing == FRAMING_BINARY:
+            frame = encode_binary_frame(command, 0, data)
+        else:
+            frame = encode_frame(command, data)
+        if client.outbound.append(frame):
+            self.selector.modify(client.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+
+    def process_frame(self, client, command, status, payload):
+        if command == Command.PING.value:
+            self.send(client, Command.PONG, None)
+            return
+        if status is None:
+            status = payload[0] - 0x30
+            payload = payload[1:]
+        if status != ResponseCodes.OK.value:
+            self.errors += 1
+            return
+        if command == Command.MESSAGE.value:
+            # channel \n sender \n sendtime padding
+            stamp = payload.split(b'\n', 2)[2].split(b' ', 1)[0]
+            self.latencies.append(time.perf_counter_ns() - int(stamp))
+            self.delivered += 1
+        else:
+            self.responses[command] = self.responses.get(command, 0) + 1
+
+    def poll(self, timeout):
+        for key, events in self.selector.select(timeout):
+            client = key.data
+            if events & selectors.EVENT_READ:
+                try:
+                    data = client.sock.recv(RECV_SIZE)
+                except (BlockingIOError, InterruptedError):
+                    data = None
+                if data == b'':
+                    raise SystemExit("Server closed connection for " + client.name)
+                if data:
+                    for command, status, flags, payload in client.decoder.feed(data):
+                        self.process_frame(client, command, status, payload)
+            if events & selectors.EVENT_WRITE:
+                if not client.outbound.flush(client.sock):
+                    self.selector.modify(client.sock, selectors.EVENT_READ, client)
+
+    def wait_for(self, command, count, what):
+        deadline = time.perf_counter() + self.args.timeout
+        while self.responses.get(command.value, 0) < count:
+            if time.perf_counter() > deadline:
+                raise SystemExit("Timed out waiting for " + what + " (" + str(self.responses.get(command.value, 0)) +
+                                 "/" + str(count) + ", " + str(self.errors) + " errors)")
+            self.poll(0.05)
+
+    def connect(self):
+        args = self.args
+        start = time.perf_counter()
+        for i in range(args.clients):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            sock.connect_ex(self.addr)
+            client = LoadClient(i, sock, self.framing)
+            self.clients.append(client)
+            self.selector.register(sock, selectors.EVENT_READ, client)
+            self.send(client, Command.LOGIN, client.name)
+            if i % CONNECT_WINDOW == CONNECT_WINDOW - 1:
+                # Don't get further ahead of the server's accepts than its
+                # listen backlog can hold, or the kernel drops our SYNs and
+                # the connect time includes the retransmit timeout
+                self.wait_for(Command.LOGIN, i + 1 - CONNECT_WINDOW, "logins")
+        self.wait_for(Command.LOGIN, args.clients, "logins")
+        return time.perf_counter() - start
+
+    def setup_channels(self):
+        # Channel i is created by client i, then every client joins
+        # args.joins channels spread evenly over the topology
+        args = self.args
+        channels = ['c' + str(i) for i in range(args.channels)]
+        for i, name in enumerate(channels):
+            owner = self.clients[i % len(self.clients)]
+            owner.channels.append(name)
+            self.send(owner, Command.ADD_CHANNEL, name)
+        self.wait_for(Command.ADD_CHANNEL, len(channels), "channel creation")
+
+        joins = 0
+        for client in self.clients:
+            for j in range(args.joins):
+                name = channels[(client.index * args.joins + j) % len(channels)]
+                if name not in client.channels:
+                    client.channels.append(name)
+                    self.send(client, Command.JOIN_CHANNEL, name)
+                    joins += 1
+        # ADD_CHANNEL also answers with a JOIN_CHANNEL for the creator
+        self.wait_for(Command.JOIN_CHANNEL, joins + len(channels), "joins")
+
+    def run_traffic(self):
+        args = self.args
+        senders = [c for c in self.clients if c.channels][:args.senders]
+        if not senders:
+            raise SystemExit("No clients are in any channel")
+        sent = 0
+        start = time.perf_counter()
+        end = start + args.duration
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            # Send whatever we are behind by to keep the overall rate steady
+            due = int((now - start) * args.rate) - sent
+            for i in range(due):
+                client = senders[sent % len(senders)]
+                channel = client.channels[sent % len(client.channels)]
+                self.send(client, Command.MESSAGE, channel + '\n' + str(time.perf_counter_ns()) + ' ' + self.padding)
+                sent += 1
+            self.poll(0.001)
+        elapsed = time.perf_counter() - start
+
+        # Let the tail of the deliveries arrive
+        drain = time.perf_counter() + args.drain
+        while time.perf_counter() < drain:
+            self.poll(0.01)
+        return sent, elapsed
+
+    def close(self):
+        for client in self.clients:
+            self.selector.unregister(client.sock)
+            client.sock.close()
+        self.selector.close()
+
+def open_target(args):
+    # The server named by --connect, or a local one we started.  Returns the
+    # local server process (or None) and the address to connect to
+    if args.connect:
+        host, port = args.connect.rsplit(':', 1)
+        return None, (host, int(port))
+    proc, port = start_local_server(args.server_args.split())
+    return proc, ('127.0.0.1', port)
+
+def bench_load(args):
+    raise_fd_limit()
+    limitedRate = irc_limits.DEFAULT_LIMITS['MESSAGE'][0]
+    if args.senders and args.rate / args.senders > limitedRate and \
+            (args.connect or '--no-rate-limit' not in args.server_args.split()):
+        # Anything over the limit sits in the server's flood delay, and the
+        # latencies below measure that rather than the fan-out
+        print("warning: %.0f messages/sec per sender is over the server's default MESSAGE limit of %d/sec"
+              % (args.rate / args.senders, limitedRate), file=sys.stderr)
+    proc, addr = open_target(args)
+    generator = LoadGenerator(addr, args)
+    try:
+        connectTime = generator.connect()
+        generator.setup_channels()
+        sent, elapsed = generator.run_traffic()
+    finally:
+        generator.close()
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    latencies = sorted(generator.latencies)
+    print("clients           %d" % args.clients)
+    print("channels          %d (%d joins per client)" % (args.channels, args.joins))
+    print("connect+login     %.0f clients/sec" % (args.clients / connectTime))
+    print("messages sent     %d (%.0f/sec)" % (sent, sent / elapsed))
+    print("deliveries        %d (%.0f/sec)" % (generator.delivered, generator.delivered / elapsed))
+    print("errors            %d" % generator.errors)
+    print("fan-out latency   p50 %.3f ms  p99 %.3f ms  p999 %.3f ms  max %.3f ms" % (
+        percentile(latencies, 0.5) / 1e6, percentile(latencies, 0.99) / 1e6,
+        percentile(latencies, 0.999) / 1e6, (latencies[-1] if latencies else float('nan')) / 1e6))
+
+def bench_pipeline(args):
+    # Request throughput when every client has args.depth requests in flight
+    # at once.  LIST_USERS on a small channel keeps the work per request small
+    # so this mostly measures dispatch and the per-wakeup overhead
+    raise_fd_limit()
+    proc, addr = open_target(args)
+    generator = LoadGenerator(addr, args)
+    try:
+        generator.connect()
+        generator.setup_channels()
+        requests = 0
+        start = time.perf_counter()
+        end = start + args.duration
+        while time.perf_counter() < end:
+            for client in generator.clients:
+                for i in range(args.depth):
+                    generator.send(client, Command.LIST_USERS, client.channels[0])
+            requests += len(generator.clients) * args.depth
+            generator.wait_for(Command.LIST_USERS, requests, "responses")
+        elapsed = time.perf_counter() - start
+    finally:
+        generator.close()
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    print("clients           %d (%d requests in flight each)" % (args.clients, args.depth))
+    print("requests          %d (%.0f/sec)" % (requests, requests / elapsed))
+    print("errors            %d" % generator.errors)
+
+def process_rss(pid):
+    # Resident set size in bytes, from /proc - Linux only
+    try:
+        with open('/proc/' + str(pid) + '/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    raise SystemExit("Can't read the memory use of pid " + str(pid))
+
+def unslotted(cls):
+    # A copy of cls without __slots__, for the memory comparison.  A plain
+    # subclass wouldn't do: the slots it inherits still hold every attribute
+    # and the instance __dict__ would stay empty
+    namespace = dict((k, v) for k, v in vars(cls).items()
+                     if k not in cls.__slots__ and k not in ('__slots__', '__dict__', '__weakref__'))
+    return type(cls.__name__, (object,), namespace)
+
+def run_memory_server(port, slots):
+    # Child process for bench_memory --compare-slots.  Rate limits off, as
+    # in the usual --server-args
+    if not slots:
+        irc_server.Channel = unslotted(irc_server.Channel)
+    server = irc_server.Server(port, rateLimits=None)
+    if not slots:
+        server.clientClass = unslotted(irc_server.Client)
+    server.run()
+
+def start_memory_server(slots):
+    # Like start_local_server, but forked from here so the server classes
+    # can be swapped before it starts
+    import multiprocessing
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    proc = multiprocessing.get_context('fork').Process(target=run_memory_server, args=(port, slots))
+    proc.start()
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc, port
+        except OSError:
+            if time.time() > deadline or not proc.is_alive():
+                proc.kill()
+                raise SystemExit("Local server did not start")
+            time.sleep(0.05)
+
+def measure_memory(args, proc, port):
+    # Server RSS before and after args.clients log in (and join channels,
+    # if asked) - always a server we started, since we need to look at the process
+    generator = LoadGenerator(('127.0.0.1', port), args)
+    try:
+        before = process_rss(proc.pid)
+        generator.connect()
+        if args.channels:
+            generator.setup_channels()
+        # Every response has been seen, so the server is idle again
+        time.sleep(args.settle)
+        after = process_rss(proc.pid)
+    finally:
+        generator.close()
+        proc.terminate()
+        if hasattr(proc, 'join'):
+            proc.join()
+        else:
+            proc.wait()
+    return before, after
+
+def bench_memory(args):
+    # Server memory per idle, logged in client
+    raise_fd_limit()
+    if not args.compare_slots:
+        proc, port = start_local_server(args.server_args.split())
+        before, after = measure_memory(args, proc, port)
+        print("clients           %d (%d channels)" % (args.clients, args.channels))
+        print("server RSS        %.1f MiB before, %.1f MiB after" % (before / 1048576.0, after / 1048576.0))
+        print("per client        %.0f bytes" % ((after - before) / float(args.clients)))
+        return
+
+    # The same run against a server whose Client and Channel have __slots__
+    # and one where they don't.  Both are forked before either run, so
+    # neither starts with the heap the other run left behind in this process
+    servers = [(slots, start_memory_server(slots)) for slots in (True, False)]
+    print("clients           %d (%d channels)" % (args.clients, args.channels))
+    perClient = {}
+    for slots, (proc, port) in servers:
+        before, after = measure_memory(args, proc, port)
+        label = 'slotted' if slots else 'unslotted'
+        perClient[label] = (after - before) / float(args.clients)
+        print("%-17s %.1f MiB before, %.1f MiB after, %.0f bytes per client"
+              % (label, before / 1048576.0, after / 1048576.0, perClient[label]))
+    # RSS moves with the allocator, so give the objects' own sizes as well
+    sizes = {}
+    for label, clientClass, channelClass in (('slotted', irc_server.Client, irc_server.Channel),
+                                             ('unslotted', unslotted(irc_server.Client),
+                                              unslotted(irc_server.Channel))):
+        objects = (clientClass(None, None), channelClass('bench'))
+        sizes[label] = [sys.getsizeof(o) + (sys.getsizeof(vars(o)) if hasattr(o, '__dict__') else 0)
+                        for o in objects]
+    print("object bytes      Client %d slotted, %d unslotted; Channel %d slotted, %d unslotted"
+          % (sizes['slotted'][0], sizes['unslotted'][0], sizes['slotted'][1], sizes['unslotted'][1]))
+    saved = perClient['unslotted'] - perClient['slotted']
+    print("slots save        %.0f bytes per client (%.1f%%)"
+          % (saved, 100.0 * saved / perClient['unslotted'] if perClient['unslotted'] else 0.0))
+
+def make_test_certificate(directory):
+    # Self-signed certificate for localhost, made with the openssl command
+    certFile = os.path.join(directory, 'cert.pem')
+    keyFile = os.path.join(directory, 'key.pem')
+    try:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                        '-nodes', '-keyout', keyFile, '-out', certFile, '-days', '1', '-subj', '/CN=localhost',
+                        '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1'],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        raise SystemExit("Could not make a certificate - pass --cert and --key, or put openssl on the PATH")
+    return certFile, keyFile
+
+def connect_rate(port, count, tlsContext, resume):
+    # Connect, log in and hang up, count times.  Returns connections per second
+    session = irc_session.Session(True, False, None, tlsContext)
+    start = time.perf_counter()
+    for i in range(count):
+        if not resume:
+            session.tlsSession = None
+        session.connect('127.0.0.1', port, 10)
+        session.login('h' + str(i))
+        if session.wait_for(Command.LOGIN, 10) is None:
+            raise SystemExit("No login response from the server")
+        session.close()
+    return count / (time.perf_counter() - start)
+
+def echo_throughput(port, count, size, tlsContext):
+    # One client alone in a channel sends count messages and reads back its
+    # own copies.  Returns messages per second
+    session = irc_session.Session(True, False, None, tlsContext)
+    session.connect('127.0.0.1', port, 10)
+    session.login('echo')
+    session.wait_for(Command.LOGIN, 10)
+    session.add_channel('bench')
+    session.wait_for(Command.JOIN_CHANNEL, 10)
+    received = [0]
+
+    def count_messages(event):
+        if event.command == Command.MESSAGE:
+            received[0] += 1
+    session.handler = count_messages
+
+    message = 'x' * size
+    start = time.perf_counter()
+    session.send_messages('bench', (message for i in range(count)))
+    while received[0] < count:
+        if not session.poll(10):
+            raise SystemExit("Only " + str(received[0]) + " of " + str(count) + " messages came back")
+    elapsed = time.perf_counter() - start
+    session.close()
+    return count / elapsed
+
+def bench_tls(args):
+    # Handshake rate (full and resumed) and message throughput over TLS,
+    # each against the same thing in plain TCP
+    import irc_tls
+    directory = None
+    certFile, keyFile = args.cert, args.key
+    if certFile is None:
+        directory = tempfile.TemporaryDirectory()
+        certFile, keyFile = make_test_certificate(directory.name)
+    serverArgs = args.server_args.split()
+    plain, plainPort = start_local_server(serverArgs)
+    tls, tlsPort = start_local_server(serverArgs + ['--tls-cert', certFile] + (['--tls-key', keyFile] if keyFile else []))
+    tlsContext = irc_tls.make_client_context(certFile)
+    try:
+        plainConnects = connect_rate(plainPort, args.connections, None, False)
+        fullConnects = connect_rate(tlsPort, args.connections, tlsContext, False)
+        resumedConnects = connect_rate(tlsPort, args.connections, tlsContext, True)
+        plainRate = echo_throughput(plainPort, args.messages, args.message_size, None)
+        tlsRate = echo_throughput(tlsPort, args.messages, args.message_size, tlsContext)
+    finally:
+        for proc in (plain, tls):
+            proc.terminate()
+            proc.wait()
+        if directory is not None:
+            directory.cleanup()
+
+    print("connect+login     plain %.0f/sec  TLS full handshake %.0f/sec  TLS resumed %.0f/sec" % (
+        plainConnects, fullConnects, resumedConnects))
+    print("echo throughput   plain %.0f msgs/sec  TLS %.0f msgs/sec (%d byte messages, TLS at %.2fx plain)" % (
+        plainRate, tlsRate, args.message_size, tlsRate / plainRate))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CS594 IRC Server benchmarks")
+    commands = parser.add_subparsers(dest='benchmark', required=True)
+
+    wakeup = commands.add_parser('wakeup', help="event loop wakeup cost against idle connections")
+    wakeup.add_argument('--backends', nargs='+', default=['select', 'default'],
+                        choices=sorted(irc_server.SELECTOR_BACKENDS))
+    wakeup.add_argument('--sizes', nargs='+', type=int, default=[100, 1000, 10000, 50000])
+    wakeup.add_argument('--iterations', type=int, default=2000)
+    wakeup.set_defaults(func=bench_wakeup)
+
+    fanout = commands.add_parser('fanout', help="channel broadcast cost per message")
+    fanout.add_argument('--sizes', nargs='+', type=int, default=[10, 1000, 10000])
+    fanout.add_argument('--rounds', type=int, default=20)
+    fanout.add_argument('--message', default='The quick brown fox jumps over the lazy dog')
+    fanout.add_argument('--compress', action='store_true', help="members negotiated compression")
+    fanout.set_defaults(func=bench_fanout)
+
+    compression = commands.add_parser('compression', help="compressed size and cost for chat messages")
+    compression.add_argument('--sizes', nargs='+', type=int, default=[64, 256, 1024, 4096, 65536])
+    compression.add_argument('--rounds', type=int, default=200)
+    compression.set_defaults(func=bench_compression)
+
+    load = commands.add_parser('load', help="simulated users against a server - throughput and fan-out latency")
+    load.add_argument('--connect', metavar='HOST:PORT',
+                      help="server to test (default: start a local irc_server.py)")
+    load.add_argument('--server-args', default='--no-rate-limit',
+                      help="arguments for the local server (default: rate limits off, so the latencies "
+                           "aren't the flood delay)")
+    load.add_argument('--clients', type=int, default=1000)
+    load.add_argument('--channels', type=int, default=10)
+    load.add_argument('--joins', type=int, default=1, help="channels each client joins")
+    load.add_argument('--senders', type=int, default=100, help="clients that send messages")
+    load.add_argument('--rate', type=float, default=1000, help="messages per second across all senders")
+    load.add_argument('--duration', type=float, default=10)
+    load.add_argument('--drain', type=float, default=1, help="seconds to wait for deliveries at the end")
+    load.add_argument('--message-size', type=int, default=64)
+    load.add_argument('--binary', action='store_true', help="use the binary framing")
+    load.add_argument('--timeout', type=float, default=60, help="setup phase timeout")
+    load.set_defaults(func=bench_load)
+
+    pipeline = commands.add_parser('pipeline', help="request throughput with many requests in flight per client")
+    pipeline.add_argument('--connect', metavar='HOST:PORT',
+                          help="server to test (default: start a local irc_server.py)")
+    pipeline.add_argument('--server-args', default='--no-rate-limit',
+                          help="arguments for the local server (default: rate limits off, since this "
+                               "floods the server on purpose)")
+    pipeline.add_argument('--clients', type=int, default=100)
+    pipeline.add_argument('--channels', type=int, default=10)
+    pipeline.add_argument('--depth', type=int, default=32, help="requests each client sends before waiting")
+    pipeline.add_argument('--duration', type=float, default=5)
+    pipeline.add_argument('--binary', action='store_true', help="use the binary framing")
+    pipeline.add_argument('--timeout', type=float, default=60, help="setup phase timeout")
+    pipeline.set_defaults(func=bench_pipeline, joins=1, message_size=0)
+
+    memory = commands.add_parser('memory', help="server RSS per idle logged in client")
+    memory.add_argument('--server-args', default='--no-rate-limit',
+                        help="arguments for the local server (default: rate limits off, so the logins "
+                             "aren't held back)")
+    memory.add_argument('--clients', type=int, default=10000)
+    memory.add_argument('--settle', type=float, default=1, help="seconds to wait before measuring")
+    memory.add_argument('--binary', action='store_true', help="use the binary framing")
+    memory.add_argument('--timeout', type=float, default=60, help="login timeout")
+    memory.add_argument('--channels', type=int, default=0, help="channels for the clients to join")
+    memory.add_argument('--joins', type=int, default=1, help="channels each client joins")
+    memory.add_argument('--compare-slots', action='store_true',
+                        help="measure a server with slotted Client and Channel classes against one "
+                             "without (--server-args is ignored; both run with rate limits off)")
+    memory.set_defaults(func=bench_memory, message_size=0)
+
+    tls = commands.add_parser('tls', help="TLS handshake rate and throughput overhead against plain TCP")
+    tls.add_argument('--cert', help="certificate for the local servers (default: make a self-signed one with openssl)")
+    tls.add_argument('--key', help="private key for --cert, if it isn't in the same file")
+    tls.add_argument('--server-args', default='--no-rate-limit',
+                     help="arguments for both local servers (default: rate limits off)")
+    tls.add_argument('--connections', type=int, default=500, help="connections per handshake test")
+    tls.add_argument('--messages', type=int, default=50000)
+    tls.add_argument('--message-size', type=int, default=64)
+    tls.set_defaults(func=bench_tls)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,110 +1,82 @@
 # Miguel Delapaz - CS594 - IRC Client Project
-import socket
+#
+# Console client - keyboard commands in, printed responses out.  The
+# protocol itself is irc_session.Session, which bots and services can use
+# without any of this
+import argparse
+import codecs
+import os
 import select
 import sys
-import msvcrt
-from enum import Enum
 try:
-    import queue
+    import msvcrt
 except ImportError:
-    import Queue as queue
-
-class Command(Enum):
-    LOGIN = 1
-    LOGOUT = 2
-    ADD_CHANNEL = 3
-    JOIN_CHANNEL = 4
-    LEAVE_CHANNEL = 5
-    LIST_ROOMS = 6
-    LIST_USERS = 7
-    MESSAGE = 8
-
-class ResponseCodes(Enum):
-    OK = 0
-    ERROR = 4
+    # Not on Windows - keyboard input is read from stdin with select instead
+    msvcrt = None
+from irc_protocol import Command, ResponseCodes, ProtocolError, MAX_CHANNELS_PER_REQUEST, FRAMING_LEGACY
+from irc_session import Session
 
 class Client:
-    def __init__(self):
-        self.addr = None
-        self.port = None
-        self.socket = None
-        self.username = None
-        self.LoggedIn = False
-        self.readList = []
-        self.writeList = []
-        self.outbound = queue.Queue()
-        self.keyboardInput = ''
-
-    def process_logout(self):
-        self.readList.remove(self.socket)
-        if self.socket in self.writeList:
-            self.writeList.remove(self.socket)
-        self.LoggedIn = False
+    sessionClass = Session
 
-    def process_login_response(self, response):
-        # Parse response into response code and message.  No message for success
-        responseCode = int(response[0])
-        errorMessage = response[1:]
+    def __init__(self, binary=False, compress=False, tlsContext=None):
+        self.session = self.sessionClass(binary, compress, self.process_event, tlsContext)
+        self.keyboardInput = ''
+        self.keyboardDecoder = codecs.getincrementaldecoder('utf-8')('replace')
 
-        if self.LoggedIn:
-            print("Received Login Response, but we're already logged in")
-        elif responseCode == ResponseCodes.ERROR:
+    def process_login_response(self, responseCode, errorMessage):
+        # No message for success
+        if responseCode == ResponseCodes.ERROR:
             print("Login Failure: " + errorMessage)
         elif responseCode == ResponseCodes.OK:
-            self.LoggedIn = True
-            print("Logged in to server " + self.addr + " as " + self.username)
+            print("Logged in to server " + self.session.addr + " as " + self.session.username)
         else:
             print("Login Response with Unexpected Code: " + str(responseCode))
 
-    def process_add_response(self, response):
-        # Parse response into response code and message.  Message is channel name on success
-        responseCode = int(response[0])
-        message = response[1:]
-
+    def process_add_response(self, responseCode, message):
+        # Message is channel name on success
         if responseCode == ResponseCodes.ERROR:
             print("Add Channel Failure: " + message)
         else:
             print("Successfully Added Channel: " + message)
 
-    def process_join_response(self, response):
-        # Parse response into response code and message.  Message is channel name on success
-        responseCode = int(response[0])
-        message = response[1:]
-
+    def process_join_response(self, responseCode, message):
+        # Message is channel name on success
         if responseCode == ResponseCodes.ERROR:
             print("Join Channel Failure: " + message)
         else:
             print("Successfully Joined Channel: " + message)
 
-    def process_leave_response(self, response):
-        # Parse response into response code and message.  Message is channel name on success
-        responseCode = int(response[0])
-        message = response[1:]
-
+    def process_leave_response(self, responseCode, message):
+        # Message is channel name on success
         if responseCode == ResponseCodes.ERROR:
             print("Leave Channel Failure: " + message)
         else:
             print("Successfully Left Channel: " + message)
 
-    def process_list_rooms_response(self, response):
-        # Parse response into response code and message.  Message is list of rooms on success
-        responseCode = int(response[0])
-        message = response[1:]
+    def process_many_response(self, event, done, action):
+        # A line per channel asked for
+        for channel, error in event.results():
+            if error is None:
+                print("Successfully " + done + " Channel: " + channel)
+            else:
+                print(action + " Channel Failure: " + error)
 
+    def process_list_rooms_response(self, responseCode, message):
+        # Message is list of rooms on success
         if responseCode == ResponseCodes.ERROR:
             print("Error listing server rooms: " + message)
         else:
             rooms = message.splitlines()
             print("Available Rooms:")
             for r in rooms:
-                print(">> " + r)
+                if r.startswith('+'):
+                    print("(more - ask again with offset " + r[1:] + ")")
+                else:
+                    print(">> " + r)
 
-    def process_list_users_response(self, response):
-        # Parse response into response code and message.
+    def process_list_users_response(self, responseCode, message):
         # Message is channel name and list of users on success
-        responseCode = int(response[0])
-        message = response[1:]
-
         if responseCode == ResponseCodes.ERROR:
             print("List Users Failure: " + message)
         else:
@@ -112,138 +84,134 @@ class Client:
             channel = users.pop(0)
             print("Users in channel " + channel + ":")
             for u in users:
-                print(">> " + u)
+                if u.startswith('+'):
+                    print("(more - ask again with offset " + u[1:] + ")")
+                else:
+                    print(">> " + u)
 
-    def process_incoming_message(self, response):
-        # Parse response into response code and message
+    def process_incoming_message(self, event):
         # if response is error, a message we sent failed
-        # if response is OK, message is channel name, sending user name and message
-        responseCode = int(response[0])
-        message = response[1:]
-
-        if responseCode == ResponseCodes.ERROR:
-            print("Send Message Failure: " + message)
+        # if response is OK, the event has the channel, sending user and message
+        if event.code == ResponseCodes.ERROR:
+            print("Send Message Failure: " + event.data)
         else:
-            channelName, clientName, userMessage = message.split(None, 2)
-            print("[" + channelName + "]>>>(" + clientName + ") " + userMessage)
-
-    def process_server_data(self):
-        try:
-            command = self.socket.recv(1)
-        except:
-            print("Connection encountered an error...Login again")
-            self.process_logout()
-            return
-
-        if not command:
-            # Server disconnected
-            print("Server disconnected")
-            self.process_logout()
-            return
-        else:
-            command = int(command)
-            try:
-                length = int(self.socket.recv(5))
-                data = self.socket.recv(length)
-            except:
-                print("Connection encountered an error...Login again")
-                self.process_logout()
-                return
-
-        if command == Command.LOGIN:
-            self.process_login_response(data)
+            print("[" + event.channel + "]>>>(" + event.user + ") " + event.text)
+
+    def process_event(self, event):
+        # Everything the session hears from the server
+        command = event.command
+        if command is None:
+            print(event.data + "...Login again")
+        elif command == Command.LOGIN:
+            self.process_login_response(event.code, event.data)
         elif command == Command.ADD_CHANNEL:
-            self.process_add_response(data)
+            self.process_add_response(event.code, event.data)
         elif command == Command.JOIN_CHANNEL:
-            self.process_join_response(data)
+            self.process_join_response(event.code, event.data)
         elif command == Command.LEAVE_CHANNEL:
-            self.process_leave_response(data)
+            self.process_leave_response(event.code, event.data)
+        elif command == Command.JOIN_MANY:
+            self.process_many_response(event, "Joined", "Join")
+        elif command == Command.LEAVE_MANY:
+            self.process_many_response(event, "Left", "Leave")
+        elif command == Command.MESSAGE_MANY:
+            self.process_incoming_message(event)
         elif command == Command.LIST_ROOMS:
-            self.process_list_rooms_response(data)
+            self.process_list_rooms_response(event.code, event.data)
         elif command == Command.LIST_USERS:
-            self.process_list_users_response(data)
+            self.process_list_users_response(event.code, event.data)
         elif command == Command.MESSAGE:
-            self.process_incoming_message(data)
-        else:
+            self.process_incoming_message(event)
+        elif command != Command.PONG:
             print("Unexpected command received from server: " + str(command))
 
+    def request(self, method, *args):
+        try:
+            method(*args)
+        except ProtocolError:
+            print("Message too long")
+
     def login(self, data):
-        if self.LoggedIn:
-            print("Already logged into server: " + self.addr)
+        if self.session.LoggedIn:
+            print("Already logged into server: " + self.session.addr)
         else:
-            if len(data.split()) < 3:
+            if not data or len(data.split()) < 3:
                 print("Missing arguments on /login command")
                 return
 
-            self.addr, port, self.username = data.split(None, 2)
+            addr, port, username = data.split(None, 2)
 
-            self.port = int(port)
-
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((self.addr, self.port))
-            self.socket = s
-            self.socket.setblocking(False)
-            self.readList = [self.socket]
-            self.writeList = []
+            try:
+                self.session.connect(addr, int(port))
+            except (OSError, ValueError) as e:
+                print("Could not connect to " + addr + ": " + str(e))
+                return
 
-            self.send_network_data(Command.LOGIN, self.username)
+            self.request(self.session.login, username)
 
     def logout(self):
-        self.send_network_data(Command.LOGOUT, None)
-        self.LoggedIn = False
-        self.sock.close()
+        self.session.logout()
         print("Disconnected from server")
 
     def add_channel(self, channelName):
         if not channelName:
             print("Missing arguments on /add command")
             return
-        self.send_network_data(Command.ADD_CHANNEL, channelName)
+        self.request(self.session.add_channel, channelName)
 
-    def join_channel(self, channelName):
-        if not channelName:
+    def join_channel(self, data):
+        # One or more channel names separated by spaces
+        if not data:
             print("Missing arguments on /join command")
             return
-        self.send_network_data(Command.JOIN_CHANNEL, channelName)
+        self.request_channels(data.split(), self.session.join_channel, self.session.join_channels)
 
-    def leave_channel(self, channelName):
-        if not channelName:
+    def leave_channel(self, data):
+        if not data:
             print("Missing arguments on /leave command")
             return
-        self.send_network_data(Command.LEAVE_CHANNEL, channelName)
+        self.request_channels(data.split(), self.session.leave_channel, self.session.leave_channels)
+
+    def request_channels(self, channelNames, single, many):
+        if len(channelNames) == 1:
+            self.request(single, channelNames[0])
+        elif self.session.framing == FRAMING_LEGACY:
+            # No multi-channel commands in the legacy framing - one request each
+            for channelName in channelNames:
+                self.request(single, channelName)
+        elif len(channelNames) > MAX_CHANNELS_PER_REQUEST:
+            print("At most " + str(MAX_CHANNELS_PER_REQUEST) + " channels at a time")
+        else:
+            self.request(many, channelNames)
 
-    def list_rooms(self):
-        self.send_network_data(Command.LIST_ROOMS, None)
+    def list_rooms(self, query=None):
+        # Optional query is prefix, offset and limit separated by spaces
+        self.request(self.session.list_rooms, *(query.split()[:3] if query else []))
 
-    def list_users(self, channelName):
-        if not channelName:
+    def list_users(self, data):
+        if not data:
             print("Missing arguments on /users command")
             return
-        self.send_network_data(Command.LIST_USERS, channelName)
+        fields = data.split()
+        self.request(self.session.list_users, fields[0], *fields[1:4])
 
     def send_message(self, input):
-        if len(input.split()) < 2:
+        if not input or len(input.split()) < 2:
             print("Missing arguments on /message")
             return
 
+        # Several channels are separated by commas - everyone in any of them
+        # gets the message once
         channel, message = input.split(None, 1)
-        self.send_network_data(Command.MESSAGE, channel + '\n' + message)
-
-    def send_network_data(self, code, data):
-        # Packet is one byte of command code, 5 bytes of length (string form)
-        # followed by the data
-        if data and len(data) >= 99999:
-            print("Message too long")
+        channelNames = [c for c in channel.split(',') if c]
+        if len(channelNames) < 2:
+            self.request(self.session.send_message, channel, message)
+        elif self.session.framing == FRAMING_LEGACY:
+            print("Sending to several channels needs the binary framing (--binary)")
+        elif len(channelNames) > MAX_CHANNELS_PER_REQUEST:
+            print("At most " + str(MAX_CHANNELS_PER_REQUEST) + " channels at a time")
         else:
-            if data:
-                length = len(data)
-            else:
-                length = 0
-            message = str(code) + str(length).rjust(5, '0')
-            if data:
-                message = message + data
-        self.outbound.put(message)
-        self.writeList.append(self.socket)
+            self.request(self.session.send_message_many, channelNames, message)
 
     def process_quit(self):
         print("Quitting...")
@@ -251,6 +219,7 @@ class Client:
 
     def process_user_input(self, input):
         # Parse keyboard input
+        data = None
         if len(input.split()) < 2:
             command = input
         else:
@@ -258,7 +227,7 @@ class Client:
 
         command = command.lower()
 
-        if not self.LoggedIn:
+        if not self.session.LoggedIn:
             if command == '/login':
                 self.login(data)
             elif command == '/quit':
@@ -276,7 +245,7 @@ class Client:
         elif command == '/leave':
             self.leave_channel(data)
         elif command == '/rooms':
-            self.list_rooms()
+            self.list_rooms(data)
         elif command == '/users':
             self.list_users(data)
         elif command == '/message':
@@ -286,37 +255,66 @@ class Client:
         else:
             print("Unknown command issued: " + command)
 
-    def send_outgoing_data(self):
-        while not self.outbound.empty():
-            self.socket.send(self.outbound.get())
+    def process_keyboard_input(self):
+        # stdin is non-blocking - take whatever has been typed and act on
+        # the complete lines, keeping a partial one for next time
+        try:
+            data = os.read(sys.stdin.fileno(), 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            # stdin closed
+            self.process_quit()
+        lines = (self.keyboardInput + self.keyboardDecoder.decode(data)).split('\n')
+        self.keyboardInput = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if line != '':
+                self.process_user_input(line)
 
     def run(self):
-
+        if msvcrt is None:
+            blocking = os.get_blocking(sys.stdin.fileno())
+            os.set_blocking(sys.stdin.fileno(), False)
+        try:
+            self.run_loop()
+        finally:
+            if msvcrt is None:
+                # stdin is shared with the shell we were started from
+                os.set_blocking(sys.stdin.fileno(), blocking)
+
+    def run_loop(self):
+        session = self.session
         while True:
-            if self.readList:
-                # Is the server socket ready for reading or writing?
-                read, write, exception = select.select(self.readList, self.writeList, self.readList, 1)
+            sock = session.sock
+            readList = [sock] if sock is not None else []
+            writeList = [sock] if sock is not None and session.outbound else []
+            if readList or msvcrt is None:
+                if msvcrt is None:
+                    # Off Windows stdin goes in the same select as the server
+                    # socket, so we sleep until either one has something for us
+                    read, write, exception = select.select(readList + [sys.stdin], writeList, readList)
+                else:
+                    # Is the server socket ready for reading or writing?
+                    read, write, exception = select.select(readList, writeList, readList, 1)
 
-                for s in read:
-                    if s == self.socket:
-                        # A client is trying to connect
-                        self.process_server_data()
+                for s in exception:
+                    if s is session.sock:
+                        print("Server socket encountered exception.  Please login again")
+                        session.close()
 
                 for s in write:
-                    if s == self.socket:
-                        self.send_outgoing_data()
-                        self.writeList.remove(s)
+                    if s is session.sock:
+                        session.flush_outgoing_data()
 
-                for s in exception:
-                    if s == self.socket:
-                        print("Server socket encountered exception.  Please login again")
-                        self.readList.remove(self.socket)
-                        if self.socket in self.writeList:
-                            self.writeList.remove(self.socket)
-                        self.socket.close()
+                for s in read:
+                    if s is session.sock:
+                        session.process_input()
+                    elif s is sys.stdin:
+                        self.process_keyboard_input()
 
             # Check for keyboard input
-            while msvcrt.kbhit():
+            while msvcrt and msvcrt.kbhit():
                 newChar = msvcrt.getche()
                 if newChar == '\r':
                     print('')
@@ -326,7 +324,26 @@ class Client:
                 else:
                     self.keyboardInput = self.keyboardInput + newChar
 
-# Start of main client program
+def add_tls_arguments(parser):
+    parser.add_argument('--tls', action='store_true', help="connect with TLS")
+    parser.add_argument('--tls-ca', metavar='PATH',
+                        help="trust the certificates in this file instead of the system's, implies --tls")
+    parser.add_argument('--tls-insecure', action='store_true',
+                        help="don't check the server's certificate (testing only), implies --tls")
+
+def make_tls_context(args):
+    if not (args.tls or args.tls_ca or args.tls_insecure):
+        return None
+    import irc_tls
+    return irc_tls.make_client_context(args.tls_ca, not args.tls_insecure)
 
-client = Client()
-client.run()
+# Start of main client program
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CS594 IRC Client")
+    parser.add_argument('--binary', action='store_true', help="use the binary framing")
+    parser.add_argument('--compress', action='store_true', help="ask for compressed frames, implies --binary")
+    add_tls_arguments(parser)
+    args = parser.parse_args()
+
+    client = Client(args.binary, args.compress, make_tls_context(args))
+    client.run()
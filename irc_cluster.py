@@ -0,0 +1,262 @@
+# Miguel Delapaz - CS594 - IRC Server multi-process mode
+#
+# N worker processes each run their own Server and event loop on the same
+# port (SO_REUSEPORT), so the kernel spreads client connections across cores.
+# Workers are linked in a full mesh of unix socket pairs - the bus - which
+# carries logins, channel membership changes and channel messages.  Every
+# worker knows which channels exist and who is in them, and a message is
+# only forwarded to the workers that have members in its channel.
+import logging
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+
+from irc_protocol import OutputBuffer, RECV_SIZE
+
+log = logging.getLogger('irc_cluster')
+
+# Bus records are a 4 byte body length and a 1 byte record type, followed by
+# the body.  Bodies are newline separated utf-8 fields
+BUS_HEADER = struct.Struct('!IB')
+
+BUS_LOGIN = 1
+BUS_LOGOUT = 2
+BUS_JOIN = 3
+BUS_LEAVE = 4
+BUS_MESSAGE = 5
+# Link setup between federated nodes - see irc_federation
+BUS_HELLO = 6
+# One message to several channels: the channel names separated by spaces,
+# then the sender and message.  Goes once to each worker with members in
+# any of them
+BUS_MESSAGE_MANY = 7
+
+class BusDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        buf = self.buffer
+        buf += data
+        records = []
+        offset = 0
+        end = len(buf)
+        while end - offset >= BUS_HEADER.size:
+            length, kind = BUS_HEADER.unpack_from(buf, offset)
+            start = offset + BUS_HEADER.size
+            if end - start < length:
+                break
+            records.append((kind, bytes(buf[start:start + length])))
+            offset = start + length
+        if offset:
+            del buf[:offset]
+        return records
+
+class PeerLink:
+    def __init__(self, peer, sock):
+        self.peer = peer
+        self.sock = sock
+        self.outbound = OutputBuffer()
+        self.decoder = BusDecoder()
+        self.handler = None
+        # Registered for EVENT_WRITE as well as EVENT_READ
+        self.writing = False
+
+class WorkerBus:
+    # What the other ends are called in log messages
+    peerKind = 'worker'
+
+    def __init__(self, server, links, nodeId):
+        # links maps peer worker id -> connected socket to that worker.
+        # nodeId is our own worker id
+        self.server = server
+        self.nodeId = nodeId
+        self.links = {}
+        # Links with records queued since the last flush()
+        self.dirtyLinks = set()
+        for peer, sock in links.items():
+            self.add_link(peer, sock)
+
+    def add_link(self, peer, sock):
+        sock.setblocking(False)
+        link = PeerLink(peer, sock)
+        link.handler = self.make_handler(link)
+        self.links[peer] = link
+        self.server.selector.register(sock, selectors.EVENT_READ, link.handler)
+        return link
+
+    def make_handler(self, link):
+        return lambda events: self.process_link(link, events)
+
+    def send(self, link, kind, body):
+        # Header and body go in as separate chunks so the body isn't copied
+        if link.outbound.append(BUS_HEADER.pack(len(body), kind)):
+            self.dirtyLinks.add(link)
+        link.outbound.append(body)
+
+    def flush(self):
+        # Called by the server at the end of every loop iteration
+        dirty = self.dirtyLinks
+        self.dirtyLinks = set()
+        for link in dirty:
+            if self.links.get(link.peer) is link:
+                self.flush_link(link)
+
+    def flush_link(self, link):
+        try:
+            pending = link.outbound.flush(link.sock)
+        except OSError:
+            self.drop_link(link)
+            return
+        if pending and not link.writing:
+            link.writing = True
+            self.server.selector.modify(link.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, link.handler)
+        elif not pending and link.writing:
+            link.writing = False
+            self.server.selector.modify(link.sock, selectors.EVENT_READ, link.handler)
+
+    def publish(self, kind, body):
+        for link in self.links.values():
+            self.send(link, kind, body)
+
+    def publish_login(self, username):
+        self.publish(BUS_LOGIN, username.encode('utf-8'))
+
+    def publish_logout(self, username):
+        self.publish(BUS_LOGOUT, username.encode('utf-8'))
+
+    def publish_join(self, channelName, username):
+        self.publish(BUS_JOIN, (channelName + '\n' + username).encode('utf-8'))
+
+    def publish_leave(self, channelName, username):
+        self.publish(BUS_LEAVE, (channelName + '\n' + username).encode('utf-8'))
+
+    def publish_message(self, peers, channelName, response):
+        # response already starts with the channel name
+        body = response.encode('utf-8')
+        for peer in peers:
+            link = self.links.get(peer)
+            if link is not None:
+                self.send(link, BUS_MESSAGE, body)
+
+    def publish_message_many(self, peers, channelNames, body):
+        body = (' '.join(channelNames) + '\n' + body).encode('utf-8')
+        for peer in peers:
+            link = self.links.get(peer)
+            if link is not None:
+                self.send(link, BUS_MESSAGE_MANY, body)
+
+    def process_link(self, link, events):
+        if events & selectors.EVENT_READ:
+            try:
+                data = link.sock.recv(RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                data = None
+            except OSError:
+                data = b''
+            if data == b'':
+                log.warning("Lost bus link to %s %s", self.peerKind, link.peer)
+                self.drop_link(link)
+                return
+            if data:
+                for kind, body in link.decoder.feed(data):
+                    self.process_record(link.peer, kind, body.decode('utf-8'))
+
+        if events & selectors.EVENT_WRITE:
+            self.flush_link(link)
+
+    def process_record(self, peer, kind, body):
+        server = self.server
+        if kind == BUS_MESSAGE:
+            channelName = body.split('\n', 1)[0]
+            server.process_remote_message(peer, channelName, body)
+        elif kind == BUS_MESSAGE_MANY:
+            channelNames, body = body.split('\n', 1)
+            server.process_remote_message_many(peer, channelNames.split(), body)
+        elif kind == BUS_JOIN:
+            channelName, username = body.split('\n', 1)
+            server.process_remote_join(peer, channelName, username)
+        elif kind == BUS_LEAVE:
+            channelName, username = body.split('\n', 1)
+            server.process_remote_leave(peer, channelName, username)
+        elif kind == BUS_LOGIN:
+            server.process_remote_login(peer, body)
+        elif kind == BUS_LOGOUT:
+            server.process_remote_logout(peer, body)
+        else:
+            log.warning("Unknown bus record type %d from worker %s", kind, peer)
+
+    def drop_link(self, link):
+        self.server.selector.unregister(link.sock)
+        link.sock.close()
+        del self.links[link.peer]
+        self.server.process_peer_lost(link.peer)
+
+def run_worker(workerId, links, makeServer):
+    server = makeServer(workerId)
+    server.bus = WorkerBus(server, links, workerId)
+    log.info("Worker %d running as pid %d", workerId, os.getpid())
+    server.run()
+
+def run_workers(count, makeServer):
+    # makeServer(workerId) builds a Server bound with reusePort=True.  It is
+    # called in each worker after the fork so every worker gets its own listen socket
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit("Multi-process mode needs fork() and SO_REUSEPORT")
+
+    # Full mesh - one socket pair for every pair of workers
+    mesh = {}
+    for i in range(count):
+        for j in range(i + 1, count):
+            mesh[(i, j)] = socket.socketpair()
+
+    children = []
+    for workerId in range(count):
+        pid = os.fork()
+        if pid == 0:
+            links = {}
+            for (i, j), (a, b) in mesh.items():
+                if i == workerId:
+                    links[j] = a
+                    b.close()
+                elif j == workerId:
+                    links[i] = b
+                    a.close()
+                else:
+                    a.close()
+                    b.close()
+            status = 0
+            try:
+                run_worker(workerId, links, makeServer)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                status = 1
+            os._exit(status)
+        children.append(pid)
+
+    for a, b in mesh.values():
+        a.close()
+        b.close()
+
+    # Take the workers down with us on SIGTERM as well as Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while children:
+            pid, status = os.wait()
+            if pid in children:
+                children.remove(pid)
+                log.warning("Worker pid %d exited with status %d", pid, status)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
@@ -0,0 +1,172 @@
+# Miguel Delapaz - CS594 - IRC Server federation
+#
+# Several server nodes, each with its own users, linked over TCP so they
+# share one set of channels.  Node links carry the same records as the
+# worker bus in irc_cluster (logins, joins, leaves and channel messages)
+# and feed the same Server.process_remote_* hooks, so each node knows every
+# channel and who is in it.  A message only goes to the nodes with members
+# in its channel.
+#
+# Nodes are fully meshed: every node is given the others' addresses and
+# dials the ones with a higher node id, keeping one link per pair.  When a
+# link comes up each side sends the other all of its logins and
+# memberships, and dropped links are redialled, so a node that restarts
+# catches up with the rest.  A name logged in on two nodes at once stays
+# with the lower node id (see Server.process_remote_login).  Links are not
+# authenticated - keep the link port on a private network.
+import errno
+import logging
+import selectors
+import socket
+
+from irc_cluster import WorkerBus, BusDecoder, BUS_HEADER, BUS_HELLO, BUS_LOGIN, BUS_JOIN
+from irc_protocol import RECV_SIZE
+
+log = logging.getLogger('irc_federation')
+
+# Seconds between attempts to bring up missing links
+REDIAL_INTERVAL = 2.0
+
+def parse_peer(text):
+    # ID@HOST:PORT
+    try:
+        nodeId, addr = text.split('@', 1)
+        host, port = addr.rsplit(':', 1)
+        return int(nodeId), (host, int(port))
+    except ValueError:
+        raise ValueError("Bad peer " + text + " - expected ID@HOST:PORT")
+
+class PendingLink:
+    # A node connection that hasn't said who it is yet
+    def __init__(self, sock, dialed):
+        self.sock = sock
+        self.dialed = dialed
+        self.connected = not dialed
+        self.decoder = BusDecoder()
+        self.handler = None
+
+class FederationBus(WorkerBus):
+    peerKind = 'node'
+
+    def __init__(self, server, nodeId, linkPort, peers, host=''):
+        WorkerBus.__init__(self, server, {}, nodeId)
+        # Node id -> address for every other node
+        self.peers = peers
+        self.dialing = {}
+
+        self.listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listenSocket.setblocking(False)
+        self.listenSocket.bind((host, linkPort))
+        self.listenSocket.listen(16)
+        self.linkPort = self.listenSocket.getsockname()[1]
+        server.selector.register(self.listenSocket, selectors.EVENT_READ, self.process_accept)
+        # First dial on the loop's first tick, then every REDIAL_INTERVAL
+        self.redialTimer = server.timers.schedule(server.now, 0, self.process_redial)
+        log.info("Node %d accepting node links on port %d", nodeId, self.linkPort)
+
+    def process_redial(self):
+        self.dial_missing()
+        self.server.timers.reschedule(self.redialTimer, self.server.now, REDIAL_INTERVAL)
+
+    def dial_missing(self):
+        # The lower id of each pair dials, so there's only ever one link
+        for peer, addr in self.peers.items():
+            if peer > self.nodeId and peer not in self.links and peer not in self.dialing:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                result = sock.connect_ex(addr)
+                if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    sock.close()
+                    continue
+                pending = PendingLink(sock, True)
+                pending.handler = self.make_pending_handler(pending, peer)
+                self.dialing[peer] = pending
+                self.server.selector.register(sock, selectors.EVENT_WRITE, pending.handler)
+
+    def make_pending_handler(self, pending, peer):
+        return lambda events: self.process_pending(pending, peer, events)
+
+    def process_accept(self, events):
+        while True:
+            try:
+                sock, addr = self.listenSocket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log.warning("Error accepting node link: %s", e)
+                return
+            sock.setblocking(False)
+            pending = PendingLink(sock, False)
+            pending.handler = self.make_pending_handler(pending, None)
+            self.server.selector.register(sock, selectors.EVENT_READ, pending.handler)
+
+    def send_hello(self, sock):
+        # Small enough to always fit in an empty socket buffer
+        body = str(self.nodeId).encode('utf-8')
+        sock.sendall(BUS_HEADER.pack(len(body), BUS_HELLO) + body)
+
+    def process_pending(self, pending, peer, events):
+        selector = self.server.selector
+        try:
+            if not pending.connected:
+                error = pending.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    raise OSError(error, "connect failed")
+                pending.connected = True
+                self.send_hello(pending.sock)
+                selector.modify(pending.sock, selectors.EVENT_READ, pending.handler)
+                return
+            data = pending.sock.recv(RECV_SIZE)
+            if not data:
+                raise OSError("closed before hello")
+            records = pending.decoder.feed(data)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            if pending.dialed:
+                log.debug("Link to node %s failed: %s", peer, e)
+            self.close_pending(pending, peer)
+            return
+        if not records:
+            return
+
+        kind, body = records[0]
+        try:
+            helloId = int(body)
+        except ValueError:
+            helloId = None
+        if kind != BUS_HELLO or helloId is None or helloId == self.nodeId or helloId in self.links \
+                or (pending.dialed and helloId != peer):
+            log.warning("Rejecting node link from %s", pending.sock.getpeername())
+            self.close_pending(pending, peer)
+            return
+
+        if peer is not None:
+            del self.dialing[peer]
+        selector.unregister(pending.sock)
+        if not pending.dialed:
+            self.send_hello(pending.sock)
+        link = self.add_link(helloId, pending.sock)
+        link.decoder.buffer = pending.decoder.buffer
+        log.info("Linked to node %d", helloId)
+        self.send_state(link)
+        # Anything the other side sent straight after its hello
+        for kind, body in records[1:]:
+            self.process_record(helloId, kind, body.decode('utf-8'))
+
+    def close_pending(self, pending, peer):
+        self.server.selector.unregister(pending.sock)
+        pending.sock.close()
+        if peer is not None:
+            del self.dialing[peer]
+
+    def send_state(self, link):
+        # Everything a node needs to know about us - it forgets everything
+        # about us when a link drops
+        server = self.server
+        for username in server.userList:
+            self.send(link, BUS_LOGIN, username.encode('utf-8'))
+        for channel in server.channelList.values():
+            for client in channel.users:
+                self.send(link, BUS_JOIN, (channel.name + '\n' + client.name).encode('utf-8'))
@@ -0,0 +1,104 @@
+# Miguel Delapaz - CS594 - IRC Server channel history
+#
+# The last few messages of each channel are kept so someone joining gets
+# some context.  Messages are kept as the exact frames broadcast() sent
+# (a list indexed by framing, with None for a framing nobody needed), so
+# replaying them is just handing the same bytes objects to the new member.
+# Total size is capped; when it goes over, whole histories are thrown away
+# starting with the channel that has been quiet the longest
+import collections
+
+from irc_protocol import Command, ResponseCodes, ProtocolError, encode_response, encode_binary_frame, decompress_payload, BINARY_HEADER, HEADER_SIZE, FLAG_COMPRESSED, FRAMING_BINARY, FRAMING_COMPRESSED, FRAMING_LEGACY
+
+def entry_size(entry):
+    size = 0
+    for frame in entry:
+        if frame:
+            size += len(frame)
+    return size
+
+def entry_message(entry):
+    # The message a stored entry carries, out of whichever frame it has.
+    # Legacy payloads start with the response code digit
+    frame = entry[FRAMING_BINARY] or entry[FRAMING_COMPRESSED]
+    if not frame:
+        return entry[FRAMING_LEGACY][HEADER_SIZE + 1:].decode('utf-8')
+    payload = frame[BINARY_HEADER.size:]
+    if frame[3] & FLAG_COMPRESSED:
+        payload = decompress_payload(payload)
+    return payload.decode('utf-8')
+
+def convert_frame(entry, framing):
+    # Make a stored message's frame for a framing nobody needed when it was
+    # sent.  False if it doesn't fit
+    try:
+        return encode_response(framing, Command.MESSAGE, ResponseCodes.OK, entry_message(entry))
+    except ProtocolError:
+        return False
+
+class History:
+    def __init__(self, depth=50, maxBytes=64 * 1024 * 1024):
+        # Messages kept per channel, and bytes kept across all channels
+        self.depth = depth
+        self.maxBytes = maxBytes
+        self.size = 0
+        # Channels with history, least recently used first
+        self.channels = collections.OrderedDict()
+
+    def record(self, channel, frames, message):
+        # frames is what broadcast() encoded for the channel's members
+        if not any(frames):
+            # Nobody here to send it to (members on other workers only), or
+            # too long for the framings of the members who are
+            try:
+                frames[FRAMING_BINARY] = encode_binary_frame(Command.MESSAGE, ResponseCodes.OK.value, message)
+            except ProtocolError:
+                # Too long for any framing - nobody got it, nothing to replay
+                return
+        ring = channel.history
+        if ring is None:
+            ring = channel.history = collections.deque()
+            self.channels[channel.name] = channel
+        else:
+            self.channels.move_to_end(channel.name)
+        if len(ring) >= self.depth:
+            self.size -= entry_size(ring.popleft())
+        ring.append(frames)
+        self.size += entry_size(frames)
+        self.trim()
+
+    def replay(self, channel, framing, limit):
+        # Frames of the channel's history for a member using framing, oldest
+        # first - as many of the newest as fit in limit bytes
+        self.channels.move_to_end(channel.name)
+        frames = []
+        for entry in reversed(channel.history):
+            data = entry[framing]
+            if data is None:
+                data = entry[framing] = convert_frame(entry, framing)
+                if data:
+                    self.size += len(data)
+            if data:
+                if len(data) > limit:
+                    break
+                limit -= len(data)
+                frames.append(data)
+        frames.reverse()
+        # The frames made for this framing count against the cap too
+        self.trim()
+        return frames
+
+    def trim(self):
+        while self.size > self.maxBytes:
+            name, cold = self.channels.popitem(last=False)
+            self.drop(cold)
+
+    def discard(self, channel):
+        # Channel is gone
+        if self.channels.pop(channel.name, None) is not None:
+            self.drop(channel)
+
+    def drop(self, channel):
+        for entry in channel.history:
+            self.size -= entry_size(entry)
+        channel.history = None
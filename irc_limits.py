@@ -0,0 +1,103 @@
+# Miguel Delapaz - CS594 - IRC Server rate limits
+#
+# Token buckets per connection: one for every frame a client sends and one
+# per limited command.  Each is kept as a single number - the time the
+# bucket will next be full again (the "theoretical arrival time" of GCRA,
+# which behaves exactly like a token bucket) - so checking a frame is a few
+# float operations on a list the client already has, with nothing allocated
+from irc_protocol import Command
+
+# Frames per second and burst size.  'total' covers every frame a client
+# sends, whatever the command
+DEFAULT_LIMITS = {'total': (200, 400),
+                  'MESSAGE': (20, 40),
+                  'MESSAGE_MANY': (2, 10),
+                  'LIST_ROOMS': (5, 20),
+                  'LIST_USERS': (5, 20)}
+
+# Waits shorter than this (seconds) are let through.  Rounding in the sums
+# can otherwise leave the last frame of a burst a hair over its limit, and
+# held for a whole timer tick
+SLACK = 1e-6
+
+# What to do with a client over its limit: stop reading from it until it is
+# back under, or disconnect it
+FLOOD_POLICIES = ('delay', 'disconnect')
+
+def parse_limit(text):
+    # NAME=RATE/BURST, NAME being a command or 'total'
+    try:
+        name, limit = text.split('=', 1)
+        rate, burst = limit.split('/', 1)
+        rate = float(rate)
+        burst = int(burst)
+    except ValueError:
+        raise ValueError("Bad rate limit " + text + " - expected NAME=RATE/BURST")
+    name = name.upper() if name != 'total' else name
+    if name != 'total' and name not in Command.__members__:
+        raise ValueError("Unknown command " + name + " in rate limit " + text)
+    if rate <= 0 or burst < 1:
+        raise ValueError("Rate limit " + text + " needs a positive rate and a burst of at least 1")
+    return name, (rate, burst)
+
+def add_rate_limit_arguments(parser):
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='NAME=RATE/BURST',
+                        help="frames per second and burst allowed per client for a command, or 'total' "
+                             "for all frames (repeat for each; replaces that default)")
+    parser.add_argument('--no-rate-limit', action='store_true', help="turn off rate limits")
+    parser.add_argument('--flood-policy', default='delay', choices=FLOOD_POLICIES,
+                        help="what happens to a client over its rate limits")
+
+def make_rate_limits(args):
+    # The Server's rateLimits for the options above, None for no limits
+    if args.no_rate_limit:
+        return None
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(parse_limit(text) for text in args.rate_limit)
+    return limits
+
+class RateLimiter:
+    def __init__(self, limits):
+        # limits maps 'total' and command names to (rate, burst)
+        # Bucket 0 is 'total'; a zero interval means no limit
+        self.intervals = [0.0]
+        self.tolerances = [0.0]
+        # Raw command code -> bucket number, 0 for commands without a limit
+        self.buckets = [0] * 256
+        for name, (rate, burst) in sorted(limits.items()):
+            interval = 1.0 / rate
+            # How far ahead of now the bucket may get - burst frames at once
+            tolerance = (burst - 1) * interval
+            if name == 'total':
+                self.intervals[0] = interval
+                self.tolerances[0] = tolerance
+            else:
+                self.buckets[Command[name].value] = len(self.intervals)
+                self.intervals.append(interval)
+                self.tolerances.append(tolerance)
+
+    def check(self, client, command, now):
+        # 0 if the frame may go ahead (and it is counted), otherwise the
+        # seconds until it may
+        state = client.limits
+        if state is None:
+            # Every bucket starts full
+            state = client.limits = [0.0] * len(self.intervals)
+        interval = self.intervals[0]
+        if interval:
+            total = state[0]
+            if total < now:
+                total = now
+            if total - now > self.tolerances[0] + SLACK:
+                return total - self.tolerances[0] - now
+        index = self.buckets[command]
+        if index:
+            arrival = state[index]
+            if arrival < now:
+                arrival = now
+            if arrival - now > self.tolerances[index] + SLACK:
+                return arrival - self.tolerances[index] - now
+            state[index] = arrival + self.intervals[index]
+        if interval:
+            state[0] = total + interval
+        return 0
@@ -0,0 +1,266 @@
+# Miguel Delapaz - CS594 - IRC Server metrics and logging
+#
+# Counters and histograms are plain lists updated in place so recording on
+# the hot path is a few integer adds.  They are only turned into text when
+# somebody scrapes the stats endpoint, which speaks just enough HTTP for
+# Prometheus (or curl) to read the text exposition format.  The endpoint's
+# /connections path lists the connections with the deepest output queues,
+# for finding out who a big irc_output_queued_bytes belongs to.
+import atexit
+import bisect
+import logging
+import logging.handlers
+import queue
+import selectors
+import socket
+
+from irc_protocol import Command, OutputBuffer, RECV_SIZE
+
+# Connections /connections lists unless asked for more (?top=N)
+CONNECTIONS_SHOWN = 100
+
+# Latency buckets in seconds, 10us to 1s
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+def setup_logging(level='INFO'):
+    # Log records are handed to a queue and written out by a background
+    # thread, so a slow stdout never stalls the event loop
+    logQueue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(logQueue, handler)
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(logQueue)]
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One count per bucket plus the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels, lines):
+        # Prometheus buckets are cumulative
+        labels = labels + ',' if labels else ''
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append('%s_bucket{%sle="%g"} %d' % (name, labels, bound, total))
+        lines.append('%s_bucket{%sle="+Inf"} %d' % (name, labels, self.count))
+        labels = '{' + labels.rstrip(',') + '}' if labels else ''
+        lines.append('%s_sum%s %.9f' % (name, labels, self.sum))
+        lines.append('%s_count%s %d' % (name, labels, self.count))
+
+class Metrics:
+    def __init__(self):
+        # Indexed by raw command code
+        self.framesIn = [0] * 256
+        self.framesOut = [0] * 256
+        self.handlerLatency = [None] * 256
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.connectionsAccepted = 0
+        self.disconnects = 0
+        self.slowConsumerEvents = 0
+        self.timeouts = 0
+        self.rateLimited = 0
+        # TLS handshakes completed, how many of those resumed an earlier
+        # session, and how many failed or timed out
+        self.tlsHandshakes = 0
+        self.tlsResumed = 0
+        self.tlsFailures = 0
+        self.loopIterations = 0
+        self.loopTime = Histogram()
+
+    def record_command(self, command, elapsed):
+        self.framesIn[command] += 1
+        latency = self.handlerLatency[command]
+        if latency is None:
+            latency = self.handlerLatency[command] = Histogram()
+        latency.observe(elapsed)
+
+    def record_frames_out(self, command, count):
+        self.framesOut[command] += count
+
+    def record_loop(self, elapsed):
+        self.loopIterations += 1
+        self.loopTime.observe(elapsed)
+
+    def render(self, server):
+        lines = []
+
+        def command_name(code):
+            try:
+                return Command(code).name
+            except ValueError:
+                return str(code)
+
+        def counter(name, help, value):
+            lines.append('# HELP ' + name + ' ' + help)
+            lines.append('# TYPE ' + name + ' counter')
+            lines.append('%s %d' % (name, value))
+
+        def gauge(name, help, value):
+            lines.append('# HELP ' + name + ' ' + help)
+            lines.append('# TYPE ' + name + ' gauge')
+            lines.append('%s %d' % (name, value))
+
+        for name, values, help in (('irc_frames_in_total', self.framesIn, "Frames received by command"),
+                                   ('irc_frames_out_total', self.framesOut, "Frames queued for sending by command")):
+            lines.append('# HELP ' + name + ' ' + help)
+            lines.append('# TYPE ' + name + ' counter')
+            for code, value in enumerate(values):
+                if value:
+                    lines.append('%s{command="%s"} %d' % (name, command_name(code), value))
+
+        counter('irc_bytes_in_total', "Bytes received from clients", self.bytesIn)
+        counter('irc_bytes_out_total', "Bytes written to clients", self.bytesOut)
+        counter('irc_connections_accepted_total', "Client connections accepted", self.connectionsAccepted)
+        counter('irc_disconnects_total', "Client connections closed", self.disconnects)
+        counter('irc_slow_consumer_events_total', "Times a client went over the output high watermark",
+                self.slowConsumerEvents)
+        counter('irc_timeouts_total', "Clients disconnected for not logging in or going quiet", self.timeouts)
+        counter('irc_rate_limited_total', "Frames that found their client over its rate limits", self.rateLimited)
+        if server.tls is not None:
+            counter('irc_tls_handshakes_total', "TLS handshakes completed", self.tlsHandshakes)
+            counter('irc_tls_resumed_total', "TLS handshakes that resumed an earlier session", self.tlsResumed)
+            counter('irc_tls_failures_total', "TLS handshakes that failed or timed out", self.tlsFailures)
+            gauge('irc_tls_handshakes_pending', "TLS handshakes in progress", server.tls.pending)
+
+        # Queue depths are walked at scrape time rather than tracked per frame
+        queued = 0
+        deepest = 0
+        paused = 0
+        for client in server.clientList.values():
+            if client.outbound is None:
+                continue
+            size = client.outbound.size
+            queued += size
+            deepest = max(deepest, size)
+            paused += client.paused
+        gauge('irc_connections', "Connected clients", len(server.clientList))
+        gauge('irc_users', "Logged in users on this server", len(server.userList))
+        gauge('irc_channels', "Channels", len(server.channelList))
+        gauge('irc_timers', "Timers pending", server.timers.count)
+        gauge('irc_output_queued_bytes', "Bytes queued for all clients", queued)
+        gauge('irc_output_queue_max_bytes', "Deepest client output queue", deepest)
+        gauge('irc_paused_clients', "Clients with reads paused for backpressure", paused)
+
+        lines.append('# HELP irc_loop_iteration_seconds Time spent handling one batch of events')
+        lines.append('# TYPE irc_loop_iteration_seconds histogram')
+        self.loopTime.render('irc_loop_iteration_seconds', '', lines)
+
+        lines.append('# HELP irc_handler_seconds Time spent handling one request, by command')
+        lines.append('# TYPE irc_handler_seconds histogram')
+        for code, latency in enumerate(self.handlerLatency):
+            if latency is not None:
+                latency.render('irc_handler_seconds', 'command="%s"' % command_name(code), lines)
+
+        lines.append('')
+        return '\n'.join(lines)
+
+def render_connections(server, limit=CONNECTIONS_SHOWN):
+    # One line per connection, deepest output queue first
+    lines = ['# address user queued_bytes queued_chunks dropped_frames paused']
+    for addr, name, size, chunks, dropped, paused in server.connection_stats(limit):
+        if isinstance(addr, tuple):
+            addr = str(addr[0]) + ':' + str(addr[1])
+        lines.append('%s %s %d %d %d %d' % (addr, name or '-', size, chunks, dropped, paused))
+    lines.append('')
+    return '\n'.join(lines)
+
+def parse_connections_query(query):
+    limit = CONNECTIONS_SHOWN
+    for field in query.split('&'):
+        name, sep, value = field.partition('=')
+        if name == 'top' and value.isdigit():
+            limit = int(value)
+    return limit
+
+class StatsEndpoint:
+    # Minimal HTTP listener on the server's own event loop.  /connections
+    # gets render_connections(), any other path the current metrics, and
+    # the connection is closed
+    def __init__(self, server, port, host='127.0.0.1'):
+        self.server = server
+        self.listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listenSocket.setblocking(False)
+        self.listenSocket.bind((host, port))
+        self.listenSocket.listen(16)
+        self.port = self.listenSocket.getsockname()[1]
+        server.selector.register(self.listenSocket, selectors.EVENT_READ, self.process_accept)
+        logging.getLogger('irc_metrics').info("Stats endpoint listening on %s:%d", host, self.port)
+
+    def process_accept(self, events):
+        while True:
+            try:
+                sock, addr = self.listenSocket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            sock.setblocking(False)
+            request = StatsRequest(self, sock)
+            self.server.selector.register(sock, selectors.EVENT_READ, request.process_events)
+
+class StatsRequest:
+    def __init__(self, endpoint, sock):
+        self.endpoint = endpoint
+        self.sock = sock
+        self.request = b''
+        self.outbound = None
+
+    def process_events(self, events):
+        selector = self.endpoint.server.selector
+        if self.outbound is None:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                data = b''
+            self.request += data
+            if data and b'\r\n\r\n' not in self.request and b'\n\n' not in self.request and len(self.request) < 8192:
+                return
+            if not data:
+                self.close()
+                return
+            server = self.endpoint.server
+            path, sep, query = self.request_path().partition('?')
+            if path == '/connections':
+                body = render_connections(server, parse_connections_query(query)).encode('utf-8')
+            else:
+                body = server.metrics.render(server).encode('utf-8')
+            self.outbound = OutputBuffer()
+            self.outbound.append(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                                 b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body))
+            self.outbound.append(body)
+            selector.modify(self.sock, selectors.EVENT_WRITE, self.process_events)
+        try:
+            if not self.outbound.flush(self.sock):
+                self.close()
+        except OSError:
+            self.close()
+
+    def request_path(self):
+        # From the request line, "GET /path HTTP/1.0"
+        fields = self.request.split(b'\n', 1)[0].split()
+        if len(fields) < 2:
+            return '/'
+        return fields[1].decode('latin-1')
+
+    def close(self):
+        self.endpoint.server.selector.unregister(self.sock)
+        self.sock.close()
@@ -0,0 +1,422 @@
+# Miguel Delapaz - CS594 - IRC Protocol definitions shared by client and server
+import collections
+import itertools
+import os
+import struct
+import zlib
+from enum import Enum
+try:
+    import ssl
+except ImportError:
+    # Python built without OpenSSL - no TLS, everything else works
+    ssl = None
+
+class Command(Enum):
+    LOGIN = 1
+    LOGOUT = 2
+    ADD_CHANNEL = 3
+    JOIN_CHANNEL = 4
+    LEAVE_CHANNEL = 5
+    LIST_ROOMS = 6
+    LIST_USERS = 7
+    MESSAGE = 8
+    # Keepalives - either side may send a PING at any time, even before
+    # login, and the other answers with a PONG carrying the same payload.
+    # The legacy header has one digit for the command, so PONG gets the
+    # one left over
+    PING = 9
+    PONG = 0
+    # Several channels in one frame - binary framing only, as there are no
+    # digits left for them in the legacy header.  See MAX_CHANNELS_PER_REQUEST
+    JOIN_MANY = 10
+    LEAVE_MANY = 11
+    MESSAGE_MANY = 12
+
+class ResponseCodes(Enum):
+    OK = 0
+    ERROR = 4
+
+# Packet is one byte of command code, 5 bytes of length (string form)
+# followed by the data
+HEADER_SIZE = 6
+MAX_PAYLOAD = 99999
+
+# How much to ask the kernel for per recv call.  Big enough that a burst of
+# channel traffic is picked up in a single syscall
+RECV_SIZE = 65536
+
+# Most buffers a single sendmsg call will take
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+if IOV_MAX <= 0:
+    IOV_MAX = 16
+
+# Most plaintext one TLS record carries.  Small frames are joined into
+# writes of about this size so they don't each cost a record of their own -
+# see OutputBuffer.flush_tls
+TLS_RECORD_SIZE = 16384
+
+# Binary framing.  A client that opens the connection with BINARY_MAGIC uses
+# it for the whole session, in both directions; anything else gets the legacy
+# ASCII framing above.  Header is magic, command, status (response code),
+# flags and a 4 byte payload length.  Response payloads are just the message -
+# the response code is in the header
+BINARY_MAGIC = 0xB1
+BINARY_HEADER = struct.Struct('!BBBBI')
+MAX_BINARY_PAYLOAD = 16 * 1024 * 1024
+
+FRAMING_LEGACY = 0
+FRAMING_BINARY = 1
+# Binary framing with compression negotiated at LOGIN.  Same decoder as
+# FRAMING_BINARY; only the server's frames for the connection differ
+FRAMING_COMPRESSED = 2
+# Per framing caches (see Server.broadcast) are lists this long
+FRAMINGS = 3
+
+# Binary header flags.  FLAG_COMPRESSED marks a payload that is raw deflate
+# with CHAT_DICTIONARY as the preset dictionary.  A client sets
+# FLAG_ACCEPT_COMPRESSION on its LOGIN to offer compression, and a server
+# that goes along with it sets it on the OK response.  From then on either
+# side may compress any frame; payloads shorter than COMPRESS_MIN never are.
+# Every frame is compressed on its own, so the server can compress a
+# broadcast once and send the same bytes to every member
+FLAG_COMPRESSED = 0x01
+FLAG_ACCEPT_COMPRESSION = 0x02
+COMPRESS_MIN = 256
+
+# Text that shows up a lot in chat, most common last (deflate finds the end
+# of the dictionary cheapest).  Changing it breaks every compressed
+# connection between old and new code, so it is fixed
+CHAT_DICTIONARY = (
+    b"https://www. .com .org http:// :) :( :D ;) lol haha thanks thank you please sorry "
+    b"yes no ok okay sure maybe really actually probably definitely anyone someone "
+    b"everyone something anything nothing about after again against because before "
+    b"between could would should might there their they're where which while with "
+    b"without what when who why how this that these those then than them have has "
+    b"had having been being were was are is am will just like know think want need "
+    b"going good great right time people today tomorrow yesterday morning tonight "
+    b"here from into over only also very much more most some any all not but "
+    b"and the for you your it's I'm don't can't didn't doesn't isn't that's what's "
+    b"I think I don't know does anyone know is there a way to the same "
+    b"in the of the to the on the at the for the and the it is I am "
+)
+
+# Most a compressed payload may expand to, whatever the framing limit says
+MAX_DECOMPRESSED = MAX_BINARY_PAYLOAD
+
+# LIST_ROOMS and LIST_USERS take an optional query after the usual payload
+# (nothing for LIST_ROOMS, the channel name and a newline for LIST_USERS):
+# "prefix\noffset\nlimit", trailing fields optional.  Only names starting
+# with prefix are listed, in sorted order, skipping the first offset of them
+# and returning at most limit (never more than MAX_LIST_PAGE).  If there are
+# more, the response ends with a '+' line giving the offset to ask for next.
+# Without a query the whole list comes back as before
+MAX_LIST_PAGE = 1000
+
+# JOIN_MANY and LEAVE_MANY take channel names separated by spaces, and
+# MESSAGE_MANY the same followed by a newline and the message.  JOIN_MANY and
+# LEAVE_MANY answer with one frame of their own, a line per channel asked
+# for: the name on its own if that went through, otherwise the name, a space
+# and the reason.  The response code is OK only if all of them went through.
+# MESSAGE_MANY delivers the message as ordinary MESSAGE frames, once to each
+# user however many of the channels they are in, labelled with the first of
+# them in the order given.  It is all or nothing - if any channel doesn't
+# exist the sender gets a MESSAGE_MANY error and nothing is sent
+MAX_CHANNELS_PER_REQUEST = 1000
+
+class ProtocolError(Exception):
+    pass
+
+def encode_frame(command, payload):
+    # command is a Command (or its integer value), payload is str or bytes
+    if isinstance(command, Command):
+        command = command.value
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    elif payload is None:
+        payload = b''
+    if command > 9:
+        raise ProtocolError("Command " + str(command) + " needs the binary framing")
+    if len(payload) > MAX_PAYLOAD:
+        raise ProtocolError("Payload too long - " + str(len(payload)) + " bytes")
+    return b'%d%05d' % (command, len(payload)) + payload
+
+def encode_binary_frame(command, status, payload, flags=0):
+    if isinstance(command, Command):
+        command = command.value
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    elif payload is None:
+        payload = b''
+    if len(payload) > MAX_BINARY_PAYLOAD:
+        raise ProtocolError("Payload too long - " + str(len(payload)) + " bytes")
+    return BINARY_HEADER.pack(BINARY_MAGIC, command, status, flags, len(payload)) + payload
+
+def compress_payload(payload):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15, zdict=CHAT_DICTIONARY)
+    return compressor.compress(payload) + compressor.flush()
+
+def decompress_payload(payload):
+    decompressor = zlib.decompressobj(-15, zdict=CHAT_DICTIONARY)
+    try:
+        data = decompressor.decompress(payload, MAX_DECOMPRESSED)
+    except zlib.error as e:
+        raise ProtocolError("Bad compressed payload - " + str(e))
+    if decompressor.unconsumed_tail:
+        raise ProtocolError("Compressed payload expands past " + str(MAX_DECOMPRESSED) + " bytes")
+    if not decompressor.eof:
+        raise ProtocolError("Compressed payload cut short")
+    return data
+
+def encode_compressed_frame(command, status, payload, flags=0):
+    # Binary frame, compressed if that is worth it
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if payload is not None and len(payload) >= COMPRESS_MIN:
+        compressed = compress_payload(payload)
+        if len(compressed) < len(payload):
+            return encode_binary_frame(command, status, compressed, flags | FLAG_COMPRESSED)
+    return encode_binary_frame(command, status, payload, flags)
+
+def encode_response(framing, command, responseCode, message, flags=0):
+    # Server to client frame in whichever framing the connection uses.  The
+    # legacy framing has nowhere to put flags
+    if framing == FRAMING_BINARY:
+        return encode_binary_frame(command, responseCode.value, message, flags)
+    if framing == FRAMING_COMPRESSED:
+        return encode_compressed_frame(command, responseCode.value, message, flags)
+    return encode_frame(command, str(responseCode.value) + (message or ''))
+
+def make_decoder(framing):
+    if framing == FRAMING_LEGACY:
+        return FrameDecoder()
+    return BinaryFrameDecoder()
+
+# Both decoders return (command, status, flags, payload) tuples.  Legacy
+# frames have no status field (None) and no flags (0)
+def take_leftover(decoder, buf, data, offset):
+    # After a decoder has used up to offset of buf, keep whatever is left
+    # for next time.  Nothing left (the usual case) means no buffer at all,
+    # and a read that held only whole frames is never copied into one
+    if offset == len(buf):
+        decoder.buffer = b''
+    elif buf is data:
+        decoder.buffer = bytearray(data[offset:])
+    elif offset:
+        del buf[:offset]
+
+class FrameDecoder:
+    # Incremental decoder for one connection.  Every complete frame is
+    # returned at once; a partial frame stays in the buffer until the rest
+    # of it shows up
+    __slots__ = ('buffer',)
+
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        buf = self.buffer
+        if buf:
+            buf += data
+        else:
+            buf = data
+        frames = []
+        offset = 0
+        end = len(buf)
+        view = memoryview(buf)
+        try:
+            while end - offset >= HEADER_SIZE:
+                header = view[offset:offset + HEADER_SIZE].tobytes()
+                if not header.isdigit():
+                    raise ProtocolError("Malformed frame header " + repr(header))
+                length = int(header[1:])
+                if end - offset - HEADER_SIZE < length:
+                    break
+                start = offset + HEADER_SIZE
+                frames.append((header[0] - 0x30, None, 0, view[start:start + length].tobytes()))
+                offset = start + length
+        finally:
+            view.release()
+        take_leftover(self, buf, data, offset)
+        return frames
+
+class BinaryFrameDecoder:
+    __slots__ = ('buffer',)
+
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        buf = self.buffer
+        if buf:
+            buf += data
+        else:
+            buf = data
+        frames = []
+        offset = 0
+        end = len(buf)
+        size = BINARY_HEADER.size
+        while end - offset >= size:
+            magic, command, status, flags, length = BINARY_HEADER.unpack_from(buf, offset)
+            if magic != BINARY_MAGIC:
+                raise ProtocolError("Bad frame magic " + hex(magic))
+            if length > MAX_BINARY_PAYLOAD:
+                raise ProtocolError("Frame too long - " + str(length) + " bytes")
+            start = offset + size
+            if end - start < length:
+                break
+            frames.append((command, status, flags, bytes(buf[start:start + length])))
+            offset = start + length
+        take_leftover(self, buf, data, offset)
+        return frames
+
+class OutputBuffer:
+    # Frames waiting to go out on one connection.  Frames are queued as-is
+    # (no copying or joining) and written together with a single sendmsg, so
+    # many small responses cost one syscall.  After a short write the front
+    # chunk is replaced by a memoryview of whatever didn't make it out
+    __slots__ = ('chunks', 'size')
+
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        # Returns True if the buffer was empty before, i.e. the caller needs
+        # to start watching the socket for writability
+        self.chunks.append(data)
+        self.size += len(data)
+        return self.size == len(data)
+
+    def drop_oldest(self, target):
+        # Throw away whole frames from the front until no more than target
+        # bytes are queued.  A partly written frame (a memoryview at the front)
+        # has to stay or the peer would see half a frame.  Returns the number
+        # of frames dropped
+        chunks = self.chunks
+        dropped = 0
+        head = None
+        if chunks and isinstance(chunks[0], memoryview):
+            head = chunks.popleft()
+        while chunks and self.size > target:
+            self.size -= len(chunks.popleft())
+            dropped += 1
+        if head is not None:
+            chunks.appendleft(head)
+        return dropped
+
+    def backlog(self):
+        # Bytes queued behind the frame going out now, leaving out the
+        # newest frame too.  The watermarks are held to this, so one frame
+        # of any size never counts a client as falling behind
+        chunks = self.chunks
+        if len(chunks) < 2:
+            return 0
+        return self.size - len(chunks[0]) - len(chunks[-1])
+
+    def take(self):
+        # Hand every queued chunk to someone else to write, e.g. an asyncio
+        # transport's writelines, and start over empty
+        chunks = list(self.chunks)
+        self.chunks.clear()
+        self.size = 0
+        return chunks
+
+    def flush(self, sock):
+        # Write as much as the socket will take.  Returns the number of bytes
+        # still pending; socket errors other than EAGAIN are left to the caller
+        chunks = self.chunks
+        while chunks:
+            if len(chunks) == 1 or not hasattr(sock, 'sendmsg'):
+                batch = chunks[0]
+                attempted = len(batch)
+                try:
+                    sent = sock.send(batch)
+                except (BlockingIOError, InterruptedError):
+                    break
+            else:
+                batch = list(itertools.islice(chunks, IOV_MAX))
+                attempted = sum(map(len, batch))
+                try:
+                    sent = sock.sendmsg(batch)
+                except (BlockingIOError, InterruptedError):
+                    break
+
+            self.size -= sent
+            full = sent < attempted
+            while sent:
+                head = chunks[0]
+                if sent >= len(head):
+                    sent -= len(head)
+                    chunks.popleft()
+                else:
+                    chunks[0] = memoryview(head)[sent:]
+                    sent = 0
+
+            if full:
+                # Short write - the kernel buffer is full, wait to be writable
+                break
+        return self.size
+
+    def flush_tls(self, sock):
+        # flush() for an ssl.SSLSocket, which has no sendmsg.  Frames are
+        # joined up to a record's worth per write.  A write OpenSSL couldn't
+        # finish has to be retried with the same bytes, so the front chunk
+        # becomes a memoryview (which drop_oldest leaves alone and nothing
+        # more gets joined onto) until it has gone
+        chunks = self.chunks
+        while chunks:
+            head = chunks[0]
+            if len(chunks) > 1 and len(head) < TLS_RECORD_SIZE and not isinstance(head, memoryview):
+                batch = [chunks.popleft()]
+                size = len(head)
+                while chunks and size + len(chunks[0]) <= TLS_RECORD_SIZE and not isinstance(chunks[0], memoryview):
+                    data = chunks.popleft()
+                    batch.append(data)
+                    size += len(data)
+                head = b''.join(batch) if len(batch) > 1 else batch[0]
+                chunks.appendleft(head)
+            try:
+                sent = sock.send(head)
+            except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError, InterruptedError):
+                if not isinstance(head, memoryview):
+                    chunks[0] = memoryview(head)
+                break
+            self.size -= sent
+            if sent < len(head):
+                chunks[0] = memoryview(head)[sent:]
+                break
+            chunks.popleft()
+        return self.size
+
+def recv_tls(sock):
+    # sock.recv for an ssl.SSLSocket: everything readable now, up to about
+    # RECV_SIZE.  None if no whole record has arrived yet, b'' at the end of
+    # the stream.  OpenSSL may already hold decrypted bytes that select will
+    # never report, so it is read until it has nothing pending
+    try:
+        data = sock.recv(RECV_SIZE)
+    except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+        return None
+    if not data:
+        return data
+    chunks = None
+    size = len(data)
+    while size < RECV_SIZE or sock.pending():
+        try:
+            more = sock.recv(max(RECV_SIZE - size, sock.pending()))
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            break
+        if not more:
+            # End of stream - the next read reports it
+            break
+        if chunks is None:
+            chunks = [data]
+        chunks.append(more)
+        size += len(more)
+    return data if chunks is None else b''.join(chunks)
@@ -1,101 +1,408 @@
 # Miguel Delapaz - CS594 - IRC Server Project
+import argparse
+import bisect
+import heapq
+import logging
 import socket
-import select
+import selectors
 import sys
-from enum import Enum
-try:
-    import queue
-except ImportError:
-    import Queue as queue
-
-class Command(Enum):
-    LOGIN = 1
-    LOGOUT = 2
-    ADD_CHANNEL = 3
-    JOIN_CHANNEL = 4
-    LEAVE_CHANNEL = 5
-    LIST_ROOMS = 6
-    LIST_USERS = 7
-    MESSAGE = 8
-
-class ResponseCodes(Enum):
-    OK = 0
-    ERROR = 4
+import time
+from irc_history import History
+from irc_limits import RateLimiter, FLOOD_POLICIES, add_rate_limit_arguments, make_rate_limits
+from irc_timers import TimerWheel
+from irc_protocol import Command, ResponseCodes, OutputBuffer, ProtocolError, encode_response, make_decoder, decompress_payload, RECV_SIZE, MAX_LIST_PAGE, MAX_CHANNELS_PER_REQUEST, BINARY_MAGIC, FLAG_ACCEPT_COMPRESSION, FLAG_COMPRESSED, FRAMINGS, FRAMING_BINARY, FRAMING_COMPRESSED, FRAMING_LEGACY
+
+# Event loop backends, best first.  Only the ones this platform provides are
+# listed; 'default' is whatever selectors.DefaultSelector picks (epoll on Linux)
+SELECTOR_BACKENDS = {'default': selectors.DefaultSelector}
+for _name, _cls in (('epoll', 'EpollSelector'), ('kqueue', 'KqueueSelector'),
+                    ('devpoll', 'DevpollSelector'), ('poll', 'PollSelector'),
+                    ('select', 'SelectSelector')):
+    if hasattr(selectors, _cls):
+        SELECTOR_BACKENDS[_name] = getattr(selectors, _cls)
+
+log = logging.getLogger('irc_server')
+
+LOGIN_CODE = Command.LOGIN.value
+# The only requests accepted before login
+PRE_LOGIN_CODES = (LOGIN_CODE, Command.PING.value, Command.PONG.value)
+
+# What to do with a client whose output queue goes over the high watermark:
+# stop reading its requests until it catches up, throw away its oldest queued
+# frames, or disconnect it
+OVERFLOW_POLICIES = ('pause', 'drop-oldest', 'disconnect')
+
+def make_selector(backend='default'):
+    if backend not in SELECTOR_BACKENDS:
+        raise ValueError("Unknown event loop backend " + backend + " - choose from " + ", ".join(SELECTOR_BACKENDS))
+    return SELECTOR_BACKENDS[backend]()
+
+def remove_sorted(names, name):
+    i = bisect.bisect_left(names, name)
+    if i < len(names) and names[i] == name:
+        del names[i]
+
+def select_names(names, prefix, offset, limit):
+    # names is sorted, so the ones starting with prefix are one contiguous
+    # run.  Returns that page of them and the offset of the next page, or
+    # None if this is the last one
+    start = 0
+    end = len(names)
+    if prefix:
+        start = bisect.bisect_left(names, prefix)
+        # First string past every string starting with prefix
+        end = bisect.bisect_left(names, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+    first = min(start + offset, end)
+    stop = min(first + limit, end)
+    return names[first:stop], (stop - start if stop < end else None)
+
+def parse_list_query(query):
+    # "prefix\noffset\nlimit" - see irc_protocol.  Returns None if malformed
+    fields = query.split('\n')
+    if len(fields) > 3:
+        return None
+    try:
+        offset = int(fields[1]) if len(fields) > 1 and fields[1] else 0
+        limit = int(fields[2]) if len(fields) > 2 and fields[2] else MAX_LIST_PAGE
+    except ValueError:
+        return None
+    if offset < 0 or limit <= 0:
+        return None
+    return fields[0], offset, min(limit, MAX_LIST_PAGE)
 
 class Server:
-    def __init__(self):
+    def __init__(self, port=6000, selector=None, backlog=socket.SOMAXCONN, reusePort=False,
+                 highWater=1024 * 1024, lowWater=256 * 1024, hardLimit=16 * 1024 * 1024,
+                 overflowPolicy='pause', listenSocket=None, historyDepth=50, historyBytes=64 * 1024 * 1024,
+                 compression=True, pingInterval=60, idleTimeout=180, loginTimeout=30,
+                 rateLimits=None, floodPolicy='delay'):
         self.channelList = {}
         self.clientList = {}
-        self.port = 6000
-        self.readList = []
-        self.writeList = []
+        # Logged in username -> Client
+        self.userList = {}
+        # Usernames logged in on other workers (or federated nodes) -> the
+        # worker they are on
+        self.remoteUserList = {}
+        # Channel names in sorted order, patched as channels come and go, and
+        # the encoded full LIST_ROOMS response for each framing, dropped on
+        # any change.  Clients poll the lists a lot more often than they change
+        self.roomNames = []
+        self.roomListFrames = [None] * FRAMINGS
+        self.port = port
+        self.backlog = backlog
+        self.reusePort = reusePort
+        # Per connection output queue limits, in bytes.  Over highWater the
+        # overflow policy kicks in; reads resume once the queue is back under
+        # lowWater.  Anyone over hardLimit is dropped whatever the policy.
+        # The frame being written and the newest one don't count (see
+        # OutputBuffer.backlog), so a single big message fits whatever the limits
+        if overflowPolicy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy " + overflowPolicy)
+        if hardLimit < highWater:
+            raise ValueError("Hard limit must be at least the high watermark")
+        if lowWater > highWater:
+            raise ValueError("Low watermark must not be over the high watermark")
+        self.highWater = highWater
+        self.lowWater = lowWater
+        self.hardLimit = hardLimit
+        self.overflowPolicy = overflowPolicy
+        # Whether binary clients that offer compression at LOGIN get it
+        self.compression = compression
+        # Seconds a client may go without sending anything before we PING
+        # it, before we give up on it, and to log in after connecting.
+        # 0 turns any of them off
+        self.pingInterval = pingInterval
+        self.idleTimeout = idleTimeout
+        self.loginTimeout = loginTimeout
+        # Per client frame rate limits (see irc_limits), None for no limits,
+        # and what happens to a client that goes over them
+        if floodPolicy not in FLOOD_POLICIES:
+            raise ValueError("Unknown flood policy " + floodPolicy)
+        self.limiter = RateLimiter(rateLimits) if rateLimits else None
+        self.floodPolicy = floodPolicy
+        # Clients to disconnect once the current batch of events is handled -
+        # they can't be closed while a broadcast is walking a channel
+        self.closeList = []
+        # Clients with frames queued during this loop iteration.  They are all
+        # written at the end of it - see flush_dirty_clients
+        self.dirtyClients = set()
+        self.running = True
+        # Time as of the latest wakeup, and everything that has to happen
+        # at some point later - client timeouts, restore expiry, redials
+        self.now = time.monotonic()
+        self.timers = TimerWheel(self.now)
+        # Link to the other workers when running in multi-process mode (see
+        # irc_cluster), or to the other nodes when federated (irc_federation)
+        self.bus = None
+        # Recent messages per channel, replayed to new members.  None if turned off
+        self.history = History(historyDepth, historyBytes) if historyDepth > 0 else None
+        # irc_metrics.Metrics when stats are turned on
+        self.metrics = None
+        # irc_state.Journal when channel state is persisted
+        self.journal = None
+        # irc_tls.TLSAcceptor when the client port speaks TLS.  New
+        # connections then handshake there first, and are added as whatever
+        # clientClass it sets
+        self.tls = None
+        self.clientClass = Client
+        # Memberships read back from the journal at startup: username -> set
+        # of channel names.  Users are put back in their channels when they
+        # log in again, as long as they do so within the restore window
+        self.restoredMembers = {}
+        # Request handlers indexed by the raw command code off the wire, so
+        # dispatching a frame is a list lookup rather than an Enum conversion
+        # and a walk down an if/elif chain
+        self.handlers = [None] * 256
+        self.handlers[Command.LOGIN.value] = self.process_join_server
+        self.handlers[Command.LOGOUT.value] = self.process_logout
+        self.handlers[Command.ADD_CHANNEL.value] = self.process_add_channel
+        self.handlers[Command.JOIN_CHANNEL.value] = self.process_join_channel
+        self.handlers[Command.LEAVE_CHANNEL.value] = self.process_leave_channel
+        self.handlers[Command.LIST_ROOMS.value] = self.process_list_rooms
+        self.handlers[Command.LIST_USERS.value] = self.process_list_participants
+        self.handlers[Command.MESSAGE.value] = self.process_message_channel
+        self.handlers[Command.PING.value] = self.process_ping
+        self.handlers[Command.PONG.value] = self.process_pong
+        self.handlers[Command.JOIN_MANY.value] = self.process_join_many
+        self.handlers[Command.LEAVE_MANY.value] = self.process_leave_many
+        self.handlers[Command.MESSAGE_MANY.value] = self.process_message_many
+        # Sockets are registered once and their interest is modified in place,
+        # so a wakeup costs O(ready sockets) rather than O(connected sockets)
+        self.selector = selector if selector is not None else make_selector()
+        # A listening socket inherited from a previous server - see irc_state
+        self.listenSocket = listenSocket
         self.initialize_listen_socket()
 
     def initialize_listen_socket(self):
+        if self.listenSocket is not None:
+            self.listenSocket.setblocking(False)
+            self.port = self.listenSocket.getsockname()[1]
+            self.selector.register(self.listenSocket, selectors.EVENT_READ, None)
+            log.info("Took over listening socket on port %d", self.port)
+            return
         self.listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reusePort:
+            # Every worker binds its own socket to the same port and the
+            # kernel spreads incoming connections between them
+            self.listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.listenSocket.setblocking(False)
         self.listenSocket.bind(('', self.port))
-        self.listenSocket.listen(5)
-        self.readList.append(self.listenSocket)
-        print("Server listening socket created on port " + str(self.port))
+        self.listenSocket.listen(self.backlog)
+        # Port 0 asks the OS for a free port - record the one we got
+        self.port = self.listenSocket.getsockname()[1]
+        self.selector.register(self.listenSocket, selectors.EVENT_READ, None)
+        log.info("Server listening socket created on port %d", self.port)
 
     def process_add_channel(self, client, channelName):
         if len(channelName) > 10 or not channelName.isalnum():
-            self.response(client, Command.ADD_CHANNEL, ResponseCodes.ERROR, "Invalid Channel - " + channelName + " - Must be alphanumeric and less than 10 characters")
+            self.send_response(client, Command.ADD_CHANNEL, ResponseCodes.ERROR, "Invalid Channel - " + channelName + " - Must be alphanumeric and less than 10 characters")
         else:
             if channelName in self.channelList:
                 self.send_response(client, Command.ADD_CHANNEL, ResponseCodes.ERROR, "Channel " + channelName + " already exists")
             else:
-                newChan = Channel(channelName)
-                self.channelList[channelName] = newChan
+                self.create_channel(channelName)
+                if self.journal is not None:
+                    self.journal.add_channel(channelName)
                 self.send_response(client, Command.ADD_CHANNEL, ResponseCodes.OK, channelName)
                 self.process_join_channel(client, channelName)
 
     def process_join_channel(self, client, channelName):
-        if not channelName in self.channelList:
-            self.send_response(client, Command.JOIN_CHANNEL, ResponseCodes.ERROR, "Channel " + channelName + " does not exist")
+        error = self.join_channel(client, channelName)
+        if error is not None:
+            self.send_response(client, Command.JOIN_CHANNEL, ResponseCodes.ERROR, error)
         else:
+            self.send_response(client, Command.JOIN_CHANNEL, ResponseCodes.OK, channelName)
             channel = self.channelList[channelName]
-            if client in channel.users:
-                self.send_response(client, Command.JOIN_CHANNEL, ResponseCodes.ERROR, "Already in the channel " + channelName)
+            if channel.history:
+                self.send_history(client, channel)
+
+    def process_join_many(self, client, data):
+        names = data.split()
+        if not names or len(names) > MAX_CHANNELS_PER_REQUEST:
+            self.send_response(client, Command.JOIN_MANY, ResponseCodes.ERROR, "Expected 1 to " + str(MAX_CHANNELS_PER_REQUEST) + " channel names")
+            return
+        lines = []
+        joined = []
+        for channelName in names:
+            error = self.join_channel(client, channelName)
+            if error is None:
+                lines.append(channelName)
+                joined.append(self.channelList[channelName])
             else:
-                channel.users.append(client)
-                self.send_response(client, Command.JOIN_CHANNEL, ResponseCodes.OK, channelName)
+                lines.append(channelName + ' ' + error)
+        responseCode = ResponseCodes.OK if len(joined) == len(names) else ResponseCodes.ERROR
+        self.send_response(client, Command.JOIN_MANY, responseCode, '\n'.join(lines))
+        # History goes out behind the response, as for JOIN_CHANNEL
+        for channel in joined:
+            if channel.history:
+                self.send_history(client, channel)
 
-    def process_leave_channel(self, client, channelName):
+    def join_channel(self, client, channelName):
+        # Returns why not, or None once the client is in the channel
         if not channelName in self.channelList:
-            self.send_response(client, Command.LEAVE_CHANNEL, ResponseCodes.ERROR, "Channel " + channelName + " does not exist")
+            return "Channel " + channelName + " does not exist"
+        channel = self.channelList[channelName]
+        if client in channel.users:
+            return "Already in the channel " + channelName
+        channel.users.add(client)
+        channel.add_name(client.name)
+        if not client.channels:
+            client.channels = set()
+        client.channels.add(channel)
+        if self.journal is not None:
+            self.journal.join(channelName, client.name)
+        if self.bus:
+            self.bus.publish_join(channelName, client.name)
+        return None
+
+    def send_history(self, client, channel):
+        # The channel's recent messages go out right behind the JOIN response,
+        # as many as fit under the client's high watermark
+        outbound = client.outbound
+        frames = self.history.replay(channel, client.framing, self.highWater - (outbound.size if outbound else 0))
+        if frames:
+            for data in frames:
+                self.queue_frame(client, data)
+            if self.metrics is not None:
+                self.metrics.record_frames_out(Command.MESSAGE.value, len(frames))
+
+    def process_leave_channel(self, client, channelName):
+        error = self.leave_channel(client, channelName)
+        if error is not None:
+            self.send_response(client, Command.LEAVE_CHANNEL, ResponseCodes.ERROR, error)
         else:
-            channel = self.channelList[channelName]
-            if not client in channel.users:
-                self.send_response(client, Command.LEAVE_CHANNEL, ResponseCodes.ERROR, "Not in the channel " + channelName)
+            self.send_response(client, Command.LEAVE_CHANNEL, ResponseCodes.OK, channelName)
+
+    def process_leave_many(self, client, data):
+        names = data.split()
+        if not names or len(names) > MAX_CHANNELS_PER_REQUEST:
+            self.send_response(client, Command.LEAVE_MANY, ResponseCodes.ERROR, "Expected 1 to " + str(MAX_CHANNELS_PER_REQUEST) + " channel names")
+            return
+        lines = []
+        failed = False
+        for channelName in names:
+            error = self.leave_channel(client, channelName)
+            if error is None:
+                lines.append(channelName)
             else:
-                channel.users.remove(client)
-                self.send_response(client, Command.LEAVE_CHANNEL, ResponseCodes.OK, channelName)
-
-                # Remove channel if it is empty
-                if not channel.users:
-                    del(self.channelList[channelName])
-
-    def process_list_rooms(self, client):
-        response = ''
-        for c in self.channelList:
-            channel = self.channelList[c]
-            response += channel.name + '\n'
-        self.send_response(client, Command.LIST_ROOMS, ResponseCodes.OK, response)
-
-    def process_list_participants(self, client, channelName):
-        response = channelName + '\n'
+                lines.append(channelName + ' ' + error)
+                failed = True
+        self.send_response(client, Command.LEAVE_MANY, ResponseCodes.ERROR if failed else ResponseCodes.OK, '\n'.join(lines))
+
+    def leave_channel(self, client, channelName):
+        # Returns why not, or None once the client is out of the channel
+        if not channelName in self.channelList:
+            return "Channel " + channelName + " does not exist"
+        channel = self.channelList[channelName]
+        if not client in channel.users:
+            return "Not in the channel " + channelName
+        channel.users.discard(client)
+        channel.remove_name(client.name)
+        client.channels.discard(channel)
+        if self.journal is not None:
+            self.journal.leave(channelName, client.name)
+        if self.bus:
+            self.bus.publish_leave(channelName, client.name)
+
+        # Remove channel if it is empty
+        if not channel.users and not channel.remoteUsers:
+            self.remove_channel(channel)
+        return None
+
+    def create_channel(self, channelName):
+        channel = Channel(channelName)
+        self.channelList[channelName] = channel
+        bisect.insort(self.roomNames, channelName)
+        self.roomListFrames = [None] * FRAMINGS
+        return channel
+
+    def remove_channel(self, channel):
+        del self.channelList[channel.name]
+        remove_sorted(self.roomNames, channel.name)
+        self.roomListFrames = [None] * FRAMINGS
+        if self.journal is not None:
+            self.journal.remove_channel(channel.name)
+        if channel.history is not None:
+            self.history.discard(channel)
+
+    def restore_channels(self, channels, members, window):
+        # State read back from the journal.  channels is every channel name,
+        # members maps channel name -> usernames that were in it.  Nobody is
+        # connected yet, so members only rejoin when they log in again
+        for channelName in channels:
+            self.channelList[channelName] = Channel(channelName)
+        self.roomNames = sorted(self.channelList)
+        self.roomListFrames = [None] * FRAMINGS
+        for channelName, usernames in members.items():
+            for username in usernames:
+                self.restoredMembers.setdefault(username, set()).add(channelName)
+        if self.restoredMembers:
+            self.timers.schedule(self.now, window, self.expire_restored_members)
+
+    def process_restored_member(self, client):
+        for channelName in sorted(self.restoredMembers.pop(client.name)):
+            if channelName in self.channelList and client not in self.channelList[channelName].users:
+                self.process_join_channel(client, channelName)
+
+    def expire_restored_members(self):
+        # Whoever hasn't come back by now isn't getting their channels back.
+        # Channels nobody returned to go the same way as any empty channel
+        self.restoredMembers = {}
+        for channel in list(self.channelList.values()):
+            if not channel.users and not channel.remoteUsers:
+                self.remove_channel(channel)
+
+    def process_list_rooms(self, client, query=''):
+        if not query:
+            self.send_list(client, self.roomListFrames, Command.LIST_ROOMS, self.roomNames, '')
+            return
+        query = parse_list_query(query)
+        if query is None:
+            self.send_response(client, Command.LIST_ROOMS, ResponseCodes.ERROR, "Invalid list request")
+        else:
+            self.send_list_page(client, Command.LIST_ROOMS, self.roomNames, '', *query)
+
+    def process_list_participants(self, client, data):
+        channelName, _, query = data.partition('\n')
         if not channelName in self.channelList:
             self.send_response(client, Command.LIST_USERS, ResponseCodes.ERROR, "Channel " + channelName + " does not exist")
+            return
+        channel = self.channelList[channelName]
+        if not query:
+            self.send_list(client, channel.listFrames, Command.LIST_USERS, channel.names, channelName + '\n')
+            return
+        query = parse_list_query(query)
+        if query is None:
+            self.send_response(client, Command.LIST_USERS, ResponseCodes.ERROR, "Invalid list request")
         else:
-            channel = self.channelList[channelName]
-            for u in channel.users:
-                response += u.name + '\n'
-            self.send_response(client, Command.LIST_USERS, ResponseCodes.OK, response)
+            self.send_list_page(client, Command.LIST_USERS, channel.names, channelName + '\n', *query)
+
+    def send_list(self, client, frames, commandCode, names, heading):
+        # frames caches the encoded response per framing - the list is only
+        # joined and encoded again after it has changed
+        data = frames[client.framing]
+        if data is None:
+            try:
+                data = encode_response(client.framing, commandCode, ResponseCodes.OK,
+                                       heading + ''.join([name + '\n' for name in names]))
+            except ProtocolError:
+                data = encode_response(client.framing, commandCode, ResponseCodes.ERROR,
+                                       "List too long - ask for it a page at a time")
+            frames[client.framing] = data
+        self.queue_frame(client, data)
+        if self.metrics is not None:
+            self.metrics.record_frames_out(commandCode.value, 1)
+
+    def send_list_page(self, client, commandCode, names, heading, prefix, offset, limit):
+        page, nextOffset = select_names(names, prefix, offset, limit)
+        response = heading + ''.join([name + '\n' for name in page])
+        if nextOffset is not None:
+            response += '+' + str(nextOffset) + '\n'
+        self.send_response(client, commandCode, ResponseCodes.OK, response)
 
     def process_message_channel(self, client, data):
-        channelName, message = data.split('\n', 1)
+        channelName, _, message = data.partition('\n')
         if not channelName in self.channelList:
             self.send_response(client, Command.MESSAGE, ResponseCodes.ERROR, "Channel " + channelName + " does not exist")
         elif message == '':
@@ -103,158 +410,801 @@ class Server:
         else:
             channel = self.channelList[channelName]
             response = channelName + '\n' + client.name + '\n' + message
-            for c in channel.users:
-                self.send_response(c, Command.MESSAGE, ResponseCodes.OK, response)
+            frames = self.broadcast(channel.users, Command.MESSAGE, ResponseCodes.OK, response)
+            if self.history is not None:
+                self.history.record(channel, frames, response)
+            if self.bus and channel.remoteUsers:
+                # Only the workers with members in this channel get a copy
+                self.bus.publish_message(channel.remoteUsers, channelName, response)
+
+    def process_message_many(self, client, data):
+        names, _, message = data.partition('\n')
+        # Naming a channel twice doesn't send the message twice
+        names = list(dict.fromkeys(names.split()))
+        if not names or len(names) > MAX_CHANNELS_PER_REQUEST:
+            self.send_response(client, Command.MESSAGE_MANY, ResponseCodes.ERROR, "Expected 1 to " + str(MAX_CHANNELS_PER_REQUEST) + " channel names")
+            return
+        if message == '':
+            self.send_response(client, Command.MESSAGE_MANY, ResponseCodes.ERROR, "Cannot send empty message")
+            return
+        for channelName in names:
+            if not channelName in self.channelList:
+                self.send_response(client, Command.MESSAGE_MANY, ResponseCodes.ERROR, "Channel " + channelName + " does not exist")
+                return
+        channels = [self.channelList[channelName] for channelName in names]
+        body = client.name + '\n' + message
+        self.broadcast_many(channels, body)
+        if self.bus:
+            peers = set()
+            for channel in channels:
+                peers.update(channel.remoteUsers)
+            if peers:
+                self.bus.publish_message_many(peers, names, body)
+
+    def broadcast_many(self, channels, body):
+        # body is the sender and message.  Each channel's members get it as
+        # that channel's MESSAGE, minus anyone an earlier channel already
+        # reached, so the frames are still encoded once per channel and
+        # framing and shared by everyone they go to
+        seen = None
+        for channel in channels:
+            response = channel.name + '\n' + body
+            users = channel.users
+            recipients = users if seen is None else users - seen
+            frames = self.broadcast(recipients, Command.MESSAGE, ResponseCodes.OK, response)
+            if self.history is not None:
+                self.history.record(channel, frames, response)
+            if seen is None:
+                seen = set(users)
+            else:
+                seen |= users
+
+    def process_logout(self, client, data):
+        self.process_leave_server(client)
+
+    def process_ping(self, client, data):
+        self.send_response(client, Command.PONG, ResponseCodes.OK, data)
+
+    def process_pong(self, client, data):
+        # Hearing from the client at all is what counts - see check_client
+        pass
 
     def process_leave_server(self, client):
-        channelsToRemove = []
-        for c in self.channelList:
-            channel = self.channelList[c]
-            if client in channel.users:
-                channel.users.remove(client)
-                # Remove channel if it is empty
-                if not channel.users:
-                    channelsToRemove.append(c)
-        for c in channelsToRemove:
-            del(self.channelList[c])
-        if client.sock in self.writeList:
-            self.writeList.remove(client.sock)
-        self.readList.remove(client.sock)
+        if client.timer is not None:
+            self.timers.cancel(client.timer)
+        # Only visit the channels this client is actually in
+        for channel in client.channels:
+            channel.users.discard(client)
+            channel.remove_name(client.name)
+            if self.journal is not None:
+                self.journal.leave(channel.name, client.name)
+            if self.bus:
+                self.bus.publish_leave(channel.name, client.name)
+            # Remove channel if it is empty
+            if not channel.users and not channel.remoteUsers:
+                self.remove_channel(channel)
+        client.channels = ()
+        if client.LoggedIn and self.userList.get(client.name) is client:
+            del self.userList[client.name]
+            if self.bus:
+                self.bus.publish_logout(client.name)
+        self.close_client(client)
+
+    def close_client(self, client):
+        if self.metrics is not None:
+            self.metrics.disconnects += 1
+        if client.events:
+            self.selector.unregister(client.sock)
         client.sock.close()
         del self.clientList[client.sock]
 
     def process_join_server(self, client, username):
         if len(username) > 10 or not username.isalnum():
-            self.send_response(client, ResponseCodes.ERROR, "Invalid Username - Must be alphanumeric and less than 10 characters")
+            self.send_response(client, Command.LOGIN, ResponseCodes.ERROR, "Invalid Username - Must be alphanumeric and less than 10 characters")
+            return ResponseCodes.ERROR
+        if (username in self.userList and self.userList[username] is not client) or username in self.remoteUserList:
+            self.send_response(client, Command.LOGIN, ResponseCodes.ERROR, "Username " + username + " is already in use")
             return ResponseCodes.ERROR
+        if client.LoggedIn:
+            del self.userList[client.name]
+            for channel in client.channels:
+                channel.remove_name(client.name)
+                channel.add_name(username)
+                if self.journal is not None:
+                    self.journal.leave(channel.name, client.name)
+                    self.journal.join(channel.name, username)
+            if self.bus:
+                # Renamed - move our channel memberships over to the new name
+                self.bus.publish_logout(client.name)
+                for channel in client.channels:
+                    self.bus.publish_leave(channel.name, client.name)
+                    self.bus.publish_join(channel.name, username)
         client.name = username
         client.LoggedIn = True
-        self.send_response(client, Command.LOGIN, ResponseCodes.OK, None)
+        self.userList[username] = client
+        if self.bus:
+            self.bus.publish_login(username)
+        flags = FLAG_ACCEPT_COMPRESSION if client.framing == FRAMING_COMPRESSED else 0
+        self.send_response(client, Command.LOGIN, ResponseCodes.OK, None, flags)
+        if username in self.restoredMembers:
+            self.process_restored_member(client)
 
-    def process_incoming_data(self, socket):
-        client = self.clientList[socket]
+    def process_incoming_data(self, sock):
+        client = self.clientList[sock]
         try:
-            command = socket.recv(1)
-        except:
-            print("Client at " + str(client.addr) + " encounterd an error")
+            data = client.receive()
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            log.info("Client at %s encounterd an error", client.addr)
             self.process_leave_server(client)
             return
 
-        if not command:
+        if not data:
+            if data is None:
+                # TLS - no whole record yet
+                return
             # Client disconnected
-            print("Client at " + str(client.addr) + " disconnected")
+            log.debug("Client at %s disconnected", client.addr)
             self.process_leave_server(client)
             return
-        else:
-            try:
-                command = int(command)
-                length = int(socket.recv(5))
-                if length > 0:
-                    data = socket.recv(length)
-            except:
-                print("Client at " + str(client.addr) + " encounterd an error")
-                self.process_leave_server(client)
-                return
 
-        if command == Command.LOGIN:
-            self.process_join_server(client, data)
-        elif not client.LoggedIn:
-            send_response(client, command, ResponseCodes.ERROR, "Command not valid before login")
-        elif command == Command.LOGOUT:
+        if self.metrics is not None:
+            self.metrics.bytesIn += len(data)
+
+        self.process_received_data(client, data)
+
+    def process_received_data(self, client, data):
+        client.lastActive = self.now
+        if client.decoder is None:
+            # The first byte on a connection picks the framing for the session
+            if data[0] == BINARY_MAGIC:
+                client.framing = FRAMING_BINARY
+            client.decoder = make_decoder(client.framing)
+
+        # One read can carry several pipelined frames - handle all of them
+        try:
+            frames = client.decoder.feed(data)
+        except ProtocolError as e:
+            log.warning("Client at %s sent a malformed frame: %s", client.addr, e)
             self.process_leave_server(client)
-        elif command == Command.ADD_CHANNEL:
-            self.process_add_channel(client, data)
-        elif command == Command.JOIN_CHANNEL:
-            self.process_join_channel(client, data)
-        elif command == Command.LEAVE_CHANNEL:
-            self.process_leave_channel(client, data)
-        elif command == Command.LIST_ROOMS:
-            self.process_list_rooms(client)
-        elif command == Command.LIST_USERS:
-            self.process_list_participants(client, data)
-        elif command == Command.MESSAGE:
-            self.process_message_channel(client, data)
-        elif command == Command.RESPONSE:
-            # Client shouldn't be sending response messages
-            send_response(client, command, ResponseCodes.ERROR, "Response messages are reserved for the server")
-        else:
+            return
+
+        if client.held is not None:
+            # Still waiting out a rate limit - these queue up behind the rest
+            client.held.extend(frames)
+            return
+        self.process_frames(client, frames)
+
+    def process_frames(self, client, frames):
+        metrics = self.metrics
+        limiter = self.limiter
+        for i, (command, status, flags, payload) in enumerate(frames):
+            if limiter is not None:
+                # Before anything else is spent on the frame
+                wait = limiter.check(client, command, self.now)
+                if wait:
+                    self.process_flood(client, frames, i, wait)
+                    return
+            if flags:
+                payload = self.process_frame_flags(client, command, flags, payload)
+                if payload is None:
+                    self.process_leave_server(client)
+                    return
+            if metrics is None:
+                self.process_command(client, command, payload.decode('utf-8', 'replace'))
+            else:
+                start = time.perf_counter()
+                self.process_command(client, command, payload.decode('utf-8', 'replace'))
+                metrics.record_command(command, time.perf_counter() - start)
+            if client.sock not in self.clientList:
+                # Logged out part way through the batch
+                return
+
+    def process_flood(self, client, frames, index, wait):
+        # frames[index] is over one of the client's limits and may go in
+        # wait seconds
+        if self.metrics is not None:
+            self.metrics.rateLimited += 1
+        if self.floodPolicy == 'disconnect':
+            log.warning("Client at %s is sending too fast - disconnecting", client.addr)
+            self.schedule_close(client)
+            return
+        # Hold on to the rest of the batch and stop reading until then.  A
+        # flooding client ends up waiting on its own socket buffer
+        client.held = frames[index:]
+        self.pause_reading(client)
+        self.timers.schedule(self.now, wait, self.release_held, client)
+
+    def release_held(self, client):
+        if client.held is None or client.sock not in self.clientList:
+            return
+        frames = client.held
+        client.held = None
+        self.process_frames(client, frames)
+        if client.held is None and client.sock in self.clientList:
+            self.resume_reading(client)
+
+    def process_frame_flags(self, client, command, flags, payload):
+        # Returns the payload to hand on, or None if the client has to go
+        if flags & FLAG_ACCEPT_COMPRESSION and command == LOGIN_CODE and self.compression:
+            # Broadcasts to this client use the compressed frames from now on
+            client.framing = FRAMING_COMPRESSED
+        if flags & FLAG_COMPRESSED:
+            if client.framing != FRAMING_COMPRESSED:
+                log.warning("Client at %s sent a compressed frame without asking for compression", client.addr)
+                return None
+            try:
+                payload = decompress_payload(payload)
+            except ProtocolError as e:
+                log.warning("Client at %s sent a malformed frame: %s", client.addr, e)
+                return None
+        return payload
+
+    def process_command(self, client, command, data):
+        handler = self.handlers[command]
+        if handler is None:
             # We don't know what this code is
-            send_response(client, command, ResponseCodes.ERROR, "Unrecognized command code")
+            self.send_response(client, command, ResponseCodes.ERROR, "Unrecognized command code")
+        elif not client.LoggedIn and command not in PRE_LOGIN_CODES:
+            self.send_response(client, command, ResponseCodes.ERROR, "Command not valid before login")
+        else:
+            handler(client, data)
+
+    # State changes reported by other workers over the bus.  Remote members
+    # are only tracked by name - their sockets belong to the other worker
+    def process_remote_login(self, peer, username):
+        # Two workers can each let the same name in before hearing about the
+        # other's login, or find they both have it when a link comes back.
+        # Either way the lower id keeps it and the other drops its user
+        client = self.userList.get(username)
+        if client is not None:
+            if self.bus.nodeId < peer:
+                return
+            log.warning("Username %s is taken on %s %s - disconnecting ours", username, self.bus.peerKind, peer)
+            self.send_response(client, Command.LOGIN, ResponseCodes.ERROR, "Username " + username + " is already in use")
+            # Straight away, and with whatever the socket will take of the
+            # error - a client waiting in closeList isn't written to again
+            try:
+                client.send_outgoing_data()
+            except OSError:
+                pass
+            self.process_leave_server(client)
+        owner = self.remoteUserList.get(username)
+        if owner is None or peer < owner:
+            self.remoteUserList[username] = peer
+
+    def process_remote_logout(self, peer, username):
+        if self.remoteUserList.get(username) == peer:
+            del self.remoteUserList[username]
+
+    def process_remote_join(self, peer, channelName, username):
+        channel = self.channelList.get(channelName)
+        if channel is None:
+            channel = self.create_channel(channelName)
+        users = channel.remoteUsers.setdefault(peer, set())
+        if username not in users:
+            users.add(username)
+            channel.add_name(username)
+
+    def process_remote_leave(self, peer, channelName, username):
+        channel = self.channelList.get(channelName)
+        if channel is None:
+            return
+        users = channel.remoteUsers.get(peer)
+        if users is not None and username in users:
+            users.discard(username)
+            channel.remove_name(username)
+            if not users:
+                del channel.remoteUsers[peer]
+        if not channel.users and not channel.remoteUsers:
+            self.remove_channel(channel)
+
+    def process_remote_message(self, peer, channelName, response):
+        channel = self.channelList.get(channelName)
+        if channel is not None:
+            frames = self.broadcast(channel.users, Command.MESSAGE, ResponseCodes.OK, response)
+            if self.history is not None:
+                self.history.record(channel, frames, response)
+
+    def process_remote_message_many(self, peer, channelNames, body):
+        # Dedup is per node - the sending node forwards one copy, however
+        # many of the channels our members are in
+        channels = [self.channelList[name] for name in channelNames if name in self.channelList]
+        if channels:
+            self.broadcast_many(channels, body)
+
+    def process_peer_lost(self, peer):
+        # A worker went away - forget everything we knew about its users
+        for channelName in list(self.channelList):
+            channel = self.channelList[channelName]
+            if peer in channel.remoteUsers:
+                for username in channel.remoteUsers.pop(peer):
+                    channel.remove_name(username)
+                if not channel.users and not channel.remoteUsers:
+                    self.remove_channel(channel)
+        for username in [u for u in self.remoteUserList if self.remoteUserList[u] == peer]:
+            del self.remoteUserList[username]
 
     def process_incoming_connection(self):
-        c, addr = self.listenSocket.accept()
-        c.setblocking(False)
-        print("Received connection from client at " + str(addr))
-        self.readList.append(c)
-        server.clientList[c] = Client(c, addr)
+        # Drain the whole accept backlog in one wakeup so a connect burst
+        # doesn't cost one trip through the event loop per client
+        while True:
+            try:
+                c, addr = self.listenSocket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of descriptors or the peer gave up before we got to it -
+                # leave the rest of the backlog for the next wakeup
+                log.warning("Error accepting connection: %s", e)
+                return
+            log.debug("Received connection from client at %s", addr)
+            if self.metrics is not None:
+                self.metrics.connectionsAccepted += 1
+            if self.tls is not None:
+                self.tls.accept(c, addr)
+            else:
+                self.add_client(c, addr)
+
+    def add_client(self, sock, addr):
+        sock.setblocking(False)
+        client = self.clientClass(sock, addr)
+        self.clientList[sock] = client
+        self.selector.register(sock, selectors.EVENT_READ, client)
+        self.start_client_timer(client)
+        return client
+
+    def start_client_timer(self, client):
+        # One timer per connection, moved along by check_client rather than
+        # on every read - a read only notes the time in client.lastActive
+        client.lastActive = self.now
+        delay = self.loginTimeout or self.next_check_delay(0)
+        if delay is not None:
+            client.timer = self.timers.schedule(self.now, delay, self.check_client, client)
+
+    def next_check_delay(self, idle):
+        # Seconds from now until a client quiet for idle seconds needs
+        # looking at again, or None if never
+        delays = []
+        if self.pingInterval:
+            delays.append(self.pingInterval - idle if idle < self.pingInterval else self.pingInterval)
+        if self.idleTimeout:
+            delays.append(self.idleTimeout - idle)
+        return min(delays) if delays else None
+
+    def check_client(self, client):
+        if client.closing:
+            return
+        if not client.LoggedIn and self.loginTimeout:
+            log.info("Client at %s did not log in in time - disconnecting", client.addr)
+            self.expire_client(client)
+            return
+        idle = self.now - client.lastActive
+        if self.idleTimeout and idle >= self.idleTimeout:
+            log.info("Client at %s went quiet for %d seconds - disconnecting", client.addr, idle)
+            self.expire_client(client)
+            return
+        if self.pingInterval and idle >= self.pingInterval:
+            # Anything it sends back (the PONG, or any other request) counts
+            self.send_response(client, Command.PING, ResponseCodes.OK, None)
+        delay = self.next_check_delay(idle)
+        if delay is not None:
+            self.timers.reschedule(client.timer, self.now, delay)
+
+    def expire_client(self, client):
+        if self.metrics is not None:
+            self.metrics.timeouts += 1
+        self.schedule_close(client)
 
     def process_client_exception(self, sock):
-        client = self.clientList[socket]
-        print("Client at " + client.addr + " encountered socket exception - closing")
+        client = self.clientList[sock]
+        log.info("Client at %s encountered socket exception - closing", client.addr)
         self.process_leave_server(client)
 
-    def send_response(self, client, commandCode, responseCode, message):
-        # Packet is one byte of command code, 5 bytes of length (string form)
-        # followed by the data
-        if message and len(message) >= 99999:
-            print("Message too long")
+    def send_response(self, client, commandCode, responseCode, message, flags=0):
+        try:
+            data = encode_response(client.framing, commandCode, responseCode, message, flags)
+        except ProtocolError:
+            log.warning("Message too long")
         else:
-            if message:
-                length = len(str(responseCode)) + len(message)
+            self.queue_frame(client, data)
+            if self.metrics is not None:
+                self.metrics.record_frames_out(getattr(commandCode, 'value', commandCode), 1)
+
+    def broadcast(self, clients, commandCode, responseCode, message):
+        # Same frame for every recipient - encode (and compress) it once per
+        # framing and queue the same immutable bytes object on each
+        # connection.  Returns the frames, indexed by framing (None where
+        # nobody needed one)
+        frames = [None] * FRAMINGS
+        queued = 0
+        for c in clients:
+            data = frames[c.framing]
+            if data is None:
+                try:
+                    data = encode_response(c.framing, commandCode, responseCode, message)
+                except ProtocolError:
+                    # Too big for the legacy framing - those members miss out
+                    log.warning("Message too long for framing %d", c.framing)
+                    data = False
+                frames[c.framing] = data
+            if data:
+                self.queue_frame(c, data)
+                queued += 1
+        if self.metrics is not None:
+            self.metrics.record_frames_out(commandCode.value, queued)
+        return frames
+
+    def queue_frame(self, client, data):
+        outbound = client.outbound
+        if outbound is None:
+            outbound = client.outbound = OutputBuffer()
+        if outbound.append(data) or outbound.backlog() > self.highWater:
+            # First bytes pending - written at the end of this loop iteration
+            # along with everything else queued for this client by then.  A
+            # queue over the high watermark is only held against the client
+            # if it is still over once that write has been tried (see
+            # process_outgoing_data), so frames queued in this iteration
+            # aren't counted before the client has had a chance at them
+            self.dirtyClients.add(client)
+
+    def process_slow_consumer(self, client):
+        if client.closing:
+            return
+        if self.metrics is not None:
+            self.metrics.slowConsumerEvents += 1
+        if self.overflowPolicy == 'disconnect' or client.outbound.backlog() > self.hardLimit:
+            log.warning("Client at %s is not keeping up - disconnecting", client.addr)
+            self.schedule_close(client)
+        elif self.overflowPolicy == 'drop-oldest':
+            client.dropped += client.outbound.drop_oldest(self.lowWater)
+        elif not client.paused:
+            client.paused = True
+            self.pause_reading(client)
+
+    def pause_reading(self, client):
+        self.update_interest(client)
+
+    def resume_reading(self, client):
+        self.update_interest(client)
+
+    def update_interest(self, client):
+        # Read unless paused for backpressure or a rate limit, write only
+        # while bytes are pending
+        events = 0 if client.paused or client.held is not None else selectors.EVENT_READ
+        if client.outbound:
+            events |= selectors.EVENT_WRITE
+        if events != client.events:
+            # Not every selector takes an empty event mask - a socket with
+            # nothing to wait for comes out of the selector altogether
+            if not events:
+                self.selector.unregister(client.sock)
+            elif not client.events:
+                self.selector.register(client.sock, events, client)
             else:
-                length = len(str(responseCode))
-            data = str(commandCode) + str(length).rjust(5, '0') + str(responseCode)
-            if message:
-                data = data + message
-            client.outbound.put(data)
-            self.writeList.append(client.sock)
+                self.selector.modify(client.sock, events, client)
+            client.events = events
+
+    def schedule_close(self, client):
+        client.closing = True
+        self.closeList.append(client)
+
+    def process_close_list(self):
+        closeList = self.closeList
+        self.closeList = []
+        for client in closeList:
+            if client.sock in self.clientList:
+                self.process_leave_server(client)
+
+    def process_outgoing_data(self, client):
+        before = client.outbound.size
+        try:
+            pending = client.send_outgoing_data()
+        except OSError:
+            self.process_client_exception(client.sock)
+            return
+        if self.metrics is not None:
+            self.metrics.bytesOut += before - pending
+        if client.outbound.backlog() > self.highWater:
+            self.process_slow_consumer(client)
+            pending = client.outbound.size
+        if not pending:
+            # Idle connections don't hold on to a buffer
+            client.outbound = None
+        if client.paused and pending <= self.lowWater:
+            client.paused = False
+            self.resume_reading(client)
+        else:
+            # Only keep write interest while there is something left to send
+            self.update_interest(client)
+
+    def flush_dirty_clients(self):
+        # Write straight away instead of waiting for the next select to say
+        # the socket is writable - it almost always is.  Only clients the
+        # kernel couldn't take everything from get write interest
+        dirty = self.dirtyClients
+        self.dirtyClients = set()
+        for client in dirty:
+            if client.outbound and not client.closing and client.sock in self.clientList:
+                self.process_outgoing_data(client)
+
+    def connection_stats(self, limit=None):
+        # Output queue depth for every connection (or the limit deepest),
+        # deepest first.  Served as /connections by irc_metrics.StatsEndpoint
+        stats = []
+        for client in self.clientList.values():
+            outbound = client.outbound
+            if outbound is None:
+                stats.append((client.addr, client.name, 0, 0, client.dropped, client.paused))
+            else:
+                stats.append((client.addr, client.name, outbound.size, len(outbound.chunks),
+                              client.dropped, client.paused))
+        if limit is not None:
+            return heapq.nlargest(limit, stats, key=lambda s: s[2])
+        stats.sort(key=lambda s: s[2], reverse=True)
+        return stats
+
+    def run_once(self, timeout=None):
+        ready = self.selector.select(timeout)
+        now = self.now = time.monotonic()
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+
+        for key, events in ready:
+            if key.fileobj is self.listenSocket:
+                # A client is trying to connect
+                self.process_incoming_connection()
+                continue
+
+            client = key.data
+            if callable(client):
+                # Some other socket we watch, e.g. a worker bus link.  (Not
+                # isinstance(client, Client) - run as a script this module is
+                # __main__, and Client subclasses elsewhere, e.g. irc_tls,
+                # derive from the irc_server copy)
+                client(events)
+                if not self.running:
+                    # Handed over to a new process - see irc_state
+                    return
+                continue
+            if events & selectors.EVENT_READ:
+                # Data coming in on a client socket
+                self.process_incoming_data(key.fileobj)
+            # The read handler may have disconnected the client
+            if events & selectors.EVENT_WRITE and client.sock in self.clientList:
+                self.process_outgoing_data(client)
+
+        # Timeouts go after the reads, so a client isn't dropped for being
+        # quiet with its data sitting in this batch of events
+        self.timers.advance(now)
+
+        # Worker bus first, so other workers hear about a change no later
+        # than our clients do
+        if self.bus is not None:
+            self.bus.flush()
+        if self.dirtyClients:
+            self.flush_dirty_clients()
+
+        if self.closeList:
+            self.process_close_list()
+
+        if self.journal is not None:
+            self.journal.flush()
+
+        if metrics is not None:
+            metrics.record_loop(time.perf_counter() - start)
 
     def run(self):
-        while self.readList:
-            read, write, exception = select.select(self.readList, self.writeList, self.readList)
-
-            for s in read:
-                if s == self.listenSocket:
-                    # A client is trying to connect
-                    self.process_incoming_connection()
-                else:
-                    # Data coming in on a client socket
-                    self.process_incoming_data(s)
-
-            for s in write:
-                if s in self.clientList:
-                    client = self.clientList[s]
-                    client.send_outgoing_data()
-                    self.writeList.remove(s)
-
-            for s in exception:
-                if s == self.listenSocket:
-                    print("Server listen socket encountered exception - reinitializing")
-                    self.readList.remove(self.listenSocket)
-                    self.listenSocket.close()
-                    self.initialize_listen_socket()
-                else:
-                    self.process_client_exception(s)
+        while self.running:
+            self.run_once(self.timers.next_timeout(time.monotonic()))
 
 
+# Both are slotted - with 100k connections the per instance __dict__ adds up
 class Channel:
+    __slots__ = ('name', 'users', 'remoteUsers', 'names', 'listFrames', 'history')
+
     def __init__(self, name):
         self.name = name
-        self.users = []
+        self.users = set()
+        # Members on other workers: worker -> set of usernames.  Workers
+        # with no members left are removed so this is empty when unused
+        self.remoteUsers = {}
+        # Every member's name, local and remote, in sorted order, and the
+        # encoded full LIST_USERS response per framing (see Server.send_list)
+        self.names = []
+        self.listFrames = [None] * FRAMINGS
+        # Deque of recent messages, see irc_history.  None until the first one
+        self.history = None
+
+    def add_name(self, name):
+        bisect.insort(self.names, name)
+        self.listFrames = [None] * FRAMINGS
+
+    def remove_name(self, name):
+        remove_sorted(self.names, name)
+        self.listFrames = [None] * FRAMINGS
 
 class Client:
+    __slots__ = ('name', 'sock', 'addr', 'LoggedIn', 'channels', 'framing', 'decoder', 'outbound',
+                 'dropped', 'events', 'paused', 'closing', 'lastActive', 'timer', 'limits', 'held')
+
     def __init__(self, socket, addr):
         self.name = None
         self.sock = socket
         self.addr = addr
         self.LoggedIn = False
-        self.outbound = queue.Queue()
+        # Channels this client has joined, so logout doesn't scan every channel.
+        # The shared empty tuple until the first join
+        self.channels = ()
+        # Picked when the first bytes arrive - see process_received_data -
+        # and moved to FRAMING_COMPRESSED if the client asks at LOGIN
+        self.framing = FRAMING_LEGACY
+        self.decoder = None
+        # Allocated when there is something to send and dropped again once
+        # it has all gone out - see Server.queue_frame
+        self.outbound = None
+        # Frames thrown away by the drop-oldest overflow policy
+        self.dropped = 0
+        # Events currently registered with the selector.  0 when the socket
+        # is out of the selector - paused with nothing left to write
+        self.events = selectors.EVENT_READ
+        # Reads stopped because our output queue is over the high watermark
+        self.paused = False
+        # Waiting in Server.closeList to be disconnected
+        self.closing = False
+        # When we last heard from the client, and its timeout timer - see
+        # Server.start_client_timer
+        self.lastActive = 0
+        self.timer = None
+        # Rate limit state (see irc_limits.RateLimiter), allocated on the
+        # first frame, and the frames waiting for the client to be back
+        # under its limits - None unless it is over them
+        self.limits = None
+        self.held = None
+
+    def receive(self):
+        return self.sock.recv(RECV_SIZE)
 
     def send_outgoing_data(self):
-        while not self.outbound.empty():
-            self.sock.send(self.outbound.get())
+        return self.outbound.flush(self.sock)
 
 # Start of main server program
-server = Server()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CS594 IRC Server")
+    parser.add_argument('--port', type=int, default=6000)
+    parser.add_argument('--backend', default='default', choices=sorted(SELECTOR_BACKENDS),
+                        help="event loop backend (default: best available)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes sharing the port (default: 1)")
+    parser.add_argument('--backlog', type=int, default=socket.SOMAXCONN,
+                        help="connections the kernel queues before we accept them (default: the "
+                             "system maximum, " + str(socket.SOMAXCONN) + ")")
+    parser.add_argument('--high-water', type=int, default=1024 * 1024,
+                        help="per client output queue size that triggers the overflow policy (bytes)")
+    parser.add_argument('--low-water', type=int, default=256 * 1024,
+                        help="output queue size at which a paused client is resumed (bytes)")
+    parser.add_argument('--hard-limit', type=int, default=16 * 1024 * 1024,
+                        help="output queue size at which a client is always disconnected (bytes)")
+    parser.add_argument('--overflow-policy', default='pause', choices=OVERFLOW_POLICIES)
+    parser.add_argument('--stats-port', type=int, default=None,
+                        help="serve Prometheus-style metrics on this localhost port (worker N uses port+N)")
+    parser.add_argument('--history', type=int, default=50,
+                        help="messages per channel replayed to new members (0 turns history off)")
+    parser.add_argument('--history-bytes', type=int, default=64 * 1024 * 1024,
+                        help="memory cap for history across all channels - quietest channels are dropped first")
+    parser.add_argument('--node-id', type=int, default=0,
+                        help="this node's id when federated - unique across the nodes")
+    parser.add_argument('--link-port', type=int, default=None,
+                        help="federate with other nodes, accepting node links on this port")
+    parser.add_argument('--peer', action='append', default=[], metavar='ID@HOST:PORT',
+                        help="another node's id and link address (repeat for each node)")
+    parser.add_argument('--journal', metavar='PATH',
+                        help="keep channels and memberships in this file and restore them at startup")
+    parser.add_argument('--journal-sync', action='store_true',
+                        help="fsync the journal after every write")
+    parser.add_argument('--restore-window', type=float, default=300,
+                        help="seconds restored users have to log back in and get their channels back")
+    parser.add_argument('--handoff-socket', metavar='PATH',
+                        help="unix socket a new server process can take over this one through")
+    parser.add_argument('--takeover', metavar='PATH',
+                        help="take over the listening socket and clients of the server on this handoff socket")
+    parser.add_argument('--ping-interval', type=float, default=60,
+                        help="seconds of silence before a client is sent a PING (0 never pings)")
+    parser.add_argument('--idle-timeout', type=float, default=180,
+                        help="seconds of silence before a client is disconnected (0 never)")
+    parser.add_argument('--login-timeout', type=float, default=30,
+                        help="seconds a new connection has to log in (0 for no limit)")
+    add_rate_limit_arguments(parser)
+    parser.add_argument('--no-compression', action='store_true',
+                        help="turn down clients that ask for compressed frames")
+    parser.add_argument('--tls-cert', metavar='PATH',
+                        help="speak TLS on the client port with this certificate chain (PEM)")
+    parser.add_argument('--tls-key', metavar='PATH',
+                        help="private key for --tls-cert, if it isn't in the same file")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="DEBUG logs every connect and disconnect")
+    args = parser.parse_args()
+    if args.workers > 1 and (args.handoff_socket or args.takeover):
+        parser.error("handoff only works with a single worker")
+    if args.workers > 1 and args.link_port is not None:
+        parser.error("federation only works with a single worker per node")
+    if args.workers > 1 and args.journal:
+        # Each worker would restore its own part, but a returning user lands
+        # on whichever worker the kernel picks
+        parser.error("the journal only works with a single worker")
+    if args.hard_limit < args.high_water:
+        parser.error("--hard-limit must be at least --high-water")
+    if args.low_water > args.high_water:
+        parser.error("--low-water must not be over --high-water")
+    if args.tls_cert and (args.handoff_socket or args.takeover):
+        parser.error("TLS connections can't be handed off")
+
+    import irc_metrics
+    import irc_state
+    irc_metrics.setup_logging(args.log_level)
+
+    try:
+        rateLimits = make_rate_limits(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    options = dict(backlog=args.backlog, highWater=args.high_water, lowWater=args.low_water,
+                   hardLimit=args.hard_limit, overflowPolicy=args.overflow_policy, historyDepth=args.history,
+                   historyBytes=args.history_bytes, compression=not args.no_compression,
+                   pingInterval=args.ping_interval, idleTimeout=args.idle_timeout,
+                   loginTimeout=args.login_timeout, rateLimits=rateLimits, floodPolicy=args.flood_policy)
+
+    tlsContext = None
+    if args.tls_cert:
+        import irc_tls
+        # Made before the workers fork so they share session ticket keys
+        try:
+            tlsContext = irc_tls.make_server_context(args.tls_cert, args.tls_key)
+        except OSError as e:
+            parser.error("Can't load TLS certificate: " + str(e))
+
+    def make_server(workerId=None):
+        if workerId is not None:
+            # The log writer thread doesn't survive fork - each worker needs its own
+            irc_metrics.setup_logging(args.log_level)
+        else:
+            workerId = 0
+        listenSocket = None
+        if args.takeover:
+            listenSocket, handoffConn, state = irc_state.receive_handoff(args.takeover)
+        server = Server(args.port, make_selector(args.backend), reusePort=args.workers > 1,
+                        listenSocket=listenSocket, **options)
+        if args.takeover:
+            irc_state.adopt_state(server, state, args.restore_window)
+            # Let the old process get out of the way before binding anything else
+            irc_state.wait_for_exit(handoffConn)
+        if args.journal:
+            if not args.takeover:
+                channels, members = irc_state.read_journal(args.journal)
+                server.restore_channels(channels, members, args.restore_window)
+                log.info("Restored %d channels from %s", len(channels), args.journal)
+            server.journal = irc_state.Journal(server, args.journal, args.journal_sync)
+            server.journal.open()
+        if tlsContext is not None:
+            server.tls = irc_tls.TLSAcceptor(server, tlsContext)
+        if args.handoff_socket:
+            irc_state.HandoffEndpoint(server, args.handoff_socket)
+        if args.link_port is not None:
+            import irc_federation
+            try:
+                peers = dict(irc_federation.parse_peer(p) for p in args.peer)
+            except ValueError as e:
+                parser.error(str(e))
+            server.bus = irc_federation.FederationBus(server, args.node_id, args.link_port, peers)
+        if args.stats_port is not None:
+            server.metrics = irc_metrics.Metrics()
+            irc_metrics.StatsEndpoint(server, args.stats_port + workerId)
+        return server
 
-server.run()
+    if args.workers > 1:
+        import irc_cluster
+        irc_cluster.run_workers(args.workers, make_server)
+    else:
+        make_server().run()
@@ -0,0 +1,359 @@
+# Miguel Delapaz - CS594 - IRC Client library
+#
+# The client side of the protocol with no user interface, for bots and
+# services.  A Session owns one server connection.  Requests are methods
+# (login, join_channel, send_message, ...) that queue a frame and write it
+# straight away if the socket will take it; responses and channel traffic
+# come back as Events, either handed to a callback as they arrive or
+# queued up for the events() iterator:
+#
+#     session = Session(binary=True)
+#     session.connect('localhost', 6000)
+#     session.login('bot')
+#     session.join_channel('general')
+#     for event in session.events():
+#         if event.command == Command.MESSAGE and event.text == '!ping':
+#             session.send_message(event.channel, 'pong')
+#
+# Nothing here blocks except poll() and the iterators, which wait on the
+# socket with select, so a Session also fits into someone else's event
+# loop: watch fileno(), call process_input() when it is readable and
+# flush_outgoing_data() when it is writable and there is output pending.
+# irc_client.py is the console client built on top of this.
+#
+# Pass an ssl.SSLContext (see irc_tls.make_client_context) as tlsContext
+# to talk to a server running TLS.  The session keeps the TLS session from
+# its last connection and offers it when it connects to the same server
+# again, so a reconnect is a quick resumed handshake.
+import collections
+import select
+import socket
+import time
+
+from irc_protocol import Command, ResponseCodes, OutputBuffer, ProtocolError, encode_frame, encode_binary_frame, encode_compressed_frame, decompress_payload, make_decoder, recv_tls, RECV_SIZE, FLAG_ACCEPT_COMPRESSION, FLAG_COMPRESSED, FRAMING_BINARY, FRAMING_LEGACY
+
+# send_messages joins frames into writes of about this size
+BULK_WRITE_SIZE = 256 * 1024
+
+class Event(collections.namedtuple('Event', 'command code data channel user text')):
+    # A response or channel message from the server.  command and code are
+    # the Command and ResponseCodes; data is the payload text.  Channel
+    # messages also have channel, user and text split out.  command None
+    # means the connection is gone and data says why
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.code == ResponseCodes.OK
+
+    def names(self):
+        # LIST_ROOMS and LIST_USERS responses: the names (without the channel
+        # line LIST_USERS starts with) and the offset of the next page, or
+        # None if this was the last one
+        lines = self.data.splitlines()
+        if self.command == Command.LIST_USERS:
+            lines = lines[1:]
+        nextOffset = None
+        if lines and lines[-1].startswith('+'):
+            nextOffset = int(lines.pop()[1:])
+        return lines, nextOffset
+
+    def results(self):
+        # JOIN_MANY and LEAVE_MANY responses: (channel, error) for each
+        # channel asked for, error None for the ones that went through
+        results = []
+        for line in self.data.splitlines():
+            channel, _, error = line.partition(' ')
+            results.append((channel, error or None))
+        return results
+
+def list_query(prefix, offset, limit):
+    # The optional query on LIST_ROOMS and LIST_USERS - see irc_protocol
+    if not prefix and offset is None and limit is None:
+        return ''
+    return (prefix or '') + '\n' + ('' if offset is None else str(offset)) + '\n' + ('' if limit is None else str(limit))
+
+class Session:
+    def __init__(self, binary=False, compress=False, handler=None, tlsContext=None):
+        self.addr = None
+        self.port = None
+        self.sock = None
+        self.username = None
+        self.LoggedIn = False
+        self.outbound = OutputBuffer()
+        # Binary framing is chosen by the client - the server follows whatever
+        # the first frame on the connection uses
+        self.framing = FRAMING_BINARY if binary or compress else FRAMING_LEGACY
+        self.decoder = make_decoder(self.framing)
+        # Offer compression at LOGIN (binary framing only), and whether the
+        # server took us up on it - only then do our own frames get compressed
+        self.compress = compress
+        self.compressing = False
+        # handler(event) is called for every event; without one they queue
+        # up here for events()
+        self.handler = handler
+        self.pending = collections.deque()
+        # Command wait_for() is looking for, and what it found
+        self.waitCommand = None
+        self.waitResult = None
+        # TLS, and the session to resume with (server, ssl.SSLSession)
+        self.tlsContext = tlsContext
+        self.tlsSession = None
+
+    # Connection
+    def connect(self, addr, port, timeout=None):
+        # Blocking connect, then everything else is non-blocking
+        self.reset(addr, port)
+        sock = socket.create_connection((addr, port), timeout)
+        if self.tlsContext is not None:
+            session = None
+            if self.tlsSession is not None and self.tlsSession[0] == (addr, port):
+                session = self.tlsSession[1]
+            try:
+                sock = self.tlsContext.wrap_socket(sock, server_hostname=addr, session=session)
+            except OSError:
+                sock.close()
+                raise
+        sock.setblocking(False)
+        self.sock = sock
+
+    def reset(self, addr, port):
+        # Nothing carries over from an earlier connection
+        self.addr = addr
+        self.port = port
+        self.decoder = make_decoder(self.framing)
+        self.outbound = OutputBuffer()
+        self.compressing = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        # Hang up without telling the server - see logout
+        sock = self.sock
+        self.sock = None
+        self.LoggedIn = False
+        if sock is not None:
+            if self.tlsContext is not None and sock.session is not None:
+                # TLS 1.3 tickets arrive after the handshake, so this is the
+                # first point we can be sure of having one
+                self.tlsSession = ((self.addr, self.port), sock.session)
+            sock.close()
+
+    def process_disconnect(self, reason):
+        if self.sock is not None or self.LoggedIn:
+            self.close()
+            self.deliver(Event(None, None, reason, None, None, None))
+
+    # Requests.  These raise ProtocolError if the frame is too long
+    def login(self, username):
+        self.username = username
+        self.send_network_data(Command.LOGIN, username)
+
+    def logout(self):
+        self.send_network_data(Command.LOGOUT, None)
+        # Best effort - get the LOGOUT out before we hang up
+        self.flush_outgoing_data()
+        self.close()
+
+    def add_channel(self, channelName):
+        self.send_network_data(Command.ADD_CHANNEL, channelName)
+
+    def join_channel(self, channelName):
+        self.send_network_data(Command.JOIN_CHANNEL, channelName)
+
+    def leave_channel(self, channelName):
+        self.send_network_data(Command.LEAVE_CHANNEL, channelName)
+
+    # The *_many requests take several channels in one frame and need the
+    # binary framing - see MAX_CHANNELS_PER_REQUEST in irc_protocol
+    def join_channels(self, channelNames):
+        self.send_network_data(Command.JOIN_MANY, ' '.join(channelNames))
+
+    def leave_channels(self, channelNames):
+        self.send_network_data(Command.LEAVE_MANY, ' '.join(channelNames))
+
+    def send_message_many(self, channelNames, message):
+        # Each member of the channels gets the message once
+        self.send_network_data(Command.MESSAGE_MANY, ' '.join(channelNames) + '\n' + message)
+
+    def list_rooms(self, prefix=None, offset=None, limit=None):
+        self.send_network_data(Command.LIST_ROOMS, list_query(prefix, offset, limit))
+
+    def list_users(self, channelName, prefix=None, offset=None, limit=None):
+        self.send_network_data(Command.LIST_USERS, channelName + '\n' + list_query(prefix, offset, limit))
+
+    def send_message(self, channelName, message):
+        self.send_network_data(Command.MESSAGE, channelName + '\n' + message)
+
+    def send_messages(self, channelName, messages):
+        # Many messages to one channel, pipelined - the frames are joined into
+        # a few large writes rather than going out one per syscall.  Returns
+        # the number queued
+        chunk = []
+        size = 0
+        count = 0
+        prefix = channelName + '\n'
+        for message in messages:
+            frame = self.encode_request(Command.MESSAGE, prefix + message)
+            chunk.append(frame)
+            size += len(frame)
+            count += 1
+            if size >= BULK_WRITE_SIZE:
+                self.outbound.append(b''.join(chunk))
+                chunk = []
+                size = 0
+        if chunk:
+            self.outbound.append(b''.join(chunk))
+        if count:
+            self.request_flush()
+        return count
+
+    def ping(self, data=''):
+        self.send_network_data(Command.PING, data)
+
+    def encode_request(self, code, data):
+        if self.framing == FRAMING_LEGACY:
+            return encode_frame(code, data)
+        if self.compressing:
+            return encode_compressed_frame(code, 0, data)
+        if self.compress and code == Command.LOGIN:
+            return encode_binary_frame(code, 0, data, FLAG_ACCEPT_COMPRESSION)
+        return encode_binary_frame(code, 0, data)
+
+    def send_network_data(self, code, data):
+        message = self.encode_request(code, data)
+        if self.outbound.append(message):
+            self.request_flush()
+
+    def request_flush(self):
+        # Output was queued - try writing it straight away
+        self.flush_outgoing_data()
+
+    def flush_outgoing_data(self):
+        # Returns the number of bytes still waiting for the socket
+        if self.sock is None:
+            return 0
+        try:
+            if self.tlsContext is not None:
+                return self.outbound.flush_tls(self.sock)
+            return self.outbound.flush(self.sock)
+        except OSError:
+            self.process_disconnect("Connection encountered an error")
+            return 0
+
+    # Incoming data
+    def process_input(self):
+        # The socket is readable
+        try:
+            if self.tlsContext is not None:
+                data = recv_tls(self.sock)
+                if data is None:
+                    return
+            else:
+                data = self.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.process_disconnect("Connection encountered an error")
+            return
+        if not data:
+            self.process_disconnect("Server disconnected")
+            return
+        self.process_received_data(data)
+
+    def process_received_data(self, data):
+        # A burst of channel traffic arrives as many frames in one read
+        try:
+            frames = self.decoder.feed(data)
+        except ProtocolError:
+            self.process_disconnect("Server sent a malformed frame")
+            return
+
+        for command, status, flags, payload in frames:
+            if flags & FLAG_COMPRESSED:
+                try:
+                    payload = decompress_payload(payload)
+                except ProtocolError:
+                    self.process_disconnect("Server sent a malformed frame")
+                    return
+            if flags & FLAG_ACCEPT_COMPRESSION and command == Command.LOGIN.value:
+                self.compressing = True
+            self.process_server_frame(command, status, payload.decode('utf-8', 'replace'))
+
+    def process_server_frame(self, command, status, data):
+        if status is None:
+            # Legacy framing - response code is the first character of the payload
+            status = data[:1]
+            data = data[1:]
+        try:
+            command = Command(command)
+            responseCode = ResponseCodes(int(status))
+        except ValueError:
+            # Something newer than us - skip it
+            return
+
+        if command == Command.PING:
+            # The server hasn't heard from us in a while
+            self.send_network_data(Command.PONG, data)
+            return
+        if command == Command.LOGIN and responseCode == ResponseCodes.OK:
+            self.LoggedIn = True
+
+        channel = user = text = None
+        if command == Command.MESSAGE and responseCode == ResponseCodes.OK:
+            fields = data.split('\n', 2)
+            if len(fields) == 3:
+                channel, user, text = fields
+        self.deliver(Event(command, responseCode, data, channel, user, text))
+
+    def deliver(self, event):
+        if event.command is not None and event.command == self.waitCommand and self.waitResult is None:
+            self.waitResult = event
+        elif self.handler is not None:
+            self.handler(event)
+        else:
+            self.pending.append(event)
+
+    # Waiting, for scripts that don't have an event loop of their own
+    def poll(self, timeout=None):
+        # Wait up to timeout seconds (None for ever) for the socket, then
+        # read and write whatever it is ready for.  False on a timeout
+        if self.sock is None:
+            return False
+        writing = [self.sock] if self.outbound else []
+        read, write, exception = select.select([self.sock], writing, [], timeout)
+        if write:
+            self.flush_outgoing_data()
+        if read and self.sock is not None:
+            self.process_input()
+        return bool(read or write)
+
+    def events(self, timeout=None):
+        # Queued events, then new ones as they arrive.  Ends when nothing
+        # has come in for timeout seconds, or once the connection is gone
+        while True:
+            while self.pending:
+                yield self.pending.popleft()
+            if self.sock is None or not self.poll(timeout):
+                return
+
+    def wait_for(self, command, timeout=None):
+        # The next response to command, e.g. Command.LOGIN after login().
+        # Anything else that arrives meanwhile is delivered as usual.  None
+        # if it doesn't come within timeout seconds or the connection drops
+        self.waitCommand = command
+        self.waitResult = None
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while self.waitResult is None and self.sock is not None:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                self.poll(remaining)
+            return self.waitResult
+        finally:
+            self.waitCommand = None
+            self.waitResult = None
@@ -0,0 +1,373 @@
+# Miguel Delapaz - CS594 - IRC Server persistent state and warm restart
+#
+# Two ways to keep users' channels across a restart:
+#
+# The journal is an append-only file with one line per channel change -
+# "A chan" (added), "D chan" (deleted), "J chan user" and "L chan user".
+# Lines are buffered and written once per loop iteration, and the file is
+# rewritten as a snapshot of the current state whenever it has grown well
+# past it.  At startup the channels are recreated straight away and users
+# are put back in theirs when they log in again.
+#
+# A handoff moves a running server into a new process without dropping
+# anybody.  The old server listens on a unix socket; the new one connects,
+# and the old one sends over the listening socket and every client socket
+# (SCM_RIGHTS) along with each client's session state - including frames
+# held back for a rate limit and where its limits stand - then exits.
+import json
+import logging
+import os
+import selectors
+import socket
+import struct
+
+from irc_protocol import make_decoder
+
+log = logging.getLogger('irc_state')
+
+# Rewrite the journal once it holds this many more lines than a snapshot would
+COMPACT_MIN_RECORDS = 10000
+COMPACT_RATIO = 4
+
+def read_journal(path):
+    # Returns (set of channel names, channel name -> set of usernames)
+    channels = set()
+    members = {}
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return channels, members
+    with f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                # Cut short by a crash part way through a write
+                break
+            fields = line.decode('utf-8', 'replace').split()
+            if len(fields) == 2 and fields[0] == 'A':
+                channels.add(fields[1])
+            elif len(fields) == 2 and fields[0] == 'D':
+                channels.discard(fields[1])
+                members.pop(fields[1], None)
+            elif len(fields) == 3 and fields[0] == 'J':
+                channels.add(fields[1])
+                members.setdefault(fields[1], set()).add(fields[2])
+            elif len(fields) == 3 and fields[0] == 'L':
+                users = members.get(fields[1])
+                if users is not None:
+                    users.discard(fields[2])
+            else:
+                log.warning("Skipping bad journal line %r", line)
+    return channels, members
+
+class Journal:
+    def __init__(self, server, path, sync=False):
+        self.server = server
+        self.path = path
+        # fsync after every write - survives power loss, costs a disk flush
+        # per loop iteration that changed anything
+        self.sync = sync
+        self.pending = []
+        self.records = 0
+        self.limit = COMPACT_MIN_RECORDS
+        self.file = None
+
+    def open(self):
+        # Start from a snapshot of whatever the server holds now - the
+        # channels just read back from this file, or those handed over by
+        # the previous process
+        self.compact()
+
+    def add_channel(self, channelName):
+        self.pending.append('A ' + channelName + '\n')
+
+    def remove_channel(self, channelName):
+        self.pending.append('D ' + channelName + '\n')
+
+    def join(self, channelName, username):
+        self.pending.append('J ' + channelName + ' ' + username + '\n')
+
+    def leave(self, channelName, username):
+        self.pending.append('L ' + channelName + ' ' + username + '\n')
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.records += len(self.pending)
+        self.file.write(''.join(self.pending).encode('utf-8'))
+        self.pending = []
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        if self.records > self.limit:
+            self.compact()
+
+    def snapshot_lines(self):
+        server = self.server
+        for channel in server.channelList.values():
+            yield 'A ' + channel.name + '\n'
+            for client in channel.users:
+                yield 'J ' + channel.name + ' ' + client.name + '\n'
+        # Users still expected back keep their place in the next snapshot too
+        for username, channelNames in server.restoredMembers.items():
+            for channelName in channelNames:
+                yield 'J ' + channelName + ' ' + username + '\n'
+
+    def compact(self):
+        self.pending = []
+        if self.file is not None:
+            self.file.close()
+        temp = self.path + '.tmp'
+        records = 0
+        with open(temp, 'wb') as f:
+            chunk = []
+            for line in self.snapshot_lines():
+                chunk.append(line)
+                if len(chunk) >= 4096:
+                    f.write(''.join(chunk).encode('utf-8'))
+                    records += len(chunk)
+                    chunk = []
+            f.write(''.join(chunk).encode('utf-8'))
+            records += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+        self.file = open(self.path, 'ab')
+        self.records = records
+        self.limit = max(COMPACT_MIN_RECORDS, records * COMPACT_RATIO)
+        log.debug("Journal compacted to %d records", records)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+# Handoff messages are a header - body length and number of descriptors,
+# sent with the descriptors attached - followed by a JSON body.  Bytes
+# fields (unsent output, half received frames) travel as latin-1 strings
+HANDOFF_HEADER = struct.Struct('!II')
+# Kernel limit on descriptors in one message is 253
+HANDOFF_BATCH = 200
+
+def send_message(sock, body, fds=()):
+    data = json.dumps(body).encode('utf-8')
+    header = HANDOFF_HEADER.pack(len(data), len(fds))
+    if fds:
+        socket.send_fds(sock, [header], fds)
+    else:
+        sock.sendall(header)
+    sock.sendall(data)
+
+def receive_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        more = sock.recv(size - len(data))
+        if not more:
+            raise ConnectionError("Handoff connection closed early")
+        data += more
+    return data
+
+def receive_message(sock):
+    # The descriptors arrive with the first byte of the header.  Reads never
+    # go past the end of a message, so they can't pick up the next one's
+    header, fds, flags, addr = socket.recv_fds(sock, HANDOFF_HEADER.size, HANDOFF_BATCH)
+    if not header:
+        raise ConnectionError("Handoff connection closed early")
+    header += receive_exactly(sock, HANDOFF_HEADER.size - len(header))
+    length, count = HANDOFF_HEADER.unpack(header)
+    if len(fds) != count:
+        raise ConnectionError("Expected " + str(count) + " descriptors, got " + str(len(fds)))
+    return json.loads(receive_exactly(sock, length)), fds
+
+def check_handoff_support():
+    if not hasattr(socket, 'AF_UNIX') or not hasattr(socket, 'send_fds'):
+        raise SystemExit("Handoff needs unix sockets with descriptor passing")
+
+class HandoffEndpoint:
+    # Unix socket the next server process connects to for a takeover
+    def __init__(self, server, path):
+        check_handoff_support()
+        self.server = server
+        self.path = path
+        self.conn = None
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listenSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listenSocket.bind(path)
+        self.listenSocket.listen(1)
+        self.listenSocket.setblocking(False)
+        server.selector.register(self.listenSocket, selectors.EVENT_READ, self.process_accept)
+        log.info("Accepting handoff requests on %s", path)
+
+    def process_accept(self, events):
+        try:
+            conn, addr = self.listenSocket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        # We are on our way out - nothing else gets a look in until this is done
+        conn.setblocking(True)
+        conn.settimeout(30)
+        try:
+            hand_off(self.server, conn)
+        except (OSError, ValueError) as e:
+            log.error("Handoff failed, carrying on: %s", e)
+            conn.close()
+            if self.server.listenSocket.fileno() != -1:
+                self.server.selector.register(self.server.listenSocket, selectors.EVENT_READ, None)
+            return
+        self.close()
+        # The new process is watching conn for our exit, so leave it open
+        self.conn = conn
+        self.server.running = False
+
+    def close(self):
+        self.server.selector.unregister(self.listenSocket)
+        self.listenSocket.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+def export_client(server, client):
+    outbound = b''
+    if client.outbound:
+        outbound = b''.join([bytes(chunk) for chunk in client.outbound.chunks])
+    leftover = b''
+    if client.decoder is not None:
+        leftover = bytes(client.decoder.buffer)
+    # Rate limit state as seconds ahead of now, and any frames waiting on it
+    limits = None
+    if client.limits is not None:
+        limits = [arrival - server.now for arrival in client.limits]
+    held = None
+    if client.held is not None:
+        held = [[command, status, flags, payload.decode('latin-1')] for command, status, flags, payload in client.held]
+    return {'addr': list(client.addr) if isinstance(client.addr, tuple) else client.addr,
+            'name': client.name,
+            'loggedIn': client.LoggedIn,
+            'framing': client.framing if client.decoder is not None else None,
+            'channels': [channel.name for channel in client.channels],
+            'leftover': leftover.decode('latin-1'),
+            'outbound': outbound.decode('latin-1'),
+            'limits': limits,
+            'held': held}
+
+def hand_off(server, conn):
+    # Stop taking new connections - they queue on the listening socket,
+    # which goes to the new process
+    server.selector.unregister(server.listenSocket)
+    if server.journal is not None:
+        # Get it up to date on disk, but keep it open until the new process
+        # has confirmed - if the handoff fails we carry on writing to it
+        server.journal.flush()
+
+    clients = []
+    for client in list(server.clientList.values()):
+        if client.closing:
+            continue
+        if client.outbound:
+            # Whatever goes now doesn't have to be carried over
+            try:
+                client.send_outgoing_data()
+            except OSError:
+                continue
+        clients.append(client)
+
+    restoredMembers = {}
+    for username, channelNames in server.restoredMembers.items():
+        restoredMembers[username] = sorted(channelNames)
+    send_message(conn, {'channels': sorted(server.channelList), 'restoredMembers': restoredMembers},
+                 [server.listenSocket.fileno()])
+    for i in range(0, len(clients), HANDOFF_BATCH):
+        batch = clients[i:i + HANDOFF_BATCH]
+        send_message(conn, {'clients': [export_client(server, c) for c in batch]}, [c.sock.fileno() for c in batch])
+    send_message(conn, {'done': True})
+
+    if receive_exactly(conn, 1) != b'k':
+        raise ValueError("New server did not confirm the handoff")
+
+    if server.journal is not None:
+        # The new process rewrites the journal from what we sent it
+        server.journal.close()
+        server.journal = None
+    # Our copies of the sockets can go now.  close() rather than shutdown()
+    # so the connections stay up in the new process
+    server.listenSocket.close()
+    for client in clients:
+        if client.events:
+            server.selector.unregister(client.sock)
+        client.sock.close()
+    server.clientList.clear()
+    server.userList.clear()
+    log.info("Handed %d clients over to the new server", len(clients))
+
+def receive_handoff(path):
+    # Run by the new process before it builds its Server.  Returns the
+    # listening socket, the connection to the old process and the state
+    check_handoff_support()
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(30)
+    conn.connect(path)
+    state, fds = receive_message(conn)
+    listenSocket = socket.socket(fileno=fds[0])
+    state['clients'] = []
+    while True:
+        body, fds = receive_message(conn)
+        if body.get('done'):
+            break
+        for record, fd in zip(body['clients'], fds):
+            state['clients'].append((socket.socket(fileno=fd), record))
+    return listenSocket, conn, state
+
+def adopt_state(server, state, restoreWindow):
+    # Rebuild the old process's clients and channels in server, which was
+    # created with the handed over listening socket
+    members = {}
+    for username, channelNames in state['restoredMembers'].items():
+        for channelName in channelNames:
+            members.setdefault(channelName, set()).add(username)
+    server.restore_channels(state['channels'], members, restoreWindow)
+
+    for sock, record in state['clients']:
+        addr = record['addr']
+        client = server.add_client(sock, tuple(addr) if isinstance(addr, list) else addr)
+        if record['framing'] is not None:
+            client.framing = record['framing']
+            client.decoder = make_decoder(client.framing)
+            if record['leftover']:
+                client.decoder.buffer = bytearray(record['leftover'].encode('latin-1'))
+        if record['loggedIn']:
+            client.name = record['name']
+            client.LoggedIn = True
+            server.userList[client.name] = client
+        for channelName in record['channels']:
+            channel = server.channelList.get(channelName)
+            if channel is None:
+                channel = server.create_channel(channelName)
+            if not client.channels:
+                client.channels = set()
+            client.channels.add(channel)
+            channel.users.add(client)
+            channel.add_name(client.name)
+        if record['outbound']:
+            server.queue_frame(client, record['outbound'].encode('latin-1'))
+        limits = record.get('limits')
+        if limits is not None and server.limiter is not None and len(limits) == len(server.limiter.intervals):
+            # Only if the limits are set up the same way here
+            client.limits = [server.now + ahead for ahead in limits]
+        if record.get('held'):
+            # Not read from until these have gone through the limiter again
+            client.held = [(command, status, flags, payload.encode('latin-1'))
+                           for command, status, flags, payload in record['held']]
+            server.update_interest(client)
+            server.timers.schedule(server.now, 0, server.release_held, client)
+    # Nothing else will flush these until the loop's first wakeup
+    server.flush_dirty_clients()
+    log.info("Took over %d clients and %d channels", len(state['clients']), len(server.channelList))
+
+def wait_for_exit(conn, timeout=30):
+    # The old process closes its end of the handoff connection when it exits
+    conn.sendall(b'k')
+    conn.settimeout(timeout)
+    try:
+        while conn.recv(1):
+            pass
+    except OSError:
+        pass
+    conn.close()
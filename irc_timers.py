@@ -0,0 +1,152 @@
+# Miguel Delapaz - CS594 - IRC Server timers
+#
+# A hierarchical timing wheel.  Time moves in ticks of `resolution` seconds.
+# Level 0 has a slot for each of the next SLOTS ticks, level 1 a slot for
+# each of the next SLOTS blocks of SLOTS ticks, and so on up.  A timer goes
+# in the lowest level whose range covers its expiry, and whenever level 0
+# wraps around the next slot of the level above is spread out over the
+# level below.  Scheduling and cancelling are a set add and discard, and a
+# tick only ever touches the one slot that is due, so the number of timers
+# pending (one per connection) doesn't matter to the event loop.  Idle
+# stretches are skipped: with nothing in the lower levels, time jumps
+# straight to the next cascade that could bring something down.
+import math
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+# 64^4 ticks - a couple of months at the default resolution.  Anything
+# further out is parked in the top level and placed again when it comes round
+LEVELS = 4
+
+class Timer:
+    __slots__ = ('expires', 'callback', 'args', 'bucket', 'level')
+
+    def __init__(self, callback, args):
+        self.expires = 0
+        self.callback = callback
+        self.args = args
+        # Set the timer is waiting in, None once it has fired or been cancelled
+        self.bucket = None
+        self.level = 0
+
+class TimerWheel:
+    def __init__(self, now, resolution=0.5):
+        self.resolution = resolution
+        self.start = now
+        # Last tick handled
+        self.tick = 0
+        self.count = 0
+        # Timers waiting in each level
+        self.levelCounts = [0] * LEVELS
+        # First tick that may have something to do, worked out by
+        # next_timeout and kept until it passes.  None when not known
+        self.nextTick = None
+        self.levels = [[set() for i in range(SLOTS)] for level in range(LEVELS)]
+
+    def schedule(self, now, delay, callback, *args):
+        # callback(*args) runs in the first tick at least delay seconds after now
+        timer = Timer(callback, args)
+        self.reschedule(timer, now, delay)
+        return timer
+
+    def reschedule(self, timer, now, delay):
+        # Move a timer (pending, fired or cancelled) to a new expiry
+        if timer.bucket is not None:
+            timer.bucket.discard(timer)
+            self.levelCounts[timer.level] -= 1
+        else:
+            self.count += 1
+        timer.expires = max(self.tick + 1, int(math.ceil((now - self.start + delay) / self.resolution)))
+        self.insert(timer)
+
+    def cancel(self, timer):
+        if timer.bucket is not None:
+            timer.bucket.discard(timer)
+            timer.bucket = None
+            self.count -= 1
+            self.levelCounts[timer.level] -= 1
+
+    def insert(self, timer):
+        expires = timer.expires
+        delta = expires - self.tick
+        level = 0
+        while delta >= SLOTS and level < LEVELS - 1:
+            delta >>= SLOT_BITS
+            level += 1
+        if delta >= SLOTS:
+            # Past the end of the wheel - wait in the last top level slot
+            # before this one comes round again
+            expires = self.tick + (SLOT_MASK << (SLOT_BITS * level))
+        bucket = self.levels[level][(expires >> (SLOT_BITS * level)) & SLOT_MASK]
+        bucket.add(timer)
+        timer.bucket = bucket
+        timer.level = level
+        self.levelCounts[level] += 1
+        if level == 0 and self.nextTick is not None and expires < self.nextTick:
+            self.nextTick = expires
+
+    def cascade(self, level, index):
+        slots = self.levels[level]
+        bucket = slots[index]
+        if bucket:
+            slots[index] = set()
+            self.levelCounts[level] -= len(bucket)
+            for timer in bucket:
+                self.insert(timer)
+
+    def advance(self, now):
+        # Run everything that is due by now
+        target = int((now - self.start) / self.resolution)
+        slots = self.levels[0]
+        counts = self.levelCounts
+        while self.tick < target:
+            if not self.count:
+                self.tick = target
+                break
+            level = 0
+            while not counts[level]:
+                level += 1
+            if level:
+                # Nothing can be due before that level next cascades
+                shift = SLOT_BITS * level
+                boundary = ((self.tick >> shift) + 1) << shift
+                if boundary > target:
+                    self.tick = target
+                    break
+                self.tick = boundary - 1
+            self.tick += 1
+            tick = self.tick
+            index = tick & SLOT_MASK
+            level = 0
+            while index == 0 and level < LEVELS - 1:
+                level += 1
+                index = (tick >> (SLOT_BITS * level)) & SLOT_MASK
+                self.cascade(level, index)
+            index = tick & SLOT_MASK
+            bucket = slots[index]
+            if bucket:
+                slots[index] = set()
+                # One at a time - a callback may cancel or reschedule timers
+                # still waiting in this bucket
+                while bucket:
+                    timer = bucket.pop()
+                    timer.bucket = None
+                    self.count -= 1
+                    counts[0] -= 1
+                    timer.callback(*timer.args)
+
+    def next_timeout(self, now):
+        # Seconds until the next tick with anything to do, for the event
+        # loop's select timeout.  None when no timers are pending
+        if not self.count:
+            return None
+        tick = self.nextTick
+        if tick is None or tick <= self.tick:
+            slots = self.levels[0]
+            tick = self.tick + 1
+            # Stop at the next cascade - it may bring timers down into level 0
+            while tick & SLOT_MASK and not slots[tick & SLOT_MASK]:
+                tick += 1
+            self.nextTick = tick
+        return max(0.0, self.start + tick * self.resolution - now)
@@ -0,0 +1,145 @@
+# Miguel Delapaz - CS594 - IRC Server TLS
+#
+# Optional TLS on the client port.  Accepted connections are wrapped without
+# handshaking, and the handshake is driven from the event loop like any
+# other socket: do_handshake() is retried whenever the socket is ready for
+# whatever OpenSSL last asked for (SSLWantReadError - readable,
+# SSLWantWriteError - writable).  A connection that hasn't finished within
+# HANDSHAKE_TIMEOUT is dropped.  Once through, the socket becomes an
+# ordinary client, a TLSClient, whose reads and writes go through
+# recv_tls and OutputBuffer.flush_tls in irc_protocol.
+#
+# Resumption: TLS 1.3 session tickets are on, and a resumed handshake skips
+# the certificate and its signature - the expensive part.  Ticket keys
+# belong to the SSLContext, so build it once, before the workers are forked
+# (see irc_server's main), and a ticket from any worker is good at all of
+# them.  Federated nodes each have their own keys; a client resumes with
+# the node it was last connected to.
+#
+# TLS connections can't be handed to a new process (irc_state) - the
+# session state lives in this process's OpenSSL.
+import logging
+import selectors
+import ssl
+
+import irc_server
+from irc_protocol import recv_tls
+
+log = logging.getLogger('irc_tls')
+
+# Seconds a new connection has to get through the handshake
+HANDSHAKE_TIMEOUT = 10.0
+
+def make_server_context(certFile, keyFile=None):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certFile, keyFile)
+    # One ticket per connection is all a reconnecting client uses, and each
+    # costs the server an encryption and a write after the handshake
+    context.num_tickets = 1
+    return context
+
+def make_client_context(caFile=None, verify=True):
+    # The system's trusted certificates, or caFile (e.g. the server's own
+    # self-signed certificate).  verify=False accepts any certificate -
+    # for testing only
+    context = ssl.create_default_context(cafile=caFile)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+class TLSClient(irc_server.Client):
+    __slots__ = ()
+
+    def receive(self):
+        return recv_tls(self.sock)
+
+    def send_outgoing_data(self):
+        return self.outbound.flush_tls(self.sock)
+
+class Handshake:
+    __slots__ = ('sock', 'addr', 'timer', 'handler', 'events')
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.timer = None
+        self.handler = None
+        self.events = selectors.EVENT_READ
+
+class TLSAcceptor:
+    def __init__(self, server, context, handshakeTimeout=HANDSHAKE_TIMEOUT):
+        self.server = server
+        self.context = context
+        self.handshakeTimeout = handshakeTimeout
+        # Handshakes in progress
+        self.pending = 0
+        server.clientClass = TLSClient
+
+    def accept(self, sock, addr):
+        sock.setblocking(False)
+        try:
+            sock = self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        except (ssl.SSLError, OSError) as e:
+            log.debug("Could not start TLS with %s: %s", addr, e)
+            sock.close()
+            return
+        handshake = Handshake(sock, addr)
+        handshake.handler = self.make_handler(handshake)
+        handshake.timer = self.server.timers.schedule(self.server.now, self.handshakeTimeout,
+                                                      self.expire_handshake, handshake)
+        self.pending += 1
+        # The client speaks first, so there is nothing to do until its hello arrives
+        self.server.selector.register(sock, selectors.EVENT_READ, handshake.handler)
+
+    def make_handler(self, handshake):
+        return lambda events: self.process_handshake(handshake)
+
+    def process_handshake(self, handshake):
+        server = self.server
+        sock = handshake.sock
+        try:
+            sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.wait(handshake, selectors.EVENT_READ)
+            return
+        except ssl.SSLWantWriteError:
+            self.wait(handshake, selectors.EVENT_WRITE)
+            return
+        except (ssl.SSLError, OSError) as e:
+            log.debug("TLS handshake with %s failed: %s", handshake.addr, e)
+            self.close_handshake(handshake)
+            return
+
+        self.pending -= 1
+        server.timers.cancel(handshake.timer)
+        server.selector.unregister(sock)
+        if server.metrics is not None:
+            server.metrics.tlsHandshakes += 1
+            if sock.session_reused:
+                server.metrics.tlsResumed += 1
+        server.add_client(sock, handshake.addr)
+        # The client may have sent its LOGIN right behind its last
+        # handshake message
+        server.process_incoming_data(sock)
+
+    def wait(self, handshake, events):
+        if events != handshake.events:
+            handshake.events = events
+            self.server.selector.modify(handshake.sock, events, handshake.handler)
+
+    def expire_handshake(self, handshake):
+        log.debug("TLS handshake with %s timed out", handshake.addr)
+        handshake.timer = None
+        self.close_handshake(handshake)
+
+    def close_handshake(self, handshake):
+        server = self.server
+        self.pending -= 1
+        if handshake.timer is not None:
+            server.timers.cancel(handshake.timer)
+        server.selector.unregister(handshake.sock)
+        handshake.sock.close()
+        if server.metrics is not None:
+            server.metrics.tlsFailures += 1
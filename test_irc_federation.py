@@ -0,0 +1,93 @@
+# Miguel Delapaz - CS594 - Tests for federation
+#
+# Several nodes run in the test process (see conftest.py), linked over
+# localhost.  Run with python -m pytest -q
+from irc_federation import FederationBus
+from irc_protocol import Command, ResponseCodes
+
+def start_nodes(net, count, link=True):
+    # Nodes 1 to count, fully linked unless link is False
+    servers = []
+    for nodeId in range(1, count + 1):
+        server = net.server()
+        server.bus = FederationBus(server, nodeId, 0, {}, '127.0.0.1')
+        servers.append(server)
+    if link:
+        link_nodes(net, servers)
+    return servers
+
+def link_nodes(net, servers):
+    for server in servers:
+        for other in servers:
+            if other is not server:
+                server.bus.peers[other.bus.nodeId] = ('127.0.0.1', other.bus.linkPort)
+    net.wait(lambda: all(len(server.bus.links) == len(servers) - 1 for server in servers))
+
+def users(net, peer, channelName):
+    text, ok = net.request(peer, Command.LIST_USERS, channelName)
+    assert ok
+    # The channel name comes first
+    return text.split()[1:]
+
+def test_federation_routing(net):
+    one, two, three = start_nodes(net, 3)
+    alice = net.peer(one, 'alice')
+    bob = net.peer(two, 'bob')
+    carol = net.peer(three, 'carol')
+    net.request(alice, Command.ADD_CHANNEL, 'room')
+    net.wait(lambda: 'room' in two.channelList and 'room' in three.channelList)
+    net.request(bob, Command.JOIN_CHANNEL, 'room')
+    net.request(carol, Command.JOIN_CHANNEL, 'room')
+    net.wait(lambda: len(one.channelList['room'].names) == 3)
+    alice.send(Command.MESSAGE, 'room\nhello')
+    for peer in (alice, bob, carol):
+        net.wait(lambda: peer.responses(Command.MESSAGE))
+        assert peer.responses(Command.MESSAGE) == ['room\nalice\nhello']
+    for peer in (alice, bob, carol):
+        assert sorted(users(net, peer, 'room')) == ['alice', 'bob', 'carol']
+    # A name taken on one node can't be had on another
+    dave = net.peer(three)
+    text, ok = net.request(dave, Command.LOGIN, 'alice')
+    assert not ok
+
+def test_federation_simultaneous_login(net):
+    one, two, three = start_nodes(net, 3)
+    alice = net.peer(one, 'alice')
+    net.request(alice, Command.ADD_CHANNEL, 'room')
+    net.wait(lambda: 'room' in two.channelList and 'room' in three.channelList)
+    # Both log in as xx before either node hears about the other
+    first = net.peer(two)
+    second = net.peer(three)
+    first.send(Command.LOGIN, 'xx')
+    second.send(Command.LOGIN, 'xx')
+    # The lower node id keeps the name
+    net.wait(lambda: second.closed)
+    assert second.responses(Command.LOGIN, ResponseCodes.ERROR) == ['Username xx is already in use']
+    net.settle()
+    assert not first.closed
+    net.request(first, Command.JOIN_CHANNEL, 'room')
+    assert 'xx' in two.userList and 'xx' not in three.userList
+    assert one.remoteUserList['xx'] == three.remoteUserList['xx'] == 2
+    for peer in (alice, first):
+        assert sorted(users(net, peer, 'room')) == ['alice', 'xx']
+
+def test_federation_duplicate_on_relink(net):
+    # Logged in on both sides while the nodes were apart - the lower id
+    # wins once they link up
+    one, two = start_nodes(net, 2, link=False)
+    first = net.peer(one, 'xx')
+    second = net.peer(two, 'xx')
+    net.request(first, Command.ADD_CHANNEL, 'room')
+    net.request(second, Command.ADD_CHANNEL, 'room')
+    link_nodes(net, [one, two])
+    net.wait(lambda: second.closed)
+    net.settle()
+    assert not first.closed
+    assert 'xx' in one.userList and 'xx' not in one.remoteUserList
+    assert two.remoteUserList == {'xx': 1}
+    assert users(net, first, 'room') == ['xx']
+    # The name is free again once its owner goes
+    first.send(Command.LOGOUT)
+    net.wait(lambda: 'xx' not in two.remoteUserList)
+    third = net.peer(two, 'xx')
+    assert not third.closed
@@ -0,0 +1,57 @@
+# Miguel Delapaz - CS594 - Tests for channel history
+#
+# Run with python -m pytest -q
+from irc_history import History, entry_size
+from irc_protocol import Command, ResponseCodes, encode_binary_frame, FRAMINGS, FRAMING_BINARY, FRAMING_LEGACY
+from irc_server import Channel
+
+def test_history_replayed_on_join(net):
+    server = net.server(historyDepth=5)
+    alice = net.peer(server, 'alice')
+    net.request(alice, Command.ADD_CHANNEL, 'room')
+    for i in range(8):
+        alice.send(Command.MESSAGE, 'room\nhello ' + str(i))
+    net.wait(lambda: len(alice.responses(Command.MESSAGE)) == 8)
+    bob = net.peer(server, 'bob')
+    text, ok = net.request(bob, Command.JOIN_CHANNEL, 'room')
+    assert ok
+    # The last five, oldest first, straight after the JOIN response
+    net.wait(lambda: len(bob.responses(Command.MESSAGE)) == 5)
+    assert bob.responses(Command.MESSAGE) == ['room\nalice\nhello ' + str(i) for i in range(3, 8)]
+    assert [c for c, s, text in bob.frames][-6:] == [Command.JOIN_CHANNEL.value] + [Command.MESSAGE.value] * 5
+
+def test_history_replay_fits_watermark(net):
+    server = net.server(highWater=64 * 1024, lowWater=16 * 1024)
+    alice = net.peer(server, 'alice')
+    net.request(alice, Command.ADD_CHANNEL, 'room')
+    for i in range(20):
+        alice.send(Command.MESSAGE, 'room\n' + str(i).zfill(2) + 'x' * 8000)
+    net.wait(lambda: len(alice.responses(Command.MESSAGE)) == 20)
+    bob = net.peer(server, 'bob')
+    net.request(bob, Command.JOIN_CHANNEL, 'room')
+    net.settle()
+    # Only the newest messages that fit under the high watermark
+    replayed = bob.responses(Command.MESSAGE)
+    assert 0 < len(replayed) < 20
+    assert sum(len(text) for text in replayed) <= 64 * 1024
+    assert [text[11:13] for text in replayed] == [str(i).zfill(2) for i in range(20 - len(replayed), 20)]
+    assert 'bob' in server.userList
+
+def test_history_cap_covers_replay():
+    # Frames made for a framing nobody had when a message was sent count
+    # against the cap like any others
+    history = History(50, 20000)
+    channels = [Channel('a'), Channel('b')]
+    for channel in channels:
+        for i in range(10):
+            message = channel.name + '\nalice\n' + 'x' * 800
+            frames = [None] * FRAMINGS
+            frames[FRAMING_BINARY] = encode_binary_frame(Command.MESSAGE, ResponseCodes.OK.value, message)
+            history.record(channel, frames, message)
+    assert history.size <= history.maxBytes
+    frames = history.replay(channels[1], FRAMING_LEGACY, 1 << 20)
+    assert len(frames) == 10
+    assert history.size <= history.maxBytes
+    # The quiet channel went to make room
+    assert channels[0].history is None
+    assert history.size == sum(entry_size(entry) for entry in channels[1].history)
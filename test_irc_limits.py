@@ -0,0 +1,129 @@
+# Miguel Delapaz - CS594 - Tests for the rate limiter
+#
+# RateLimiter is driven with random traffic from a few clients and compared
+# against the textbook token bucket.  Seeds are fixed so a failure can be
+# reproduced.  Run with python -m pytest -q
+import random
+import types
+
+import pytest
+
+from irc_limits import RateLimiter
+from irc_protocol import Command
+
+SEEDS = range(5)
+
+class BucketModel:
+    # The textbook token bucket: up to burst tokens, refilled at rate per
+    # second, a frame takes one
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = 0.0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait(self):
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_rate_limiter(seed):
+    rng = random.Random(seed)
+    limits = {'total': (rng.choice([20, 50, 200]), rng.randint(1, 40)),
+              'MESSAGE': (rng.choice([2, 5, 20]), rng.randint(1, 20)),
+              'LIST_ROOMS': (rng.choice([1, 5]), rng.randint(1, 5))}
+    limiter = RateLimiter(limits)
+    commands = [Command.MESSAGE, Command.LIST_ROOMS, Command.JOIN_CHANNEL, Command.PING]
+    clients = []
+    for i in range(3):
+        buckets = {}
+        for name, (rate, burst) in limits.items():
+            buckets[name] = BucketModel(rate, burst)
+        clients.append((types.SimpleNamespace(limits=None), buckets))
+
+    now = 0.0
+    allowed = 0
+    for step in range(20000):
+        # Sometimes a burst, sometimes a pause long enough to refill
+        now += rng.expovariate(100) if rng.random() < 0.95 else rng.uniform(0, 5)
+        client, buckets = rng.choice(clients)
+        command = rng.choice(commands)
+        for bucket in buckets.values():
+            bucket.refill(now)
+        total = buckets['total']
+        limited = buckets.get(command.name)
+        if total.tokens < 1:
+            expected = total.wait()
+        elif limited is not None and limited.tokens < 1:
+            expected = limited.wait()
+        else:
+            expected = 0
+            total.tokens -= 1
+            if limited is not None:
+                limited.tokens -= 1
+        wait = limiter.check(client, command.value, now)
+        assert wait == pytest.approx(expected, abs=1e-6)
+        allowed += not wait
+    assert 0 < allowed < 20000
+
+def test_rate_limiter_full_burst():
+    # A whole burst goes at once, wherever the clock happens to be
+    limiter = RateLimiter({'total': (200, 400), 'MESSAGE': (10, 5)})
+    rng = random.Random(0)
+    for i in range(200):
+        client = types.SimpleNamespace(limits=None)
+        now = rng.uniform(0, 1e6)
+        waits = [limiter.check(client, Command.MESSAGE.value, now) for j in range(6)]
+        assert waits[:5] == [0] * 5
+        assert waits[5] == pytest.approx(0.1)
+
+@pytest.mark.parametrize('backend', ['select', 'default'])
+def test_flood_with_nothing_to_write(net, backend):
+    # Held for a rate limit with no output pending, the client has nothing
+    # left to wait for in the selector - which select() and kqueue won't
+    # take as an event mask of 0
+    server = net.server(backend, rateLimits={'LIST_ROOMS': (10, 5)})
+    peer = net.peer(server, 'flood')
+    for i in range(20):
+        peer.send(Command.LIST_ROOMS)
+    net.wait(lambda: len(peer.responses(Command.LIST_ROOMS)) == 20)
+    assert server.running and not peer.closed
+    # Back to normal afterwards
+    text, ok = net.request(peer, Command.ADD_CHANNEL, 'room')
+    assert ok
+
+def flood_room(net, policy):
+    server = net.server(rateLimits={'MESSAGE': (10, 5)}, floodPolicy=policy)
+    flood = net.peer(server, 'flood')
+    quiet = net.peer(server, 'quiet')
+    net.request(flood, Command.ADD_CHANNEL, 'room')
+    net.request(quiet, Command.JOIN_CHANNEL, 'room')
+    for i in range(12):
+        flood.send(Command.MESSAGE, 'room\nm' + str(i))
+    return server, flood, quiet
+
+def test_flood_policy_delay(net):
+    server, flood, quiet = flood_room(net, 'delay')
+    flood.send(Command.LIST_ROOMS)
+    net.wait(lambda: len(quiet.responses(Command.MESSAGE)) == 5)
+    # The rest are held back, and the flooder's later requests with them -
+    # but nobody else is kept waiting
+    text, ok = net.request(quiet, Command.LIST_ROOMS)
+    assert ok and len(quiet.responses(Command.MESSAGE)) < 12
+    assert not flood.responses(Command.LIST_ROOMS)
+    net.wait(lambda: flood.responses(Command.LIST_ROOMS))
+    messages = quiet.responses(Command.MESSAGE)
+    assert messages == ['room\nflood\nm' + str(i) for i in range(12)]
+    assert not flood.closed
+
+def test_flood_policy_disconnect(net):
+    server, flood, quiet = flood_room(net, 'disconnect')
+    net.wait(lambda: flood.closed and len(quiet.responses(Command.MESSAGE)) == 5)
+    net.settle()
+    assert quiet.responses(Command.MESSAGE) == ['room\nflood\nm' + str(i) for i in range(5)]
+    assert 'flood' not in server.userList
+    text, ok = net.request(quiet, Command.LIST_USERS, 'room')
+    assert ok and 'flood' not in text.split('\n')
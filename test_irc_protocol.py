@@ -0,0 +1,175 @@
+# Miguel Delapaz - CS594 - Tests for the wire protocol
+#
+# Randomized checks against brute-force models: frames fed to the decoders
+# in random splits must come back out whole and in order, and OutputBuffer
+# must write exactly the frames it was given (less any it dropped) however
+# the socket (plain or TLS) splits the writes.  Seeds are fixed so a failure
+# can be reproduced.  Run with python -m pytest -q
+import random
+import ssl
+
+import pytest
+
+from irc_protocol import ProtocolError, FrameDecoder, BinaryFrameDecoder, OutputBuffer, encode_frame, encode_binary_frame, MAX_PAYLOAD, TLS_RECORD_SIZE
+
+SEEDS = range(5)
+
+def random_splits(rng, stream):
+    # The stream cut up the way recv might hand it over - often a byte at a
+    # time through the headers, sometimes everything at once
+    pieces = []
+    offset = 0
+    while offset < len(stream):
+        size = rng.choice([1, 2, 5, rng.randint(1, 64), rng.randint(1, 70000), len(stream)])
+        pieces.append(stream[offset:offset + size])
+        offset += size
+    return pieces
+
+def random_payload(rng, largest):
+    size = rng.randint(0, 300) if rng.random() < 0.9 else rng.randint(0, largest)
+    return rng.randbytes(size)
+
+def decode_all(decoder, pieces):
+    frames = []
+    for piece in pieces:
+        frames.extend(decoder.feed(piece))
+    return frames
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_frame_decoder(seed):
+    rng = random.Random(seed)
+    decoder = FrameDecoder()
+    for round in range(20):
+        frames = []
+        for i in range(rng.randint(1, 50)):
+            frames.append((rng.randint(0, 9), None, 0, random_payload(rng, MAX_PAYLOAD)))
+        stream = b''.join([encode_frame(command, payload) for command, status, flags, payload in frames])
+        assert decode_all(decoder, random_splits(rng, stream)) == frames
+        assert not decoder.buffer
+
+    with pytest.raises(ProtocolError):
+        decoder.feed(b'1000x5hello')
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_binary_frame_decoder(seed):
+    rng = random.Random(seed)
+    decoder = BinaryFrameDecoder()
+    for round in range(20):
+        frames = []
+        for i in range(rng.randint(1, 50)):
+            frames.append((rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255),
+                           random_payload(rng, 200000)))
+        stream = b''.join([encode_binary_frame(command, status, payload, flags)
+                           for command, status, flags, payload in frames])
+        assert decode_all(decoder, random_splits(rng, stream)) == frames
+        assert not decoder.buffer
+
+    with pytest.raises(ProtocolError):
+        decoder.feed(b'\x00' * 16)
+
+def random_payload(rng, largest):
+    size = rng.randint(0, 300) if rng.random() < 0.9 else rng.randint(0, largest)
+    return rng.randbytes(size)
+
+class ShortSocket:
+    # Takes a random part of each write, or nothing at all
+    def __init__(self, rng):
+        self.rng = rng
+        self.received = bytearray()
+
+    def accept(self, data):
+        if self.rng.random() < 0.2:
+            raise BlockingIOError()
+        sent = self.rng.randint(1, len(data))
+        self.received += data[:sent]
+        return sent
+
+    def send(self, data):
+        return self.accept(bytes(data))
+
+    def sendmsg(self, buffers):
+        return self.accept(b''.join([bytes(b) for b in buffers]))
+
+class ShortTLSSocket(ShortSocket):
+    # An SSLSocket: no sendmsg, and a write it couldn't finish must be
+    # retried with exactly the same bytes
+    def __init__(self, rng):
+        ShortSocket.__init__(self, rng)
+        self.retry = None
+
+    def send(self, data):
+        data = bytes(data)
+        if self.retry is not None:
+            assert data == self.retry
+            self.retry = None
+        if self.rng.random() < 0.2:
+            self.retry = data
+            raise ssl.SSLWantWriteError()
+        if len(data) > TLS_RECORD_SIZE:
+            sent = self.rng.randint(1, len(data))
+        else:
+            sent = len(data)
+        self.received += data[:sent]
+        return sent
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('tls', [False, True])
+def test_output_buffer(seed, tls):
+    rng = random.Random(seed)
+    sock = ShortTLSSocket(rng) if tls else ShortSocket(rng)
+    flush = OutputBuffer.flush_tls if tls else OutputBuffer.flush
+    outbound = OutputBuffer()
+    # Frames still queued, as [frame, bytes of it already written], and
+    # every frame that hasn't been dropped
+    queued = []
+    expected = []
+    for step in range(2000):
+        choice = rng.random()
+        if choice < 0.5:
+            entry = [random_payload(rng, 40000) or b'x', 0]
+            assert outbound.append(entry[0]) == (not queued)
+            queued.append(entry)
+            expected.append(entry)
+        elif choice < 0.9:
+            before = len(sock.received)
+            try:
+                flush(outbound, sock)
+            except BlockingIOError:
+                pass
+            sent = len(sock.received) - before
+            while sent:
+                head = queued[0]
+                taken = min(sent, len(head[0]) - head[1])
+                head[1] += taken
+                sent -= taken
+                if head[1] == len(head[0]):
+                    queued.pop(0)
+        else:
+            # Only whole frames can go, and not the ones in a partly written
+            # front chunk (with TLS, one write attempted is enough - it may
+            # hold several frames joined together)
+            target = rng.randint(0, outbound.size)
+            keep = []
+            if outbound.chunks and isinstance(outbound.chunks[0], memoryview):
+                started = len(outbound.chunks[0])
+                while started:
+                    entry = queued.pop(0)
+                    started -= len(entry[0]) - entry[1]
+                    keep.append(entry)
+            size = outbound.size
+            dropped = 0
+            while queued and size > target:
+                entry = queued.pop(0)
+                size -= len(entry[0])
+                expected = [e for e in expected if e is not entry]
+                dropped += 1
+            queued = keep + queued
+            assert outbound.drop_oldest(target) == dropped
+        assert outbound.size == sum([len(f) - s for f, s in queued])
+
+    while outbound.size:
+        try:
+            flush(outbound, sock)
+        except BlockingIOError:
+            pass
+    assert bytes(sock.received) == b''.join([frame for frame, sent in expected])
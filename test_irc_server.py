@@ -0,0 +1,92 @@
+# Miguel Delapaz - CS594 - Tests for the server
+#
+# Servers and clients run in the test process - see conftest.py.  Run with
+# python -m pytest -q
+import socket
+
+from irc_protocol import Command
+
+COUNT = 100
+
+def message(i):
+    return 'm' + str(i).zfill(3) + 'x' * 8000
+
+def slow_room(net, policy, hardLimit=4 * 1024 * 1024):
+    # fast sends COUNT 8k messages to a room where slow has stopped reading
+    server = net.server(highWater=64 * 1024, lowWater=16 * 1024, hardLimit=hardLimit, overflowPolicy=policy)
+    fast = net.peer(server, 'fast')
+    slow = net.peer(server, 'slow', receiveBuffer=4096)
+    net.request(fast, Command.ADD_CHANNEL, 'room')
+    net.request(slow, Command.JOIN_CHANNEL, 'room')
+    # Keep the kernel from soaking up the whole backlog on the server's side
+    server.userList['slow'].sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    slow.reading = False
+    for i in range(COUNT):
+        fast.send(Command.MESSAGE, 'room\n' + message(i))
+    net.wait(lambda: len(fast.responses(Command.MESSAGE)) == COUNT)
+    return server, fast, slow
+
+def received(peer):
+    return [text.split('\n')[2] for text in peer.responses(Command.MESSAGE)]
+
+def test_overflow_pause(net):
+    server, fast, slow = slow_room(net, 'pause')
+    client = server.userList['slow']
+    assert client.paused
+    # Nothing slow sends is read while it is paused
+    slow.send(Command.LIST_ROOMS)
+    net.settle()
+    slow.poll()
+    assert not slow.responses(Command.LIST_ROOMS)
+    # Once it catches up it is read again, and it missed nothing
+    slow.reading = True
+    net.wait(lambda: slow.responses(Command.LIST_ROOMS))
+    assert not client.paused
+    assert received(slow) == [message(i) for i in range(COUNT)]
+
+def test_overflow_drop_oldest(net):
+    server, fast, slow = slow_room(net, 'drop-oldest')
+    client = server.userList['slow']
+    assert client.dropped > 0 and not client.paused
+    slow.reading = True
+    net.wait(lambda: len(slow.responses(Command.MESSAGE)) == COUNT - client.dropped)
+    # Whole messages were dropped from the middle of the queue; the newest
+    # ones all arrive, in order
+    messages = received(slow)
+    assert messages == sorted(messages)
+    assert messages[-1] == message(COUNT - 1)
+    assert set(messages) <= set(message(i) for i in range(COUNT))
+
+def test_overflow_disconnect(net):
+    server, fast, slow = slow_room(net, 'disconnect')
+    net.wait(lambda: 'slow' not in server.userList)
+    slow.reading = True
+    net.wait(lambda: slow.closed)
+    assert len(slow.responses(Command.MESSAGE)) < COUNT
+    assert not fast.closed
+
+def test_overflow_hard_limit(net):
+    # Over the hard limit even a paused client goes
+    server, fast, slow = slow_room(net, 'pause', hardLimit=256 * 1024)
+    net.wait(lambda: 'slow' not in server.userList)
+    assert not fast.closed
+
+def test_message_many_once_per_member(net):
+    server = net.server()
+    alice = net.peer(server, 'alice')
+    bob = net.peer(server, 'bob')
+    carol = net.peer(server, 'carol')
+    for name in ('a', 'b', 'c'):
+        net.request(alice, Command.ADD_CHANNEL, name)
+    # bob is in two of the channels, carol in one
+    net.request(bob, Command.JOIN_CHANNEL, 'a')
+    net.request(bob, Command.JOIN_CHANNEL, 'b')
+    net.request(carol, Command.JOIN_CHANNEL, 'b')
+    alice.send(Command.MESSAGE_MANY, 'a b c a\nhello')
+    net.wait(lambda: alice.responses(Command.MESSAGE) and carol.responses(Command.MESSAGE))
+    net.settle()
+    # One copy each, tagged with the first channel it reached them through -
+    # the sender is in all three
+    assert alice.responses(Command.MESSAGE) == ['a\nalice\nhello']
+    assert bob.responses(Command.MESSAGE) == ['a\nalice\nhello']
+    assert carol.responses(Command.MESSAGE) == ['b\nalice\nhello']
@@ -0,0 +1,75 @@
+# Miguel Delapaz - CS594 - Tests for the journal and handoff
+#
+# The journal is tested in process (see conftest.py).  A handoff is between
+# two processes, so those tests run irc_server.py itself.  Run with
+# python -m pytest -q
+import os
+import subprocess
+import sys
+
+import irc_state
+from conftest import free_port, start_server
+from irc_protocol import Command, encode_binary_frame
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'irc_server.py')
+
+def test_journal_restore(net, tmp_path):
+    path = str(tmp_path / 'journal')
+    server = net.server()
+    server.journal = irc_state.Journal(server, path)
+    server.journal.open()
+    alice = net.peer(server, 'alice')
+    bob = net.peer(server, 'bob')
+    for name in ('room1', 'room2', 'gone'):
+        net.request(alice, Command.ADD_CHANNEL, name)
+    net.request(bob, Command.JOIN_CHANNEL, 'room1')
+    net.request(alice, Command.LEAVE_CHANNEL, 'gone')
+    # Gone without closing anything, as in a crash
+    server.running = False
+
+    channels, members = irc_state.read_journal(path)
+    assert channels == {'room1', 'room2'}
+    assert members == {'room1': {'alice', 'bob'}, 'room2': {'alice'}}
+    server = net.server()
+    server.restore_channels(channels, members, 300)
+    carol = net.peer(server, 'carol')
+    text, ok = net.request(carol, Command.LIST_ROOMS)
+    assert text.split() == ['room1', 'room2']
+    # Back in their channels as soon as they log in again
+    alice = net.peer(server, 'alice')
+    net.wait(lambda: len(alice.responses(Command.JOIN_CHANNEL)) == 2)
+    text, ok = net.request(carol, Command.LIST_USERS, 'room1')
+    assert 'alice' in text.split() and 'bob' not in text.split()
+
+def test_handoff(net, tmp_path, processes):
+    # Clients stay connected through a handoff, along with a frame half
+    # received and messages held back by the rate limiter
+    port = free_port()
+    path = str(tmp_path / 'handoff')
+    options = ['--handoff-socket', path, '--rate-limit', 'MESSAGE=2/2']
+    old = start_server(port, 'irc_server.py', *options)
+    processes.append(old)
+    alice = net.connect(port, 'alice')
+    bob = net.connect(port, 'bob')
+    net.request(alice, Command.ADD_CHANNEL, 'room')
+    net.request(bob, Command.JOIN_CHANNEL, 'room')
+    for i in range(8):
+        alice.send(Command.MESSAGE, 'room\nm' + str(i))
+    net.wait(lambda: len(bob.responses(Command.MESSAGE)) >= 2)
+    frame = encode_binary_frame(Command.LIST_ROOMS, 0, '')
+    alice.sock.sendall(frame[:3])
+
+    new = subprocess.Popen([sys.executable, SERVER, '--port', str(port), '--log-level', 'ERROR',
+                            '--takeover', path] + options)
+    processes.append(new)
+    assert old.wait(10) == 0
+    assert len(bob.responses(Command.MESSAGE)) < 8
+    alice.sock.sendall(frame[3:])
+    # All eight arrive, in order, and then the answer to the split frame
+    net.wait(lambda: alice.responses(Command.LIST_ROOMS), timeout=10)
+    net.wait(lambda: len(bob.responses(Command.MESSAGE)) == 8)
+    assert bob.responses(Command.MESSAGE) == ['room\nalice\nm' + str(i) for i in range(8)]
+    assert alice.responses(Command.LIST_ROOMS)[0].split() == ['room']
+    assert not alice.closed and not bob.closed
+    text, ok = net.request(bob, Command.LIST_USERS, 'room')
+    assert text.split() == ['room', 'alice', 'bob']
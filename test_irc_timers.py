@@ -0,0 +1,145 @@
+# Miguel Delapaz - CS594 - Tests for the timer wheel
+#
+# The wheel is driven with random operations and compared against the
+# obvious brute-force version.  Seeds are fixed so a failure can be
+# reproduced.  Run with python -m pytest -q
+import math
+import random
+import time
+
+import pytest
+
+from irc_timers import TimerWheel, SLOTS
+
+SEEDS = range(5)
+
+class WheelModel:
+    # TimerWheel plus the expiry tick of every timer it should be holding.
+    # Times are multiples of 0.25 so all the arithmetic is exact
+    def __init__(self, rng):
+        self.rng = rng
+        self.start = 1000.0
+        self.resolution = 0.5
+        self.now = self.start
+        self.wheel = TimerWheel(self.start, self.resolution)
+        self.timers = {}
+        self.pending = {}
+        self.fired = 0
+
+    def random_delay(self):
+        rng = self.rng
+        choice = rng.random()
+        if choice < 0.5:
+            return rng.randint(0, 8) * 0.25
+        if choice < 0.8:
+            # Past level 0
+            return rng.randint(0, 200) * 0.25
+        if choice < 0.98:
+            # Levels 1 and 2
+            return rng.randint(0, 12000) * 0.25
+        # Level 3
+        return rng.randint(0, 600000) * 0.25
+
+    def expected_tick(self, delay):
+        return max(self.wheel.tick + 1, int(math.ceil((self.now - self.start + delay) / self.resolution)))
+
+    def schedule(self, key):
+        delay = self.random_delay()
+        self.pending[key] = self.expected_tick(delay)
+        self.timers[key] = self.wheel.schedule(self.now, delay, self.process_timer, key)
+
+    def reschedule(self, key):
+        delay = self.random_delay()
+        self.pending[key] = self.expected_tick(delay)
+        self.wheel.reschedule(self.timers[key], self.now, delay)
+
+    def cancel(self, key):
+        self.pending.pop(key, None)
+        self.wheel.cancel(self.timers[key])
+
+    def process_timer(self, key):
+        assert self.pending.pop(key) == self.wheel.tick
+        self.fired += 1
+        # Like a connection's idle timer - sometimes it goes round again,
+        # possibly within the same advance()
+        if self.rng.random() < 0.3:
+            self.reschedule(key)
+
+    def advance(self, step):
+        self.now += step
+        self.wheel.advance(self.now)
+        assert self.wheel.tick == int((self.now - self.start) / self.resolution)
+        # Anything due has fired, at exactly its tick (checked in process_timer)
+        assert all(tick > self.wheel.tick for tick in self.pending.values())
+
+    def check_next_timeout(self, fresh):
+        wheel = self.wheel
+        if fresh:
+            wheel.nextTick = None
+        timeout = wheel.next_timeout(self.now)
+        if not self.pending:
+            assert timeout is None
+            return
+        # Wake for the earliest timer, or the next cascade if that comes first
+        boundary = (wheel.tick // SLOTS + 1) * SLOTS
+        expected = self.start + min(min(self.pending.values()), boundary) * self.resolution - self.now
+        assert timeout > 0
+        if fresh:
+            assert timeout == expected
+        else:
+            # A cached tick may be early (a timer since cancelled) but never late
+            assert timeout <= expected
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_timer_wheel(seed):
+    rng = random.Random(seed)
+    model = WheelModel(rng)
+    for step in range(3000):
+        choice = rng.random()
+        if choice < 0.4 or not model.timers:
+            model.schedule(len(model.timers))
+        elif choice < 0.5:
+            model.cancel(rng.randrange(len(model.timers)))
+        elif choice < 0.6:
+            # Pending, fired or cancelled alike
+            model.reschedule(rng.randrange(len(model.timers)))
+        elif choice < 0.97 or not model.pending:
+            model.advance(rng.randint(0, 12) * 0.25)
+        else:
+            # Straight to the next expiry, however far off
+            due = model.start + min(model.pending.values()) * model.resolution
+            model.advance(max(0.0, due - model.now))
+        assert model.wheel.count == len(model.pending) == sum(model.wheel.levelCounts)
+        model.check_next_timeout(step % 7 == 0)
+
+    # Run everything left, cascades and all
+    while model.pending:
+        model.advance(model.start + max(model.pending.values()) * model.resolution - model.now)
+    assert model.wheel.count == 0
+    assert model.fired > 1000
+
+def test_timer_wheel_idle():
+    # Long quiet stretches are jumped over, not walked a tick at a time - a
+    # year of half second ticks would take the best part of a minute
+    wheel = TimerWheel(0.0)
+    fired = []
+    started = time.perf_counter()
+    wheel.advance(365 * 86400.0)
+    assert wheel.tick == 2 * 365 * 86400
+    # Only far off timers pending: still no walking through empty rounds,
+    # and they fire on time
+    now = 365 * 86400.0
+    delays = [30 * 86400.0, 30 * 86400.0 + 0.5, 200 * 86400.0]
+    for delay in delays:
+        wheel.schedule(now, delay, fired.append, now + delay)
+    step = 86400.0 / 3
+    while now < 365 * 86400.0 * 2:
+        now += step
+        done = len(fired)
+        wheel.advance(now)
+        for due in fired[done:]:
+            # In the step it came due in
+            assert due <= now < due + step
+    assert fired == [365 * 86400.0 + delay for delay in delays]
+    assert wheel.count == 0
+    assert time.perf_counter() - started < 1.0
@@ -0,0 +1,63 @@
+# Miguel Delapaz - CS594 - Tests for TLS
+#
+# TLS handshakes block, so the servers here run as processes of their own
+# (see conftest.py) with a throwaway certificate made by the openssl
+# command.  Run with python -m pytest -q
+import shutil
+import subprocess
+
+import pytest
+
+import irc_tls
+from conftest import free_port, start_server
+from irc_protocol import Command
+from irc_session import Session
+
+SERVERS = [['irc_server.py', '--no-rate-limit'], ['irc_async.py', 'server']]
+
+@pytest.fixture(scope='module')
+def certificate(tmp_path_factory):
+    if shutil.which('openssl') is None:
+        pytest.skip("needs the openssl command")
+    directory = tmp_path_factory.mktemp('tls')
+    cert = str(directory / 'cert.pem')
+    key = str(directory / 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost', '-addext', 'subjectAltName=IP:127.0.0.1',
+                    '-keyout', key, '-out', cert], check=True, capture_output=True)
+    return cert, key
+
+@pytest.mark.parametrize('server', SERVERS)
+def test_tls_login_and_resumption(certificate, processes, server):
+    cert, key = certificate
+    port = free_port()
+    processes.append(start_server(port, server[0], *(server[1:] + ['--tls-cert', cert, '--tls-key', key])))
+    context = irc_tls.make_client_context(cert)
+
+    alice = Session(True, False, None, context)
+    alice.connect('127.0.0.1', port, 5)
+    alice.login('alice')
+    assert alice.wait_for(Command.LOGIN, 5).ok
+    alice.add_channel('room')
+    assert alice.wait_for(Command.JOIN_CHANNEL, 5).ok
+
+    # Every reconnect after the first offers the last session and gets it
+    # back, in both framings
+    bob = Session(False, False, None, context)
+    reused = []
+    for i in range(3):
+        bob.connect('127.0.0.1', port, 5)
+        reused.append(bob.sock.session_reused)
+        bob.login('bob')
+        assert bob.wait_for(Command.LOGIN, 5).ok
+        bob.join_channel('room')
+        assert bob.wait_for(Command.JOIN_CHANNEL, 5).ok
+        alice.send_message('room', 'hello ' + str(i))
+        # Past any history replayed on the join
+        event = bob.wait_for(Command.MESSAGE, 5)
+        while event.text != 'hello ' + str(i):
+            event = bob.wait_for(Command.MESSAGE, 5)
+        assert (event.channel, event.user) == ('room', 'alice')
+        bob.close()
+    assert reused == [False, True, True]
+    alice.close()